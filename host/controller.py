@@ -4,15 +4,58 @@ Cowork Sandbox Controller
 Host-side controller for communicating with Claude Code in VM via -p mode.
 """
 
+import functools
+import io
 import json
 import os
 import shlex
+import signal
 import subprocess
 import sys
-from dataclasses import dataclass, field
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
-from pathlib import Path
-from typing import Optional
+from pathlib import Path, PurePosixPath
+from typing import Callable, Optional
+from urllib.parse import quote
+
+try:
+    from host.ledger import DEFAULT_LEDGER_PATH, StreamJsonParser, UsageLedger
+    from host.readiness import (
+        VM_NODE_CACHE_ENV,
+        VM_WARM_CLI_CMD,
+        claude_probe,
+        ssh_probe,
+        wait_until_ready,
+    )
+    from host.tracing import DEFAULT_TRACE_PATH, Tracer, current_span
+except ImportError:  # run as a script from host/
+    from ledger import DEFAULT_LEDGER_PATH, StreamJsonParser, UsageLedger
+    from readiness import (
+        VM_NODE_CACHE_ENV,
+        VM_WARM_CLI_CMD,
+        claude_probe,
+        ssh_probe,
+        wait_until_ready,
+    )
+    from tracing import DEFAULT_TRACE_PATH, Tracer, current_span
+
+# Prompts larger than this are sent over stdin instead of the command line
+INLINE_PROMPT_LIMIT = 16 * 1024
+# Per-job scratch directories in the VM (attached context, removed after the run)
+VM_JOB_ROOT = "/tmp/cowork-jobs"
+# Printed to stderr right before claude starts, to split shell setup from CLI startup
+EXEC_MARKER = "__cowork_exec__"
+# Seconds to wait for `limactl start` to exit once the VM is ready
+LIMACTL_REAP_TIMEOUT = 60
+
+
+class JobCancelled(Exception):
+    """Raised by _run_streaming when the caller's cancel event is set."""
 
 
 @dataclass
@@ -24,6 +67,14 @@ class ExecutionResult:
     error: str = ""
     exit_code: int = 0
     duration_ms: int = 0
+    # Per-phase timings and transfer sizes (e.g. upload_ms, upload_bytes)
+    timings: dict = field(default_factory=dict)
+    # Token/cost accounting when usage tracking is enabled (see host/ledger.py)
+    usage: dict = field(default_factory=dict)
+    # Job id of an ask_claude run (also the job tag in the proxy's traffic stats)
+    job_id: str = ""
+    # Trace of the operation (see host/tracing.py); proxy records share it
+    trace_id: str = ""
 
 
 @dataclass
@@ -41,6 +92,10 @@ class SandboxConfig:
     proxy_host: str = ""
     proxy_port: int = 7890
     custom_mount: str = ""  # Format: host_path:vm_path
+    # Usage ledger (SQLite); when set, ask_claude records tokens/cost per call
+    ledger_path: str = ""
+    # Span export (OTLP/JSON lines); when set, operations are written as spans
+    trace_path: str = ""
 
     def __post_init__(self):
         """Load configuration from environment variables if not set."""
@@ -58,6 +113,34 @@ class SandboxConfig:
             self.proxy_port = int(os.environ.get("COWORK_PROXY_PORT", "7890"))
         if not self.custom_mount:
             self.custom_mount = os.environ.get("COWORK_MOUNT", "")
+        if not self.ledger_path:
+            self.ledger_path = os.environ.get("COWORK_LEDGER", "")
+        if not self.trace_path:
+            self.trace_path = os.environ.get("COWORK_TRACE_FILE", "")
+
+
+def traced(name: str):
+    """
+    Run a controller method as a span of self.tracer.
+
+    An ExecutionResult return value gets the span's trace id and sets its
+    status; a False return marks the span as failed.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name) as span:
+                result = method(self, *args, **kwargs)
+                if isinstance(result, ExecutionResult):
+                    result.trace_id = span.trace_id
+                    span.set(exit_code=result.exit_code, duration_ms=result.duration_ms)
+                    if not result.success:
+                        span.fail(result.error.strip()[-200:])
+                elif result is False:
+                    span.fail()
+                return result
+        return wrapper
+    return decorator
 
 
 class CoworkController:
@@ -70,6 +153,10 @@ class CoworkController:
         self.config = config or SandboxConfig()
         self._vm_running = None
         self._project_dir = Path(__file__).parent.parent
+        self._ledger = None
+        self.tracer = Tracer(
+            self.config.trace_path or None, resource={"cowork.vm_name": self.config.vm_name}
+        )
 
     def _generate_runtime_config(self) -> str:
         """
@@ -129,6 +216,26 @@ class CoworkController:
 
         return runtime_config
 
+    def _proxy_env(self, job_id: str, traceparent: str = "") -> str:
+        """
+        Proxy variables that tag a run's traffic with the sandbox and job.
+
+        The sandbox name and job id go in the proxy URL's userinfo, so HTTP
+        clients send them as Proxy-Authorization and the proxy can attribute
+        every request and tunnel to this run (see host/proxy_accounting.py).
+        A traceparent is appended to the password ("<job>:<traceparent>") so
+        proxy records also carry the run's trace.
+        """
+        if not self.config.proxy_host:
+            return ""
+        password = f"{job_id}:{traceparent}" if traceparent else job_id
+        userinfo = f"{quote(self.config.vm_name, safe='')}:{quote(password, safe='')}"
+        proxy_url = f"http://{userinfo}@{self.config.proxy_host}:{self.config.proxy_port}"
+        return "".join(
+            f"{name}={shlex.quote(proxy_url)} "
+            for name in ("HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy")
+        )
+
     def is_vm_running(self) -> bool:
         """Check if the sandbox VM is running."""
         if self._vm_running is not None:
@@ -159,34 +266,75 @@ class CoworkController:
         self._vm_running = False
         return False
 
-    def start_vm(self) -> bool:
-        """Start the sandbox VM if not running."""
+    @traced("start_vm")
+    def start_vm(self, deadline: int = 300) -> bool:
+        """
+        Start the sandbox VM if not running.
+
+        Returns as soon as SSH and the Claude CLI respond (probed with
+        backoff), reporting time-to-ready per probe, rather than waiting a
+        fixed time. Fails fast if `limactl start` exits with an error.
+
+        `limactl start` may still be finishing provisioning when the VM is
+        ready; it is waited on for up to LIMACTL_REAP_TIMEOUT seconds, then
+        left running in its own session (its output goes to a temp file, so
+        it does not depend on this process).
+        """
         if self.is_vm_running():
             print(f"VM '{self.config.vm_name}' is already running.")
             return True
 
         print(f"Starting VM '{self.config.vm_name}'...")
+        # limactl reports boot progress on stderr; only the tail is shown on errors
+        progress = tempfile.TemporaryFile()
         try:
-            result = subprocess.run(
+            proc = subprocess.Popen(
                 ["limactl", "start", self.config.vm_name],
-                capture_output=True,
-                text=True,
-                timeout=300,  # VM startup can take a while
+                stdout=subprocess.DEVNULL,
+                stderr=progress,
+                start_new_session=True,
             )
-            if result.returncode == 0:
-                self._vm_running = True
-                print(f"VM '{self.config.vm_name}' started successfully.")
-                return True
-            else:
-                print(f"Failed to start VM: {result.stderr}", file=sys.stderr)
-                return False
-        except subprocess.TimeoutExpired:
-            print("VM startup timed out.", file=sys.stderr)
-            return False
         except Exception as e:
+            progress.close()
             print(f"Error starting VM: {e}", file=sys.stderr)
             return False
 
+        def stderr_tail() -> str:
+            progress.seek(0)
+            lines = progress.read().decode("utf-8", errors="replace").splitlines()
+            return "\n".join(lines[-20:]).strip()
+
+        def start_failed() -> Optional[str]:
+            if proc.poll() not in (None, 0):
+                return stderr_tail() or f"limactl exited with {proc.returncode}"
+            return None
+
+        report = wait_until_ready(
+            [ssh_probe(self.config.vm_name), claude_probe(self.config.vm_name)],
+            deadline=deadline,
+            abort=start_failed,
+            on_ready=lambda name, ms: print(f"  {name} ready after {ms / 1000:.1f}s"),
+        )
+        if report.ready:
+            self._vm_running = True
+            print(f"VM '{self.config.vm_name}' started successfully in {report.total_ms / 1000:.1f}s.")
+            try:
+                proc.wait(timeout=LIMACTL_REAP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                pass  # still provisioning; it runs on in its own session
+            progress.close()
+            return True
+
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        progress.close()
+        if report.error.startswith("Timed out"):
+            print("VM startup timed out.", file=sys.stderr)
+        else:
+            print(f"Failed to start VM: {report.error}", file=sys.stderr)
+        return False
+
     def create_vm(self) -> bool:
         """
         Create the sandbox VM with runtime configuration.
@@ -272,6 +420,7 @@ class CoworkController:
             print(f"Error stopping VM: {e}", file=sys.stderr)
             return False
 
+    @traced("execute_in_vm")
     def execute_in_vm(
         self, command: str, timeout: Optional[int] = None
     ) -> ExecutionResult:
@@ -326,6 +475,210 @@ class CoworkController:
         except Exception as e:
             return ExecutionResult(success=False, output="", error=str(e))
 
+    @traced("upload_to_vm")
+    def upload_to_vm(
+        self, files: dict, dest_dir: str, timeout: Optional[int] = None
+    ) -> ExecutionResult:
+        """
+        Stream files into a VM directory as a single tar transfer over stdin.
+
+        Args:
+            files: Mapping of file name (relative to dest_dir) to a host file
+                   (Path) or in-memory content (bytes or str)
+            dest_dir: VM directory to extract into (created if not exists)
+            timeout: Optional timeout in seconds
+
+        Returns:
+            ExecutionResult with upload_bytes and upload_ms in timings
+        """
+        timeout = timeout or self.config.timeout
+        start_time = datetime.now()
+        command = f"mkdir -p {shlex.quote(dest_dir)} && tar -xf - -C {shlex.quote(dest_dir)}"
+        sent = {"bytes": 0}
+        proc = None
+
+        # Names become tar member paths; keep them inside dest_dir
+        for name in files:
+            path = PurePosixPath(name)
+            if not name or path.is_absolute() or ".." in path.parts:
+                return ExecutionResult(
+                    success=False, output="", error=f"Invalid upload file name: {name!r}"
+                )
+
+        def count(info: tarfile.TarInfo) -> tarfile.TarInfo:
+            sent["bytes"] += info.size  # directories and links are 0
+            return info
+
+        try:
+            proc = subprocess.Popen(
+                ["limactl", "shell", self.config.vm_name, "--", "bash", "-c", command],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            try:
+                # Stream mode ("w|") writes each member as it is added,
+                # so large files are never held in memory
+                with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                    for name, source in files.items():
+                        if isinstance(source, (bytes, str)):
+                            data = source.encode("utf-8") if isinstance(source, str) else source
+                            info = tarfile.TarInfo(name)
+                            info.size = len(data)
+                            info.mtime = int(time.time())
+                            tar.addfile(count(info), io.BytesIO(data))
+                        else:
+                            host_path = Path(source).expanduser()
+                            tar.add(host_path, arcname=name, filter=count)
+            except BrokenPipeError:
+                pass
+            _, stderr = proc.communicate(timeout=timeout)
+
+            duration = int((datetime.now() - start_time).total_seconds() * 1000)
+            return ExecutionResult(
+                success=proc.returncode == 0,
+                output="",
+                error=stderr.decode("utf-8", errors="replace"),
+                exit_code=proc.returncode,
+                duration_ms=duration,
+                timings={"upload_bytes": sent["bytes"], "upload_ms": duration},
+            )
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            return ExecutionResult(
+                success=False,
+                output="",
+                error=f"Upload timed out after {timeout} seconds",
+            )
+        except Exception as e:
+            # tarfile does not close an external fileobj; stop the extracting shell
+            if proc is not None and proc.poll() is None:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+                proc.kill()
+                proc.wait()
+            return ExecutionResult(success=False, output="", error=str(e))
+
+    def _prepare_attachments(self, attachments: list) -> dict:
+        """
+        Map attachments to unique file names for upload.
+
+        Each item is either a host file path or a (name, data) tuple.
+        """
+        files = {}
+        for item in attachments:
+            if isinstance(item, (tuple, list)):
+                name, source = item
+            else:
+                source = Path(item).expanduser()
+                name = source.name
+            base, ext = os.path.splitext(name)
+            index = 1
+            while name in files:
+                name = f"{base}-{index}{ext}"
+                index += 1
+            files[name] = source
+        return files
+
+    def _get_ledger(self) -> UsageLedger:
+        """Open the usage ledger on first use."""
+        if self._ledger is None:
+            self._ledger = UsageLedger(self.config.ledger_path or DEFAULT_LEDGER_PATH)
+        return self._ledger
+
+    def _run_streaming(
+        self,
+        argv: list,
+        input_text: Optional[str],
+        timeout: int,
+        env: dict,
+        on_line: Callable[[str], None],
+        cancel: Optional[threading.Event] = None,
+    ) -> tuple:
+        """
+        Run a command and hand each stdout line to on_line as it arrives.
+
+        The local process group (limactl and its ssh child) is killed on
+        timeout or when cancel is set; raises subprocess.TimeoutExpired or
+        JobCancelled respectively.
+
+        A stderr line equal to EXEC_MARKER is not returned; the monotonic
+        time it arrived is, so callers can time what happens before and
+        after that point.
+
+        Returns:
+            (returncode, stderr, exec_time)
+        """
+        proc = subprocess.Popen(
+            argv,
+            stdin=subprocess.PIPE if input_text is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            env=env,
+            start_new_session=True,  # lets a timeout kill limactl and its ssh child together
+        )
+        deadline = time.monotonic() + timeout
+        done = threading.Event()
+        stopped = {}
+
+        def watchdog():
+            while not done.wait(0.1):
+                if cancel is not None and cancel.is_set():
+                    stopped["reason"] = "cancelled"
+                elif time.monotonic() >= deadline:
+                    stopped["reason"] = "timeout"
+                else:
+                    continue
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                return
+
+        threading.Thread(target=watchdog, daemon=True).start()
+
+        # Drain stderr and feed stdin off-thread so neither pipe can block stdout
+        stderr_chunks = []
+        marks = {}
+
+        def read_stderr():
+            for line in proc.stderr:
+                if line.strip() == EXEC_MARKER:
+                    marks["exec"] = time.monotonic()
+                else:
+                    stderr_chunks.append(line)
+
+        stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+        stderr_thread.start()
+        if input_text is not None:
+            def feed_stdin():
+                try:
+                    proc.stdin.write(input_text)
+                    proc.stdin.close()
+                except (BrokenPipeError, ValueError):
+                    pass
+
+            threading.Thread(target=feed_stdin, daemon=True).start()
+
+        try:
+            for line in proc.stdout:
+                on_line(line)
+            proc.wait()
+        finally:
+            done.set()
+            stderr_thread.join()
+
+        if stopped.get("reason") == "cancelled":
+            raise JobCancelled()
+        if stopped.get("reason") == "timeout":
+            raise subprocess.TimeoutExpired(argv, timeout)
+        return proc.returncode, "".join(stderr_chunks), marks.get("exec")
+
+    @traced("ask_claude")
     def ask_claude(
         self,
         prompt: str,
@@ -337,6 +690,12 @@ class CoworkController:
         workingdir: Optional[str] = None,
         skip_permissions: bool = True,
         claude_args: Optional[list] = None,
+        attachments: Optional[list] = None,
+        prompt_delivery: str = "auto",
+        track_usage: Optional[bool] = None,
+        cancel: Optional[threading.Event] = None,
+        on_output: Optional[Callable[[], None]] = None,
+        disallowed_tools: Optional[list] = None,
     ) -> ExecutionResult:
         """
         Send a prompt to Claude Code in the VM using -p mode.
@@ -354,6 +713,22 @@ class CoworkController:
             skip_permissions: If True (default), use --dangerously-skip-permissions
             claude_args: Additional Claude CLI arguments as a list. All Claude Code
                         options are supported (e.g., ["--plan"], ["--model", "opus"])
+            attachments: Context to make available to Claude. Each item is a host
+                        file path or a (name, data) tuple. Files are streamed into
+                        the VM once and listed by path at the top of the prompt.
+            prompt_delivery: How the prompt reaches Claude: "arg" (command line),
+                        "stdin", or "auto" (stdin when larger than INLINE_PROMPT_LIMIT)
+            track_usage: Force --output-format stream-json, parse usage from the
+                        event stream and append it to the usage ledger. Defaults
+                        to True when config.ledger_path is set. Ignored when
+                        claude_args already select an output format.
+            cancel: Event that aborts the run when set. The local limactl process
+                   and the remote Claude process group are killed and the job
+                   directory is removed (used by HedgedExecutor).
+            on_output: Called once when the first output arrives from Claude
+            disallowed_tools: Tools Claude may not use (--disallowedTools). Unlike
+                        allowed_tools, which only pre-approves tools, this blocks
+                        them even with skip_permissions.
 
         Returns:
             ExecutionResult with Claude's response
@@ -384,7 +759,20 @@ class CoworkController:
                 "complex task",
                 claude_args=["--model", "opus", "--max-budget-usd", "1.0"],
             )
+
+            # With attached context (large logs are sent once, not inlined)
+            controller.ask_claude(
+                "summarize the failures in the attached log",
+                attachments=["~/build.log", ("spec.md", spec_text)],
+            )
         """
+        if prompt_delivery not in ("auto", "arg", "stdin"):
+            return ExecutionResult(
+                success=False,
+                output="",
+                error=f"Unknown prompt_delivery: {prompt_delivery}",
+            )
+
         if not self.is_vm_running():
             if not self.start_vm():
                 return ExecutionResult(
@@ -427,11 +815,43 @@ class CoworkController:
             self.execute_in_vm(f"mkdir -p {shlex.quote(project_dir)}")
             vm_working_dir = project_dir
 
-        # Escape the prompt for shell
-        escaped_prompt = shlex.quote(prompt)
+        timings = {}
+        job_id = uuid.uuid4().hex[:12]
+        job_dir = f"{VM_JOB_ROOT}/{job_id}"
+        current_span().set(job_id=job_id, project=project)
+
+        # Stream attached context into the job directory and reference it by path
+        if attachments:
+            files = self._prepare_attachments(attachments)
+            context_dir = f"{job_dir}/context"
+            upload = self.upload_to_vm(files, context_dir, timeout=timeout)
+            timings.update(upload.timings)
+            if not upload.success:
+                self.execute_in_vm(f"rm -rf {job_dir}")
+                return ExecutionResult(
+                    success=False,
+                    output="",
+                    error=f"Failed to upload attachments: {upload.error}",
+                    exit_code=upload.exit_code,
+                    timings=timings,
+                )
+            listing = "\n".join(f"- {context_dir}/{name}" for name in files)
+            prompt = f"Attached context files:\n{listing}\n\n{prompt}"
+
+        # Large prompts go over stdin to avoid command line length limits
+        prompt_bytes = len(prompt.encode("utf-8"))
+        use_stdin = prompt_delivery == "stdin" or (
+            prompt_delivery == "auto" and prompt_bytes > INLINE_PROMPT_LIMIT
+        )
+        timings["prompt_bytes"] = prompt_bytes
 
-        # Build environment variables
-        env_vars = ""
+        # The limactl shell running Claude; the VM and the proxy see it as the parent span.
+        # Started after the upload so every return path below ends it.
+        run_span = self.tracer.start("vm_shell", job_id=job_id)
+
+        # Build environment variables (the proxy URL carries the job id and trace for attribution)
+        env_vars = self._proxy_env(job_id, run_span.traceparent)
+        env_vars += f"TRACEPARENT={run_span.traceparent} "
         if self.config.anthropic_auth_token:
             env_vars += (
                 f"ANTHROPIC_AUTH_TOKEN={shlex.quote(self.config.anthropic_auth_token)} "
@@ -457,12 +877,25 @@ class CoworkController:
             cmd_parts.append("--allowedTools")
             cmd_parts.append(",".join(allowed_tools))
 
+        # "=" form: the option is variadic and would otherwise take the prompt too
+        if disallowed_tools:
+            cmd_parts.append("--disallowedTools=" + ",".join(disallowed_tools))
+
         # Add any additional Claude args (supports all Claude Code options)
         if claude_args:
             cmd_parts.extend(claude_args)
 
-        # Add prompt as last argument
-        cmd_parts.append(escaped_prompt)
+        # Usage tracking needs the stream-json event stream (which requires --verbose with -p)
+        if track_usage is None:
+            track_usage = bool(self.config.ledger_path)
+        if track_usage and any(arg.startswith("--output-format") for arg in claude_args or []):
+            track_usage = False
+        if track_usage:
+            cmd_parts.extend(["--output-format", "stream-json", "--verbose"])
+
+        # Add prompt as last argument (claude -p reads stdin when it is omitted)
+        if not use_stdin:
+            cmd_parts.append(shlex.quote(prompt))
 
         # Ensure Claude config is linked to host (for existing VMs that don't have the symlink)
         link_cmd = """
@@ -472,55 +905,155 @@ if [ -d /tmp/lima/.claude ] && [ ! -L ~/.claude ]; then
 fi
 """
 
-        # Set PATH to include npm global and local bins
+        # Set PATH to include npm global and local bins, and use the persistent
+        # per-CLI-version Node compile cache to cut CLI startup time
         path_prefix = 'export PATH="$HOME/.npm-global/bin:$HOME/.local/bin:$PATH"'
+        path_prefix = f"{path_prefix} && {VM_NODE_CACHE_ENV}"
+
+        # Mark the moment claude is launched so CLI startup is timed on its own
+        exec_marker = f"echo {EXEC_MARKER} >&2 && " if track_usage or self.tracer.enabled else ""
+
+        # Record the remote process group so a cancelled or timed out run can be
+        # killed in the VM, and remove the job directory however the run ends
+        cleanup_cmd = (
+            f"mkdir -p {job_dir} && ps -o pgid= -p $$ | tr -d ' ' > {job_dir}/pgid; "
+            f"trap 'rm -rf {job_dir}' EXIT; "
+        )
 
         # Build full command with config link check and cd ~
-        claude_cmd = f"cd ~ 2>/dev/null; {path_prefix} && {link_cmd} cd {vm_working_dir} && {env_vars}{' '.join(cmd_parts)}"
+        claude_cmd = f"{cleanup_cmd}cd ~ 2>/dev/null; {path_prefix} && {link_cmd} cd {vm_working_dir} && {exec_marker}{env_vars}{' '.join(cmd_parts)}"
+
+        argv = ["limactl", "shell", self.config.vm_name, "--", "bash", "-c", claude_cmd]
+        env = {**os.environ, **self.config.env}
+        stream_parser = StreamJsonParser() if track_usage else None
+        exec_time = None
+        output_lines = []
+        first_output = {}
+
+        def on_line(line: str):
+            if stream_parser:
+                stream_parser.feed(line)
+            else:
+                output_lines.append(line)
+            # With stream-json, output starts at the first assistant event (not init)
+            if not first_output and (not stream_parser or stream_parser.ttft_ms is not None):
+                first_output["ms"] = int((datetime.now() - start_time).total_seconds() * 1000)
+                first_output["ns"] = time.time_ns()
+                if on_output:
+                    on_output()
 
         start_time = datetime.now()
+        run_span.start_ns = time.time_ns()
+        run_started = time.monotonic()
 
         try:
-            result = subprocess.run(
-                [
-                    "limactl",
-                    "shell",
-                    self.config.vm_name,
-                    "--",
-                    "bash",
-                    "-c",
-                    claude_cmd,
-                ],
-                capture_output=True,
-                text=True,
-                timeout=timeout,
-                env={**os.environ, **self.config.env},
+            returncode, stderr, exec_time = self._run_streaming(
+                argv,
+                prompt if use_stdin else None,
+                timeout,
+                env,
+                on_line,
+                cancel=cancel,
             )
+            run_end_ns = time.time_ns()
+            output = stream_parser.output if stream_parser else "".join(output_lines)
 
             duration = int((datetime.now() - start_time).total_seconds() * 1000)
+            timings["run_ms"] = duration
 
             # Filter out Lima's cd warnings from stderr
-            stderr_lines = result.stderr.split('\n')
+            stderr_lines = stderr.split('\n')
             filtered_stderr = '\n'.join(
                 line for line in stderr_lines
                 if 'cd:' not in line or 'No such file or directory' not in line
             )
 
-            return ExecutionResult(
-                success=result.returncode == 0,
-                output=result.stdout,
+            result = ExecutionResult(
+                success=returncode == 0,
+                output=output,
                 error=filtered_stderr,
-                exit_code=result.returncode,
+                exit_code=returncode,
                 duration_ms=duration,
+                timings=timings,
             )
-        except subprocess.TimeoutExpired:
-            return ExecutionResult(
+        except (subprocess.TimeoutExpired, JobCancelled) as e:
+            run_end_ns = time.time_ns()
+            # Killing limactl does not stop Claude in the VM; kill its process group
+            self._kill_remote_job(job_dir)
+            result = ExecutionResult(
                 success=False,
                 output="",
-                error=f"Claude timed out after {timeout} seconds",
+                error=(
+                    "Claude run cancelled"
+                    if isinstance(e, JobCancelled)
+                    else f"Claude timed out after {timeout} seconds"
+                ),
+                duration_ms=int((datetime.now() - start_time).total_seconds() * 1000),
+                timings=timings,
             )
         except Exception as e:
-            return ExecutionResult(success=False, output="", error=str(e))
+            result = ExecutionResult(success=False, output="", error=str(e))
+            self._end_run_span(run_span, run_started, time.time_ns(), exec_time, first_output, result)
+            return result
+
+        self._end_run_span(run_span, run_started, run_end_ns, exec_time, first_output, result)
+        result.job_id = job_id
+        if "ms" in first_output:
+            timings["first_output_ms"] = first_output["ms"]
+
+        if stream_parser:
+            # exec_ms: SSH + shell setup; cli_startup_ms: claude launch to first event
+            if exec_time is not None:
+                exec_ms = int((exec_time - stream_parser.start_time) * 1000)
+                timings["exec_ms"] = exec_ms
+                if stream_parser.first_event_ms is not None:
+                    timings["cli_startup_ms"] = stream_parser.first_event_ms - exec_ms
+            timings["ttft_ms"] = stream_parser.ttft_ms
+            record = stream_parser.to_record(
+                job_id,
+                vm_name=self.config.vm_name,
+                project=project or os.path.basename(vm_working_dir.rstrip("/")),
+                success=result.success and not stream_parser.is_error,
+                exit_code=result.exit_code,
+                duration_ms=result.duration_ms,
+            )
+            result.usage = asdict(record)
+            try:
+                self._get_ledger().append(record)
+            except Exception as e:
+                print(f"Error writing usage ledger: {e}", file=sys.stderr)
+
+        return result
+
+    def _end_run_span(
+        self, span, started: float, end_ns: int, exec_time: Optional[float], first_output: dict, result
+    ):
+        """
+        Finish the vm_shell span of an ask_claude run.
+
+        When the exec marker was seen the span is split into shell_setup
+        (SSH and shell) and claude (the CLI process) child spans.
+        """
+        if exec_time is not None:
+            exec_ns = span.start_ns + int((exec_time - started) * 1e9)
+            self.tracer.record("shell_setup", span, span.start_ns, exec_ns)
+            self.tracer.record("claude", span, exec_ns, end_ns)
+        if "ns" in first_output:
+            span.add_event("first_output", first_output["ns"])
+        span.set(exit_code=result.exit_code)
+        if not result.success:
+            span.fail(result.error.strip()[-200:])
+        self.tracer.end(span, end_ns)
+
+    @traced("kill_remote_job")
+    def _kill_remote_job(self, job_dir: str):
+        """Terminate a job's process group in the VM and remove its job directory."""
+        self.execute_in_vm(
+            f"pgid=$(cat {job_dir}/pgid 2>/dev/null); "
+            f'if [ -n "$pgid" ]; then kill -TERM -- -"$pgid" 2>/dev/null; sleep 1; '
+            f'kill -KILL -- -"$pgid" 2>/dev/null; fi; rm -rf {job_dir}; true',
+            timeout=30,
+        )
 
     def read_file(self, path: str) -> ExecutionResult:
         """Read a file from the VM."""
@@ -537,6 +1070,26 @@ fi
             path = self.config.working_dir
         return self.execute_in_vm(f"ls -la {shlex.quote(path)}")
 
+    def warm_cli(self) -> ExecutionResult:
+        """
+        Warm the VM's Node compile cache with a throwaway `claude --version`.
+
+        Caches of other CLI versions are removed, so the cache stays valid
+        across CLI upgrades. VMs also warm the cache at boot (sandbox.yaml).
+
+        Returns:
+            ExecutionResult with the in-VM run time as timings["cli_startup_ms"]
+        """
+        result = self.execute_in_vm(
+            f"start=$(date +%s%N); {VM_WARM_CLI_CMD}; rc=$?; "
+            f'echo "cli_startup_ms=$(( ($(date +%s%N) - start) / 1000000 ))"; exit $rc'
+        )
+        lines = result.output.strip().splitlines()
+        if lines and lines[-1].startswith("cli_startup_ms="):
+            result.timings["cli_startup_ms"] = int(lines[-1].split("=", 1)[1])
+            result.output = "\n".join(lines[:-1]) + "\n"
+        return result
+
     def get_vm_info(self) -> dict:
         """Get information about the VM."""
         info = {
@@ -566,7 +1119,9 @@ def main():
     parser = argparse.ArgumentParser(
         description="Cowork Sandbox Controller - Communicate with Claude Code in VM"
     )
-    parser.add_argument("prompt", nargs="?", help="Prompt to send to Claude Code")
+    parser.add_argument(
+        "prompt", nargs="?", help="Prompt to send to Claude Code ('-' reads from stdin)"
+    )
     parser.add_argument(
         "--vm-name", help="Name of the Lima VM (default: $COWORK_VM_NAME or sandbox)"
     )
@@ -590,6 +1145,11 @@ def main():
     parser.add_argument("--start", action="store_true", help="Start the VM")
     parser.add_argument("--stop", action="store_true", help="Stop the VM")
     parser.add_argument("--status", action="store_true", help="Show VM status and info")
+    parser.add_argument(
+        "--warm-cli",
+        action="store_true",
+        help="Warm the Claude CLI compile cache in the VM and report startup time",
+    )
     parser.add_argument(
         "--exec",
         "-e",
@@ -623,6 +1183,22 @@ def main():
         default=True,
         help="Don't auto-add --dangerously-skip-permissions (default: add it)",
     )
+    parser.add_argument(
+        "--attach",
+        action="append",
+        metavar="FILE",
+        help="Attach a host file as context (can be repeated)",
+    )
+    parser.add_argument(
+        "--track-usage",
+        action="store_true",
+        help="Record tokens, cost and latency in the usage ledger ($COWORK_LEDGER)",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help=f"Export spans to $COWORK_TRACE_FILE (default: {DEFAULT_TRACE_PATH})",
+    )
     # Runtime configuration options
     parser.add_argument(
         "--proxy",
@@ -654,6 +1230,7 @@ def main():
         proxy_host=proxy_host,
         proxy_port=proxy_port,
         custom_mount=args.mount or "",
+        trace_path=(os.environ.get("COWORK_TRACE_FILE") or DEFAULT_TRACE_PATH) if args.trace else "",
     )
 
     controller = CoworkController(config)
@@ -671,6 +1248,15 @@ def main():
         success = controller.stop_vm()
         sys.exit(0 if success else 1)
 
+    if args.warm_cli:
+        result = controller.warm_cli()
+        if result.success:
+            print(f"Claude CLI warmed: {result.output.strip()} "
+                  f"({result.timings.get('cli_startup_ms', result.duration_ms)}ms)")
+        else:
+            print(result.error, file=sys.stderr, end="")
+        sys.exit(result.exit_code)
+
     if args.status:
         info = controller.get_vm_info()
         if args.json:
@@ -707,12 +1293,15 @@ def main():
         sys.exit(result.exit_code)
 
     if args.prompt:
+        prompt = sys.stdin.read() if args.prompt == "-" else args.prompt
         result = controller.ask_claude(
-            args.prompt,
+            prompt,
             continue_conversation=args.continue_conversation,
             project=args.project,
             workingdir=args.workingdir,
             skip_permissions=args.skip_permissions,
+            attachments=args.attach,
+            track_usage=args.track_usage or None,
         )
         if args.json:
             print(
@@ -723,6 +1312,10 @@ def main():
                         "error": result.error,
                         "exit_code": result.exit_code,
                         "duration_ms": result.duration_ms,
+                        "timings": result.timings,
+                        "usage": result.usage,
+                        "job_id": result.job_id,
+                        "trace_id": result.trace_id,
                     },
                     indent=2,
                 )
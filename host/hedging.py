@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Cowork Hedged Requests
+Tail-latency mitigation for ask_claude across several sandbox VMs: when a
+read-only job has produced no output after a high percentile of historical
+first-output latency, a duplicate is launched on another VM, the first result
+wins and the other run is cancelled (including its processes in the VM).
+"""
+
+import contextvars
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+try:
+    from host.controller import CoworkController, ExecutionResult, traced
+    from host.ledger import UsageLedger
+    from host.tracing import current_span
+except ImportError:  # run as a script from host/
+    from controller import CoworkController, ExecutionResult, traced
+    from ledger import UsageLedger
+    from tracing import current_span
+
+# Tools allowed for hedged jobs unless the caller passes allowed_tools; running
+# a job twice is only safe when neither copy can modify anything
+READ_ONLY_TOOLS = ["Read", "Grep", "Glob", "LS"]
+# Tools blocked for read-only jobs. --allowedTools only pre-approves tools, and
+# jobs run with --dangerously-skip-permissions, so these must be disallowed
+MUTATING_TOOLS = ["Bash", "Edit", "MultiEdit", "Write", "NotebookEdit", "Task"]
+
+
+@dataclass
+class HedgePolicy:
+    """When to launch a hedge."""
+
+    enabled: bool = False  # hedging is opt-in
+    percentile: float = 95.0  # hedge after this percentile of first-output latency
+    min_samples: int = 20  # below this, use default_delay_ms
+    default_delay_ms: int = 30000
+    min_delay_ms: int = 1000
+    history_size: int = 200  # samples kept per project
+
+
+def _percentile(samples, pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class HedgedExecutor:
+    """
+    Run ask_claude on a pool of controllers (one per VM) with hedging.
+
+    Jobs are only hedged when read_only=True; other jobs run once on the least
+    busy VM. Losing runs are cancelled in the background so the winner is
+    returned as soon as it finishes.
+
+    Example:
+        executor = HedgedExecutor(
+            [CoworkController(SandboxConfig(vm_name=n)) for n in ("sandbox", "sandbox2")],
+            HedgePolicy(enabled=True),
+        )
+        result = executor.ask_claude("summarize README.md", project="app", read_only=True)
+        print(executor.stats())
+    """
+
+    def __init__(
+        self,
+        controllers: List[CoworkController],
+        policy: Optional[HedgePolicy] = None,
+        ledger: Optional[UsageLedger] = None,
+    ):
+        if not controllers:
+            raise ValueError("HedgedExecutor needs at least one controller")
+        self.controllers = controllers
+        self.policy = policy or HedgePolicy()
+        self.ledger = ledger
+        # A hedged job is one trace; each attempt's ask_claude is a child span
+        self.tracer = controllers[0].tracer
+        self._lock = threading.Lock()
+        self._active: Dict[str, int] = defaultdict(int)  # vm_name -> running jobs
+        self._history: Dict[str, Deque[int]] = {}  # project -> first-output samples
+        self._cleanup_threads: List[threading.Thread] = []
+        self._jobs = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+        self._latencies: Deque[int] = deque(maxlen=1000)  # delivered duration_ms
+
+    def _samples(self, key: str) -> Deque[int]:
+        with self._lock:
+            samples = self._history.get(key)
+            if samples is None:
+                samples = deque(maxlen=self.policy.history_size)
+                if self.ledger is not None:
+                    # Seed from the ledger (oldest first) so a fresh process has a baseline
+                    seeded = self.ledger.latency_samples(key or None, self.policy.history_size)
+                    samples.extend(reversed(seeded))
+                self._history[key] = samples
+            return samples
+
+    def hedge_delay_ms(self, key: str = "") -> int:
+        """Milliseconds without output after which a job for key is hedged."""
+        samples = self._samples(key)
+        with self._lock:
+            if len(samples) < self.policy.min_samples:
+                return self.policy.default_delay_ms
+            delay = _percentile(samples, self.policy.percentile)
+        return max(self.policy.min_delay_ms, int(delay))
+
+    def _pick(self, exclude: Optional[CoworkController] = None) -> Optional[CoworkController]:
+        """Least busy running controller, skipping exclude."""
+        with self._lock:
+            candidates = [c for c in self.controllers if c is not exclude]
+            candidates.sort(key=lambda c: self._active[c.config.vm_name])
+        for controller in candidates:
+            if controller.is_vm_running():
+                return controller
+        return None
+
+    @traced("hedged_ask_claude")
+    def ask_claude(self, prompt: str, read_only: bool = False, **kwargs) -> ExecutionResult:
+        """
+        Run ask_claude, hedging read-only jobs onto a second VM when slow.
+
+        Args:
+            prompt: The prompt to send to Claude
+            read_only: The job does not modify anything, so running it twice is
+                       safe. Restricts tools to READ_ONLY_TOOLS unless
+                       allowed_tools is given, and disallows MUTATING_TOOLS.
+            **kwargs: Passed to CoworkController.ask_claude
+
+        Raises:
+            ValueError: read_only with allowed_tools that include a mutating tool
+
+        Returns:
+            The first successful ExecutionResult (or the last failure).
+            timings gains "hedged" and "winner" (VM name).
+        """
+        key = kwargs.get("project") or kwargs.get("workingdir") or ""
+        hedge = self.policy.enabled and read_only and len(self.controllers) > 1
+        if read_only:
+            allowed = kwargs.get("allowed_tools")
+            if allowed is None:
+                kwargs["allowed_tools"] = READ_ONLY_TOOLS
+            else:
+                mutating = [t for t in allowed if t.split("(")[0] in MUTATING_TOOLS]
+                if mutating:
+                    raise ValueError(
+                        f"read_only job allows mutating tools: {', '.join(mutating)}"
+                    )
+            kwargs["disallowed_tools"] = sorted(
+                set(MUTATING_TOOLS) | set(kwargs.get("disallowed_tools") or [])
+            )
+
+        primary = self._pick()
+        if primary is None:
+            return ExecutionResult(success=False, output="", error="No running VM available")
+
+        done = threading.Condition()
+        results = []  # (controller, result) in completion order
+        attempts = []  # (controller, cancel event, thread)
+        first_output = threading.Event()
+
+        def run(controller: CoworkController, cancel: threading.Event):
+            with self._lock:
+                self._active[controller.config.vm_name] += 1
+            try:
+                result = controller.ask_claude(
+                    prompt, cancel=cancel, on_output=first_output.set, **kwargs
+                )
+            except Exception as e:
+                result = ExecutionResult(success=False, output="", error=str(e))
+            finally:
+                with self._lock:
+                    self._active[controller.config.vm_name] -= 1
+            with done:
+                results.append((controller, result))
+                done.notify_all()
+
+        def launch(controller: CoworkController):
+            cancel = threading.Event()
+            # Run in a copy of this context so the attempt's spans join the current trace
+            context = contextvars.copy_context()
+            thread = threading.Thread(
+                target=context.run, args=(run, controller, cancel), daemon=True
+            )
+            attempts.append((controller, cancel, thread))
+            thread.start()
+
+        start = time.monotonic()
+        launch(primary)
+        hedged = False
+
+        if hedge:
+            delay = self.hedge_delay_ms(key) / 1000
+            # Wait for first output, completion or the hedge delay, whichever is first
+            while not first_output.is_set() and time.monotonic() - start < delay:
+                with done:
+                    if results:
+                        break
+                    done.wait(min(0.1, delay))
+            with done:
+                finished = bool(results)
+            if not first_output.is_set() and not finished:
+                backup = self._pick(exclude=primary)
+                if backup is not None:
+                    hedged = True
+                    launch(backup)
+
+        # First success wins; otherwise wait for every attempt and return the last failure
+        with done:
+            while True:
+                winner = next(((c, r) for c, r in results if r.success), None)
+                if winner or len(results) == len(attempts):
+                    break
+                done.wait()
+            controller, result = winner or results[-1]
+
+        for other, cancel, thread in attempts:
+            if other is not controller:
+                cancel.set()
+                with self._lock:
+                    self._cleanup_threads.append(thread)
+
+        first_ms = result.timings.get("first_output_ms")
+        samples = self._samples(key)
+        with self._lock:
+            self._jobs += 1
+            if hedged:
+                self._hedged += 1
+                if controller is not primary:
+                    self._hedge_wins += 1
+            self._latencies.append(int((time.monotonic() - start) * 1000))
+            # Only unhedged primaries feed the history, so hedging does not bias it
+            if first_ms is not None and controller is primary and not hedged:
+                samples.append(first_ms)
+
+        result.timings["hedged"] = hedged
+        result.timings["winner"] = controller.config.vm_name
+        current_span().set(hedged=hedged, winner=controller.config.vm_name)
+        return result
+
+    def stats(self) -> dict:
+        """Hedge rate and delivered latency percentiles."""
+        with self._lock:
+            latencies = list(self._latencies)
+            history = [ms for samples in self._history.values() for ms in samples]
+            return {
+                "jobs": self._jobs,
+                "hedged": self._hedged,
+                "hedge_rate": self._hedged / self._jobs if self._jobs else 0.0,
+                "hedge_wins": self._hedge_wins,
+                "p50_ms": _percentile(latencies, 50),
+                "p99_ms": _percentile(latencies, 99),
+                # First-output latency of unhedged runs, the tail hedging cuts off
+                "baseline_first_output_p99_ms": _percentile(history, 99),
+            }
+
+    def shutdown(self, timeout: Optional[float] = None):
+        """Wait for cancelled runs to finish their remote cleanup."""
+        with self._lock:
+            threads, self._cleanup_threads = self._cleanup_threads, []
+        for thread in threads:
+            thread.join(timeout)
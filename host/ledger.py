@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Cowork Usage Ledger
+Per-call token, cost and latency accounting for ask_claude, parsed from
+Claude Code's stream-json output and stored in a local append-only SQLite file.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import List, Optional
+
+DEFAULT_LEDGER_PATH = "~/.cowork/usage.db"
+
+
+@dataclass
+class UsageRecord:
+    """Accounting record for one Claude Code run."""
+
+    job_id: str
+    timestamp: float
+    vm_name: str = ""
+    project: str = ""
+    model: str = ""
+    session_id: str = ""
+    success: bool = False
+    exit_code: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_creation_tokens: int = 0
+    cost_usd: float = 0.0
+    num_turns: int = 0
+    tool_calls: int = 0
+    ttft_ms: Optional[int] = None  # time to first assistant output
+    api_duration_ms: int = 0
+    duration_ms: int = 0
+
+
+class StreamJsonParser:
+    """
+    Incremental parser for `claude -p --output-format stream-json` events.
+
+    Feed stdout lines as they arrive; usage, tool calls and first-token time
+    are accumulated without buffering the whole stream.
+    """
+
+    def __init__(self, start_time: Optional[float] = None):
+        self.start_time = start_time or time.monotonic()
+        self.model = ""
+        self.session_id = ""
+        self.result_text: Optional[str] = None
+        self.is_error = False
+        self.num_turns = 0
+        self.tool_calls = 0
+        self.cost_usd = 0.0
+        self.api_duration_ms = 0
+        self.usage = {}
+        self.first_event_ms: Optional[int] = None
+        self.ttft_ms: Optional[int] = None
+        self.raw_lines: List[str] = []
+
+    def _elapsed_ms(self) -> int:
+        return int((time.monotonic() - self.start_time) * 1000)
+
+    def feed(self, line: str):
+        """Consume one line of stream-json output."""
+        line = line.strip()
+        if not line:
+            return
+        try:
+            event = json.loads(line)
+        except ValueError:
+            # Not an event (e.g. a warning printed by a wrapper); keep it
+            self.raw_lines.append(line)
+            return
+        if not isinstance(event, dict):
+            return
+
+        if self.first_event_ms is None:
+            self.first_event_ms = self._elapsed_ms()
+
+        event_type = event.get("type")
+        if event_type == "system" and event.get("subtype") == "init":
+            self.model = event.get("model", self.model)
+            self.session_id = event.get("session_id", self.session_id)
+        elif event_type == "assistant":
+            if self.ttft_ms is None:
+                self.ttft_ms = self._elapsed_ms()
+            message = event.get("message") or {}
+            for block in message.get("content") or []:
+                if isinstance(block, dict) and block.get("type") == "tool_use":
+                    self.tool_calls += 1
+        elif event_type == "result":
+            self.result_text = event.get("result")
+            self.is_error = bool(event.get("is_error"))
+            self.num_turns = event.get("num_turns", 0) or 0
+            self.cost_usd = event.get("total_cost_usd", event.get("cost_usd", 0.0)) or 0.0
+            self.api_duration_ms = event.get("duration_api_ms", 0) or 0
+            self.usage = event.get("usage") or {}
+            self.session_id = event.get("session_id", self.session_id)
+
+    @property
+    def output(self) -> str:
+        """Final result text, falling back to any non-event output."""
+        if self.result_text is not None:
+            return self.result_text
+        return "\n".join(self.raw_lines)
+
+    def to_record(self, job_id: str, **extra) -> UsageRecord:
+        """Build a UsageRecord from the parsed stream."""
+        return UsageRecord(
+            job_id=job_id,
+            timestamp=time.time(),
+            model=self.model,
+            session_id=self.session_id,
+            input_tokens=self.usage.get("input_tokens", 0) or 0,
+            output_tokens=self.usage.get("output_tokens", 0) or 0,
+            cache_read_tokens=self.usage.get("cache_read_input_tokens", 0) or 0,
+            cache_creation_tokens=self.usage.get("cache_creation_input_tokens", 0) or 0,
+            cost_usd=self.cost_usd,
+            num_turns=self.num_turns,
+            tool_calls=self.tool_calls,
+            ttft_ms=self.ttft_ms,
+            api_duration_ms=self.api_duration_ms,
+            **extra,
+        )
+
+
+class UsageLedger:
+    """Append-only SQLite ledger of UsageRecords with aggregate queries."""
+
+    GROUP_COLUMNS = {
+        "project": "project",
+        "model": "model",
+        "vm": "vm_name",
+        "day": "date(timestamp, 'unixepoch', 'localtime')",
+    }
+
+    def __init__(self, path: str = DEFAULT_LEDGER_PATH):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(
+            f"{f.name} {self._sql_type(f.type)}" for f in fields(UsageRecord)
+        )
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS usage ({columns})")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS usage_timestamp ON usage (timestamp)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _sql_type(py_type) -> str:
+        name = py_type.__name__ if isinstance(py_type, type) else str(py_type)
+        if "float" in name:
+            return "REAL"
+        if "int" in name or "bool" in name:
+            return "INTEGER"
+        return "TEXT"
+
+    def append(self, record: UsageRecord):
+        """Append a record (records are never updated or deleted)."""
+        data = asdict(record)
+        placeholders = ", ".join("?" for _ in data)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO usage ({', '.join(data)}) VALUES ({placeholders})",
+                list(data.values()),
+            )
+            self._conn.commit()
+
+    def recent(self, limit: int = 20) -> List[dict]:
+        """Most recent records, newest first."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT * FROM usage ORDER BY timestamp DESC LIMIT ?", (limit,)
+            )
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def latency_samples(self, project: Optional[str] = None, limit: int = 200) -> List[int]:
+        """Recent successful time-to-first-token samples (ms), optionally per project."""
+        query = "SELECT ttft_ms FROM usage WHERE success = 1 AND ttft_ms IS NOT NULL"
+        params: list = []
+        if project:
+            query += " AND project = ?"
+            params.append(project)
+        query += " ORDER BY timestamp DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            return [row[0] for row in self._conn.execute(query, params).fetchall()]
+
+    def aggregate(self, by: str = "project", since: Optional[float] = None) -> List[dict]:
+        """
+        Aggregate usage grouped by project, model, vm or day.
+
+        Args:
+            by: One of "project", "model", "vm", "day"
+            since: Only include records at or after this Unix timestamp
+
+        Returns:
+            One dict per group, most expensive first
+        """
+        if by not in self.GROUP_COLUMNS:
+            raise ValueError(f"Unknown group: {by} (use one of {', '.join(self.GROUP_COLUMNS)})")
+        key = self.GROUP_COLUMNS[by]
+        query = f"""
+            SELECT {key} AS key,
+                   COUNT(*) AS calls,
+                   SUM(success = 0) AS failures,
+                   SUM(input_tokens) AS input_tokens,
+                   SUM(output_tokens) AS output_tokens,
+                   SUM(cache_read_tokens) AS cache_read_tokens,
+                   ROUND(SUM(cost_usd), 6) AS cost_usd,
+                   SUM(tool_calls) AS tool_calls,
+                   CAST(AVG(ttft_ms) AS INTEGER) AS avg_ttft_ms,
+                   CAST(AVG(duration_ms) AS INTEGER) AS avg_duration_ms,
+                   MAX(duration_ms) AS max_duration_ms
+            FROM usage
+            WHERE timestamp >= ?
+            GROUP BY key
+            ORDER BY cost_usd DESC, avg_duration_ms DESC
+        """
+        with self._lock:
+            cursor = self._conn.execute(query, (since or 0,))
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def main():
+    """CLI entry point."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cowork Usage Ledger - query ask_claude accounting")
+    parser.add_argument(
+        "--db",
+        default=os.environ.get("COWORK_LEDGER", DEFAULT_LEDGER_PATH),
+        help=f"Ledger database (default: $COWORK_LEDGER or {DEFAULT_LEDGER_PATH})",
+    )
+    parser.add_argument("--json", action="store_true", help="Output in JSON format")
+    sub = parser.add_subparsers(dest="command")
+    summary = sub.add_parser("summary", help="Aggregate usage")
+    summary.add_argument("--by", choices=list(UsageLedger.GROUP_COLUMNS), default="project")
+    summary.add_argument("--days", type=float, help="Only include the last N days")
+    recent = sub.add_parser("recent", help="Show recent calls")
+    recent.add_argument("-n", type=int, default=20, help="Number of records (default: 20)")
+
+    args = parser.parse_args()
+    ledger = UsageLedger(args.db)
+
+    if args.command == "recent":
+        rows = ledger.recent(args.n)
+    elif args.command == "summary":
+        since = time.time() - args.days * 86400 if args.days else None
+        rows = ledger.aggregate(by=args.by, since=since)
+    else:
+        parser.print_help()
+        return
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    if not rows:
+        print("No records")
+        return
+    headers = list(rows[0])
+    print("\t".join(headers))
+    for row in rows:
+        print("\t".join("" if row[h] is None else str(row[h]) for h in headers))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,18 +8,49 @@ Cowork Sandbox 日志系统
 - 结构化日志（JSON）
 - 日志级别控制
 - 日志归档
+
+info(msg, **fields) 等方法的字段不会提前拼接成字符串：级别未启用时直接返回，
+不做任何格式化；启用时字段随日志记录传给各 handler，文本格式在输出时才拼成
+"msg | k=v"，JSON 格式把字段作为独立的键输出，可以直接查询。
+
+文件日志按大小（max_bytes）和时间（rotate_seconds）轮转，轮转出的段在后台线程中
+用 gzip 压缩，按保留天数、总磁盘预算和段数清理；旁边的 <文件>.index.json 记录
+每个段的起止时间，read_log() 按时间范围读取时只打开相关的段。
+
+async_mode 下调用方只把日志记录放入有界队列，由一个后台线程格式化并按
+handler 批量写入（每批一次写入和轮转检查），控制台和文件写入不会阻塞
+控制器的请求路径。
+
+在控制器的 span 中（见 host/tracing.py）记录的日志带有 trace_id / span_id，
+JSON 格式中可以按 trace 与代理记录关联。
 """
 
 import os
 import sys
 import json
+import gzip
+import time
+import atexit
+import queue
+import shutil
 import logging
 import logging.handlers
+import threading
 from pathlib import Path
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 from dataclasses import dataclass, asdict
 
+try:
+    import orjson  # 可选，JSON 日志序列化更快
+except ImportError:
+    orjson = None
+
+try:
+    from host.tracing import current_span
+except ImportError:  # 作为脚本从 host/ 运行
+    from tracing import current_span
+
 
 @dataclass
 class LogConfig:
@@ -28,8 +59,58 @@ class LogConfig:
     console_level: str = "INFO"
     file_level: str = "DEBUG"
     max_bytes: int = 10 * 1024 * 1024  # 10MB
-    backup_count: int = 5
+    rotate_seconds: int = 24 * 3600  # 按时间轮转的间隔，0 为只按大小轮转
+    compress: bool = True  # 在后台用 gzip 压缩轮转出的段
+    retention_days: float = 30  # 归档段的保留天数，0 为不按时间清理
+    max_total_bytes: int = 200 * 1024 * 1024  # 每个日志文件（含归档段）的磁盘预算，0 为不限制
+    backup_count: int = 0  # 最多保留的归档段数，0 为只按保留天数和磁盘预算清理
     json_format: bool = False
+    async_mode: bool = False
+    queue_size: int = 10000
+    overflow: str = "drop"  # 队列满时：drop 丢弃新记录（ERROR 及以上除外），block 等待空位
+
+
+class LogMessage:
+    """
+    延迟格式化的日志消息
+
+    作为 LogRecord.msg 传给 logging，只有 handler 真正输出时才调用 __str__
+    （结果缓存，多个 handler 只拼接一次）。
+
+    Args:
+        msg: 消息；有 args 时为 % 格式模板
+        args: 模板参数
+        fields: 附加字段，文本格式中以 " | k=v" 追加在消息后
+        context: 已经写在消息中的字段，只出现在 JSON 输出中
+    """
+
+    __slots__ = ('msg', 'args', 'fields', 'context', '_text')
+
+    def __init__(
+        self,
+        msg: str,
+        fields: Dict[str, Any],
+        args: Tuple = (),
+        context: Optional[Dict[str, Any]] = None,
+    ):
+        self.msg = msg
+        self.args = args
+        self.fields = fields
+        self.context = context
+        self._text = None
+
+    @property
+    def message(self) -> str:
+        """不含附加字段的消息"""
+        return self.msg % self.args if self.args else self.msg
+
+    def __str__(self) -> str:
+        if self._text is None:
+            text = self.message
+            if self.fields:
+                text += " | " + " | ".join(f"{k}={v}" for k, v in self.fields.items())
+            self._text = text
+        return self._text
 
 
 class CoworkLogger:
@@ -53,6 +134,17 @@ class CoworkLogger:
         if self.config.json_format:
             self._setup_json_handler()
 
+        # logger 的级别取各 handler 中最低的，所有 handler 都不输出的级别在
+        # isEnabledFor 处就返回
+        self.logger.setLevel(min(h.level for h in self.logger.handlers))
+
+        self.pipeline: Optional[LogPipeline] = None
+        if self.config.async_mode:
+            self.pipeline = LogPipeline(
+                self.logger.handlers, self.config.queue_size, self.config.overflow
+            )
+            self.logger.handlers = [self.pipeline]
+
     def _setup_console_handler(self):
         """设置控制台处理器"""
         console_handler = logging.StreamHandler(sys.stdout)
@@ -67,81 +159,124 @@ class CoworkLogger:
         self.logger.addHandler(console_handler)
 
     def _setup_file_handler(self):
-        """设置文件处理器（带日志轮转）"""
+        """设置文件处理器（带日志轮转和归档）"""
         log_file = self.log_dir / f"{self.name}.log"
 
-        file_handler = logging.handlers.RotatingFileHandler(
-            log_file,
-            maxBytes=self.config.max_bytes,
-            backupCount=self.config.backup_count,
-            encoding='utf-8'
-        )
+        file_handler = self._archiving_handler(log_file)
         file_handler.setLevel(getattr(logging, self.config.file_level))
 
         file_format = logging.Formatter(
             '%(asctime)s [%(levelname)s] %(name)s - %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
+            datefmt=_TEXT_TIME_FORMAT
         )
         file_handler.setFormatter(file_format)
         self.logger.addHandler(file_handler)
 
+    def _archiving_handler(self, path: Path) -> 'ArchivingFileHandler':
+        return ArchivingFileHandler(
+            path,
+            max_bytes=self.config.max_bytes,
+            rotate_seconds=self.config.rotate_seconds,
+            compress=self.config.compress,
+            retention_days=self.config.retention_days,
+            max_total_bytes=self.config.max_total_bytes,
+            backup_count=self.config.backup_count,
+        )
+
     def _setup_json_handler(self):
         """设置 JSON 格式处理器"""
         json_file = self.log_dir / f"{self.name}.json.log"
 
-        json_handler = logging.handlers.RotatingFileHandler(
-            json_file,
-            maxBytes=self.config.max_bytes,
-            backupCount=self.config.backup_count,
-            encoding='utf-8'
-        )
+        json_handler = self._archiving_handler(json_file)
         json_handler.setLevel(logging.DEBUG)
         json_handler.setFormatter(JsonFormatter())
         self.logger.addHandler(json_handler)
 
     def debug(self, msg: str, **kwargs):
         """调试日志"""
-        self._log(logging.DEBUG, msg, kwargs)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, msg, kwargs)
 
     def info(self, msg: str, **kwargs):
         """信息日志"""
-        self._log(logging.INFO, msg, kwargs)
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, msg, kwargs)
 
     def warning(self, msg: str, **kwargs):
         """警告日志"""
-        self._log(logging.WARNING, msg, kwargs)
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, msg, kwargs)
 
     def error(self, msg: str, **kwargs):
         """错误日志"""
-        self._log(logging.ERROR, msg, kwargs)
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, msg, kwargs)
 
     def critical(self, msg: str, **kwargs):
         """严重错误日志"""
-        self._log(logging.CRITICAL, msg, kwargs)
+        if self.logger.isEnabledFor(logging.CRITICAL):
+            self._log(logging.CRITICAL, msg, kwargs)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待队列中的日志写完（同步模式下立即返回 True）"""
+        if self.pipeline is not None:
+            return self.pipeline.flush(timeout)
+        return True
+
+    def close(self):
+        """写完队列中的日志并关闭所有 handler"""
+        if self.pipeline is not None:
+            self.pipeline.close()
+        else:
+            for handler in self.logger.handlers:
+                handler.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """异步队列的计数（queued / written / dropped / pending / max_pending）"""
+        if self.pipeline is None:
+            return {"async": False}
+        return {"async": True, **self.pipeline.stats()}
+
+    def is_enabled_for(self, level: int) -> bool:
+        """该级别的日志是否会被任何 handler 输出（可在准备昂贵的字段前检查）"""
+        return self.logger.isEnabledFor(level)
 
     def _log(self, level: int, msg: str, extra: Dict[str, Any]):
-        """内部日志方法"""
-        if extra:
-            # 将额外信息附加到消息
-            extra_str = " | ".join(f"{k}={v}" for k, v in extra.items())
-            msg = f"{msg} | {extra_str}"
-        self.logger.log(level, msg)
+        """内部日志方法（调用前已检查级别）"""
+        # stacklevel=3：记录中的模块、函数和行号为调用 info() 等方法的位置
+        self.logger.log(
+            level, LogMessage(msg, extra) if extra else msg,
+            extra=_trace_context(), stacklevel=3,
+        )
 
     def log_operation(self, operation: str, status: str, **details):
         """记录操作日志"""
-        msg = f"Operation: {operation} | Status: {status}"
-        if details:
-            detail_str = " | ".join(f"{k}={v}" for k, v in details.items())
-            msg += f" | {detail_str}"
-        self.info(msg)
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        message = LogMessage(
+            "Operation: %s | Status: %s", details, (operation, status),
+            {'operation': operation, 'status': status},
+        )
+        self.logger.log(logging.INFO, message, extra=_trace_context(), stacklevel=2)
 
     def log_error(self, operation: str, error: Exception, **context):
         """记录错误日志"""
-        msg = f"Operation: {operation} | Error: {type(error).__name__}: {error}"
-        if context:
-            context_str = " | ".join(f"{k}={v}" for k, v in context.items())
-            msg += f" | {context_str}"
-        self.error(msg)
+        if not self.logger.isEnabledFor(logging.ERROR):
+            return
+        error_type = type(error).__name__
+        message = LogMessage(
+            "Operation: %s | Error: %s: %s", context, (operation, error_type, error),
+            {'operation': operation, 'error_type': error_type, 'error': str(error)},
+        )
+        self.logger.log(logging.ERROR, message, extra=_trace_context(), stacklevel=2)
+
+
+def _trace_context() -> Optional[Dict[str, str]]:
+    """当前 span 的编号（在调用方线程取得，异步写入时上下文已不存在）"""
+    span = current_span()
+    if span is None:
+        return None
+    return {'trace_id': span.trace_id, 'span_id': span.span_id}
 
 
 class ColoredFormatter(logging.Formatter):
@@ -169,24 +304,540 @@ class ColoredFormatter(logging.Formatter):
         return result
 
 
+# 标准库 json 的回退编码器（预先创建，避免 json.dumps 每次带参数调用时新建编码器）
+_json_encoder = json.JSONEncoder(ensure_ascii=False, default=str)
+
+
+def dumps_json(data: Dict[str, Any]) -> str:
+    """序列化一条 JSON 日志（有 orjson 时使用 orjson，无法序列化的值转为字符串）"""
+    if orjson is not None:
+        return orjson.dumps(data, default=str).decode('utf-8')
+    return _json_encoder.encode(data)
+
+
 class JsonFormatter(logging.Formatter):
-    """JSON 格式化器"""
+    """
+    JSON 格式化器
+
+    LogMessage 的字段作为顶层键输出；与固定键（timestamp、level、trace_id 等）
+    重名的字段加 "field_" 前缀。
+    """
 
     def format(self, record):
+        msg = record.msg
+        structured = isinstance(msg, LogMessage)
         log_data = {
             'timestamp': datetime.fromtimestamp(record.created).isoformat(),
             'level': record.levelname,
             'logger': record.name,
-            'message': record.getMessage(),
+            'message': msg.message if structured else record.getMessage(),
             'module': record.module,
             'function': record.funcName,
             'line': record.lineno,
         }
 
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            log_data['trace_id'] = trace_id
+            log_data['span_id'] = record.span_id
+
         if record.exc_info:
             log_data['exception'] = self.formatException(record.exc_info)
 
-        return json.dumps(log_data, ensure_ascii=False)
+        if structured:
+            for fields in (msg.context, msg.fields):
+                for key, value in (fields or {}).items():
+                    log_data[f"field_{key}" if key in log_data else key] = value
+
+        return dumps_json(log_data)
+
+
+# 文本日志行开头的时间（与文件 handler 的 datefmt 相同）
+_TEXT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class SegmentIndex:
+    """
+    归档段的索引（<日志文件>.index.json）
+
+    segments 中每项为 {"file", "start", "end", "bytes", "compressed_bytes",
+    "compressed"}，start / end 为段内第一条和最后一条记录的时间戳；
+    active_start 为当前日志文件第一条记录的时间。写入时先写临时文件再改名。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.segments: List[Dict[str, Any]] = []
+        self.active_start: Optional[float] = None
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.segments = data.get('segments', [])
+            self.active_start = data.get('active_start')
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'active_start': self.active_start, 'segments': self.segments}, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def overlapping(self, start: Optional[float], end: Optional[float]) -> List[Dict[str, Any]]:
+        """与 [start, end] 有交集的段，按开始时间排列"""
+        return sorted(
+            (seg for seg in self.segments
+             if (start is None or seg['end'] >= start) and (end is None or seg['start'] <= end)),
+            key=lambda seg: seg['start'],
+        )
+
+
+class ArchivingFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    按大小和时间轮转、在后台压缩和清理归档段的文件 handler
+
+    当前文件达到 max_bytes，或第一条记录已写入超过 rotate_seconds 秒时轮转：
+    文件改名为 <文件>.<开始时间>，由后台线程压缩为 .gz，再按 retention_days、
+    max_total_bytes（含当前文件）和 backup_count 删除最旧的段。调用方的线程
+    只做改名；没来得及压缩的段在下次启动时继续处理。
+    """
+
+    def __init__(
+        self,
+        filename,
+        max_bytes: int = 10 * 1024 * 1024,
+        rotate_seconds: int = 24 * 3600,
+        compress: bool = True,
+        retention_days: float = 30,
+        max_total_bytes: int = 200 * 1024 * 1024,
+        backup_count: int = 0,
+        encoding: str = 'utf-8',
+    ):
+        super().__init__(filename, 'a', encoding=encoding)
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress = compress
+        self.retention_days = retention_days
+        self.max_total_bytes = max_total_bytes
+        self.backup_count = backup_count
+        self.index = SegmentIndex(self.baseFilename + '.index.json')
+        self._start: Optional[float] = None
+        self._end: Optional[float] = None
+        if os.path.getsize(self.baseFilename) > 0:
+            # 接着写已有的文件：开始时间取索引中的记录，没有时取文件的修改时间
+            self._start = self.index.active_start or os.path.getmtime(self.baseFilename)
+        self._jobs: queue.Queue = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        for segment in self.index.segments:
+            if not segment.get('compressed') and self.compress:
+                self._submit(segment)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self._start is None:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        if self.max_bytes > 0 and self.stream.tell() >= self.max_bytes:
+            return True
+        return self.rotate_seconds > 0 and record.created >= self._start + self.rotate_seconds
+
+    def _mark(self, first: float, last: float):
+        """记录当前文件中记录的时间范围"""
+        if self._start is None:
+            self._start = first
+            with self.index.lock:
+                self.index.active_start = first
+                self.index.save()
+        self._end = last if self._end is None else max(self._end, last)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            self._mark(record.created, record.created)
+            logging.FileHandler.emit(self, record)
+        except Exception:
+            self.handleError(record)
+
+    def emit_batch(self, records: List[logging.LogRecord]):
+        """LogPipeline 的批量写入：每批只检查一次是否轮转"""
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + self.terminator)
+            except Exception:
+                self.handleError(record)
+        with self.lock:
+            try:
+                if self.shouldRollover(records[0]):
+                    self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+                self._mark(records[0].created, records[-1].created)
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except Exception:
+                self.handleError(records[-1])
+
+    def _segment_path(self, start: float) -> str:
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(start))
+        path = f"{self.baseFilename}.{stamp}"
+        n = 0
+        while os.path.exists(path) or os.path.exists(path + '.gz'):
+            n += 1
+            path = f"{self.baseFilename}.{stamp}-{n}"
+        return path
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            mtime = os.path.getmtime(self.baseFilename)
+            start = self._start or mtime
+            path = self._segment_path(start)
+            os.rename(self.baseFilename, path)
+            segment = {
+                'file': os.path.basename(path),
+                'start': start,
+                'end': self._end or mtime,
+                'bytes': os.path.getsize(path),
+                'compressed_bytes': None,
+                'compressed': False,
+            }
+            with self.index.lock:
+                self.index.segments.append(segment)
+                self.index.active_start = None
+                self.index.save()
+            self._submit(segment)
+        self._start = self._end = None
+        self.stream = self._open()
+
+    def _submit(self, segment: Optional[Dict[str, Any]]):
+        """把压缩和清理交给后台线程"""
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(
+                target=self._maintain, name='cowork-log-archiver', daemon=True
+            )
+            self._worker.start()
+        self._jobs.put(segment)
+
+    def _maintain(self):
+        while True:
+            segment = self._jobs.get()
+            try:
+                if segment is None:
+                    return
+                if self.compress and not segment.get('compressed'):
+                    self._compress(segment)
+                self._apply_retention()
+            except Exception as e:
+                sys.stderr.write(f"Log archiving failed for {self.baseFilename}: {e}\n")
+            finally:
+                self._jobs.task_done()
+
+    def _compress(self, segment: Dict[str, Any]):
+        directory = os.path.dirname(self.baseFilename)
+        source = os.path.join(directory, segment['file'])
+        target = source + '.gz'
+        if os.path.exists(source):
+            with open(source, 'rb') as src, gzip.open(target + '.tmp', 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(target + '.tmp', target)
+        elif not os.path.exists(target):
+            return
+        with self.index.lock:
+            segment['file'] = os.path.basename(target)
+            segment['compressed'] = True
+            segment['compressed_bytes'] = os.path.getsize(target)
+            self.index.save()
+        if os.path.exists(source):
+            os.remove(source)
+
+    def _apply_retention(self):
+        """删除过期的段，再从最旧的开始删除直到满足段数和磁盘预算"""
+        directory = os.path.dirname(self.baseFilename)
+
+        def size(seg):
+            return seg['compressed_bytes'] if seg.get('compressed') else seg['bytes']
+
+        with self.index.lock:
+            segments = sorted(self.index.segments, key=lambda seg: seg['end'])
+            expired = []
+            if self.retention_days > 0:
+                cutoff = time.time() - self.retention_days * 86400
+                expired = [seg for seg in segments if seg['end'] < cutoff]
+                segments = [seg for seg in segments if seg['end'] >= cutoff]
+            if self.backup_count > 0 and len(segments) > self.backup_count:
+                expired += segments[:-self.backup_count]
+                segments = segments[-self.backup_count:]
+            if self.max_total_bytes > 0:
+                try:
+                    total = os.path.getsize(self.baseFilename)
+                except OSError:
+                    total = 0
+                total += sum(size(seg) for seg in segments)
+                while segments and total > self.max_total_bytes:
+                    total -= size(segments[0])
+                    expired.append(segments.pop(0))
+            if not expired:
+                return
+            self.index.segments = [seg for seg in self.index.segments if seg in segments]
+            self.index.save()
+        for seg in expired:
+            try:
+                os.remove(os.path.join(directory, seg['file']))
+            except FileNotFoundError:
+                pass
+
+    def close(self, timeout: float = 10.0):
+        """等待后台压缩完成（最多 timeout 秒）后关闭"""
+        if self._worker is not None and self._worker.is_alive():
+            self._jobs.put(None)
+            self._worker.join(timeout)
+        super().close()
+
+
+def _line_time(line: str) -> Optional[float]:
+    """日志行的时间戳（文本或 JSON 格式），续行（如异常堆栈）为 None"""
+    try:
+        if line.startswith('{'):
+            return datetime.fromisoformat(json.loads(line)['timestamp']).timestamp()
+        return time.mktime(time.strptime(line[:19], _TEXT_TIME_FORMAT))
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _open_segment(path: str):
+    try:
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+        return open(path, encoding='utf-8', errors='replace')
+    except FileNotFoundError:
+        if path.endswith('.gz'):
+            raise
+        # 读取期间被后台线程压缩
+        return gzip.open(path + '.gz', 'rt', encoding='utf-8', errors='replace')
+
+
+def read_log(
+    log_file: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> Iterator[str]:
+    """
+    按时间顺序读取日志文件及其归档段中 [start, end] 范围内的行
+
+    根据索引只打开时间范围有交集的段；文本行的时间精确到秒，没有时间的
+    续行跟随前一行。
+    """
+    log_file = str(Path(log_file).expanduser())
+    index = SegmentIndex(log_file + '.index.json')
+    directory = os.path.dirname(log_file)
+    paths = [os.path.join(directory, seg['file']) for seg in index.overlapping(start, end)]
+    if os.path.exists(log_file) and (end is None or (index.active_start or 0) <= end):
+        paths.append(log_file)
+
+    lower = None if start is None else int(start)  # 文本行的时间没有小数部分
+    for path in paths:
+        try:
+            f = _open_segment(path)
+        except FileNotFoundError:
+            continue  # 已被清理
+        with f:
+            included = False
+            for line in f:
+                t = _line_time(line)
+                if t is not None:
+                    included = (lower is None or t >= lower) and (end is None or t <= end)
+                if included:
+                    yield line.rstrip('\n')
+
+
+def write_batch(handler: logging.Handler, records: List[logging.LogRecord]):
+    """
+    把一批记录写入 handler
+
+    handler 有 emit_batch 方法时交给它处理；StreamHandler（包括文件和轮转文件）
+    拼接后一次写入并 flush，每批只检查一次是否轮转；其他 handler 逐条处理。
+    """
+    records = [r for r in records if r.levelno >= handler.level and handler.filter(r)]
+    if not records:
+        return
+    emit_batch = getattr(handler, 'emit_batch', None)
+    if emit_batch is not None:
+        emit_batch(records)
+        return
+    if not isinstance(handler, logging.StreamHandler):
+        for record in records:
+            handler.handle(record)
+        return
+
+    lines = []
+    for record in records:
+        try:
+            lines.append(handler.format(record) + handler.terminator)
+        except Exception:
+            handler.handleError(record)
+    text = ''.join(lines)
+    with handler.lock:
+        try:
+            if isinstance(handler, logging.handlers.RotatingFileHandler):
+                if handler.stream is None:
+                    handler.stream = handler._open()
+                if handler.maxBytes > 0 and handler.stream.tell() + len(text.encode(
+                        handler.encoding or 'utf-8', 'replace')) > handler.maxBytes:
+                    handler.doRollover()
+            elif isinstance(handler, logging.FileHandler) and handler.stream is None:
+                handler.stream = handler._open()
+            handler.stream.write(text)
+            handler.flush()
+        except Exception:
+            handler.handleError(records[-1])
+
+
+class _FlushMarker:
+    """放入队列的标记：写入线程处理到它时通知 flush() 的调用方"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class LogPipeline(logging.Handler):
+    """
+    异步日志管道
+
+    emit() 只把记录放入有界队列；一个后台线程取出记录，每次最多 batch_size 条，
+    按 handler 批量格式化和写入。
+
+    Args:
+        handlers: 实际输出的 handler
+        queue_size: 队列容量
+        overflow: 队列满时 "drop"（丢弃新记录并计数，ERROR 及以上级别仍等待空位）
+            或 "block"（调用方等待）
+        batch_size: 每批最多写入的记录数
+    """
+
+    _SENTINEL = object()
+
+    def __init__(
+        self,
+        handlers: List[logging.Handler],
+        queue_size: int = 10000,
+        overflow: str = "drop",
+        batch_size: int = 512,
+    ):
+        if overflow not in ("drop", "block"):
+            raise ValueError(f"overflow must be 'drop' or 'block', not {overflow!r}")
+        super().__init__(min((h.level for h in handlers), default=logging.NOTSET))
+        self.handlers = list(handlers)
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.max_pending = 0
+        self._reported_dropped = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='cowork-log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # 不获取 handler 锁：队列本身是线程安全的
+        if self.filter(record):
+            self.emit(record)
+            return True
+        return False
+
+    def emit(self, record: logging.LogRecord):
+        if self._closed:
+            return
+        try:
+            if self.overflow == "block" or record.levelno >= logging.ERROR:
+                self.queue.put(record)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.queued += 1
+        pending = self.queue.qsize()
+        if pending > self.max_pending:
+            self.max_pending = pending
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            markers = []
+            records = []
+            for item in batch:
+                if item is self._SENTINEL:
+                    stop = True
+                elif isinstance(item, _FlushMarker):
+                    markers.append(item)
+                else:
+                    records.append(item)
+            if self.dropped > self._reported_dropped:
+                records.append(self._dropped_record())
+            if records:
+                for handler in self.handlers:
+                    try:
+                        write_batch(handler, records)
+                    except Exception:
+                        handler.handleError(records[-1])
+                self.written += len(records)
+            for marker in markers:
+                marker.done.set()
+            if stop:
+                return
+
+    def _dropped_record(self) -> logging.LogRecord:
+        """记录自上次报告以来因队列满而丢弃的条数"""
+        dropped = self.dropped - self._reported_dropped
+        self._reported_dropped = self.dropped
+        return logging.LogRecord(
+            'cowork.logger', logging.WARNING, __file__, 0,
+            "Log queue full, dropped %d records", (dropped,), None,
+        )
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待此前放入队列的记录写完，超时返回 False"""
+        if self._closed or not self._thread.is_alive():
+            return True
+        marker = _FlushMarker()
+        self.queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def close(self, timeout: float = 10.0):
+        """写完队列中的记录后停止写入线程，关闭 handler（进程退出时自动调用）"""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        if self._thread.is_alive():
+            self.queue.put(self._SENTINEL)
+            self._thread.join(timeout)
+        for handler in self.handlers:
+            handler.close()
+        super().close()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.queued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "pending": self.queue.qsize(),
+            "max_pending": self.max_pending,
+        }
 
 
 # 全局日志器实例
@@ -226,7 +877,96 @@ def critical(msg: str, **kwargs):
     get_logger('cowork').critical(msg, **kwargs)
 
 
+def benchmark(iterations: int = 100000) -> Dict[str, Any]:
+    """
+    单次日志调用的开销（纳秒）
+
+    - disabled：级别未启用的 debug() 调用（带 3 个字段）
+    - eager_disabled：先拼接字段字符串再交给 logging 检查级别（旧实现），作为对照
+    - text / json：启用时写入文本日志文件 / 同时写入 JSON 日志文件
+    - async_text / async_json：async_mode 下调用方的开销（连续写入不超过
+      队列容量的一批，不包括后台线程的写入）
+    """
+    import tempfile
+    import timeit
+
+    fields = {'vm_name': 'sandbox', 'operation': 'start', 'duration_ms': 2512.4}
+
+    def per_call(statement) -> int:
+        return round(min(timeit.repeat(statement, number=iterations, repeat=3)) / iterations * 1e9)
+
+    def per_async_call(logger: CoworkLogger, statement) -> int:
+        burst = min(iterations, logger.config.queue_size)
+        timings = []
+        for _ in range(3):
+            timings.append(timeit.timeit(statement, number=burst))
+            logger.flush()
+        return round(min(timings) / burst * 1e9)
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        text = CoworkLogger('bench-text', LogConfig(
+            log_dir=log_dir, console_level='CRITICAL', file_level='INFO'))
+        structured = CoworkLogger('bench-json', LogConfig(
+            log_dir=log_dir, console_level='CRITICAL', file_level='INFO', json_format=True))
+        async_text = CoworkLogger('bench-async-text', LogConfig(
+            log_dir=log_dir, console_level='CRITICAL', file_level='INFO', async_mode=True))
+        async_structured = CoworkLogger('bench-async-json', LogConfig(
+            log_dir=log_dir, console_level='CRITICAL', file_level='INFO', json_format=True,
+            async_mode=True))
+        # JSON handler 记录所有级别，这里只测 INFO
+        structured.logger.handlers[-1].setLevel(logging.INFO)
+        structured.logger.setLevel(logging.INFO)
+        async_structured.logger.setLevel(logging.INFO)
+        result = {
+            'iterations': iterations,
+            'json_serializer': 'orjson' if orjson is not None else 'json',
+            'disabled_ns': per_call(lambda: text.debug("VM operation", **fields)),
+            'eager_disabled_ns': per_call(lambda: text.logger.log(
+                logging.DEBUG, "VM operation | " + " | ".join(f"{k}={v}" for k, v in fields.items())
+            )),
+            'text_ns': per_call(lambda: text.info("VM operation", **fields)),
+            'json_ns': per_call(lambda: structured.info("VM operation", **fields)),
+            'async_text_ns': per_async_call(
+                async_text, lambda: async_text.info("VM operation", **fields)),
+            'async_json_ns': per_async_call(
+                async_structured, lambda: async_structured.info("VM operation", **fields)),
+            'async_dropped': async_text.stats()['dropped'] + async_structured.stats()['dropped'],
+        }
+        for logger in (text, structured, async_text, async_structured):
+            logger.close()
+    return result
+
+
+def _parse_time(value: str) -> float:
+    """"2026-01-31 08:00"、"2026-01-31T08:00:00" 或时间戳"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['bench']:
+        # python3 host/logger.py bench [次数]
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        print(json.dumps(benchmark(count), indent=2))
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['read']:
+        # python3 host/logger.py read ~/.cowork/logs/cowork.log --start "2026-01-31 08:00"
+        import argparse
+        parser = argparse.ArgumentParser(prog='logger.py read', description="Read a log and its archived segments")
+        parser.add_argument('log_file')
+        parser.add_argument('--start', type=_parse_time, help='ISO time or Unix timestamp')
+        parser.add_argument('--end', type=_parse_time, help='ISO time or Unix timestamp')
+        args = parser.parse_args(sys.argv[2:])
+        try:
+            for line in read_log(args.log_file, args.start, args.end):
+                print(line)
+        except BrokenPipeError:
+            pass
+        sys.exit(0)
+
     # 测试日志系统
     print("Testing logger system...\n")
 
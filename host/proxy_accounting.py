@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+代理流量的归属和按沙箱 / 任务的统计
+
+所有 VM 共用同一个代理，请求按以下信息归属：
+- 客户端地址（总是有）
+- 沙箱名和任务编号：控制器为每次 ask_claude 注入带用户名的代理地址
+  http://<沙箱>:<任务>@192.168.5.2:7890，客户端据此发送 Proxy-Authorization；
+  不能设置代理认证的工具可以发送 X-Cowork-Job: <沙箱>/<任务>（或只有任务编号）
+- 追踪编号：密码为 "<任务>:<traceparent>" 时（见 host/tracing.py），请求记录
+  该 trace 的编号和父 span；没有时使用请求中的 W3C traceparent 头部
+
+前两个头部都只给代理使用，不会转发给上游。
+
+TrafficAccounts 为每个沙箱 / 任务累计请求数、错误数、上下行字节、隧道数和
+延迟直方图。条目数有上限，超出时最久没有活动的条目合并到 "(other)"，
+内存固定，可以像其他统计一样在 worker 之间合并。
+"""
+
+import base64
+import binascii
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+try:
+    from host.proxy_metrics import LatencyHistogram
+    from host.tracing import parse_traceparent
+except ImportError:  # 作为脚本从 host/ 运行
+    from proxy_metrics import LatencyHistogram
+    from tracing import parse_traceparent
+
+# 不能使用代理认证时标记任务的请求头
+JOB_HEADER = 'x-cowork-job'
+# 按任务统计时跟踪的任务数 / 按沙箱统计时跟踪的沙箱数
+MAX_JOBS = 1024
+MAX_SANDBOXES = 256
+# 沙箱名 / 任务编号的最大长度（超出部分截断）
+MAX_TAG_LENGTH = 64
+# 按沙箱 / 任务记录的延迟阶段
+ACCOUNT_PHASES = ('ttfb', 'total')
+OTHER = '(other)'
+
+
+def _tag(value: str) -> Optional[str]:
+    value = value.strip()[:MAX_TAG_LENGTH]
+    return value or None
+
+
+def parse_attribution(headers: List[tuple]) -> Tuple[Optional[str], ...]:
+    """
+    从请求头中取出 (沙箱, 任务, 追踪编号, 父 span 编号)
+
+    Proxy-Authorization: Basic 的用户名为沙箱、密码为任务（可带 ":<traceparent>"）；
+    X-Cowork-Job 为 "<沙箱>/<任务>" 或只有任务。两者都有时以 X-Cowork-Job 为准。
+    代理认证中没有追踪信息时使用 traceparent 头部。格式错误的头部被忽略
+    （代理不要求认证）。
+    """
+    sandbox = job = None
+    trace = header_trace = None
+    for name, value in headers:
+        lower = name.lower()
+        if lower == 'proxy-authorization':
+            scheme, _, credentials = value.strip().partition(' ')
+            if scheme.lower() != 'basic':
+                continue
+            try:
+                decoded = base64.b64decode(credentials.strip(), validate=True).decode('utf-8')
+            except (binascii.Error, UnicodeDecodeError):
+                continue
+            user, _, password = decoded.partition(':')
+            password, _, traceparent = unquote(password).partition(':')
+            sandbox = _tag(unquote(user)) or sandbox
+            job = _tag(password) or job
+            trace = parse_traceparent(traceparent) or trace
+        elif lower == JOB_HEADER:
+            tagged_sandbox, _, tagged_job = value.rpartition('/')
+            sandbox = _tag(tagged_sandbox) or sandbox
+            job = _tag(tagged_job) or job
+        elif lower == 'traceparent':
+            header_trace = parse_traceparent(value)
+    trace_id, parent_span_id = trace or header_trace or (None, None)
+    return sandbox, job, trace_id, parent_span_id
+
+
+@dataclass
+class Usage:
+    """一个沙箱或任务的累计流量"""
+    requests: int = 0
+    failed: int = 0
+    tunnels: int = 0
+    bytes_up: int = 0
+    bytes_down: int = 0
+    first_seen: float = 0.0
+    last_seen: float = 0.0
+    latency: Dict[str, LatencyHistogram] = field(
+        default_factory=lambda: {phase: LatencyHistogram() for phase in ACCOUNT_PHASES}
+    )
+
+    def copy(self) -> 'Usage':
+        return Usage(
+            self.requests, self.failed, self.tunnels, self.bytes_up, self.bytes_down,
+            self.first_seen, self.last_seen,
+            {phase: h.copy() for phase, h in self.latency.items()},
+        )
+
+    def merge(self, other: 'Usage'):
+        self.requests += other.requests
+        self.failed += other.failed
+        self.tunnels += other.tunnels
+        self.bytes_up += other.bytes_up
+        self.bytes_down += other.bytes_down
+        self.first_seen = min(self.first_seen, other.first_seen) if self.first_seen else other.first_seen
+        self.last_seen = max(self.last_seen, other.last_seen)
+        for phase, histogram in other.latency.items():
+            self.latency[phase].merge(histogram)
+
+    def to_dict(self) -> dict:
+        elapsed = self.last_seen - self.first_seen
+        return {
+            "requests": self.requests,
+            "failed": self.failed,
+            "tunnels": self.tunnels,
+            "bytes_up": self.bytes_up,
+            "bytes_down": self.bytes_down,
+            # 从第一个到最后一个请求结束期间的平均下行速率
+            "bytes_down_per_second": round(self.bytes_down / elapsed, 1) if elapsed > 0 else None,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "latency": {phase: h.summary() for phase, h in self.latency.items()},
+        }
+
+
+class TrafficAccounts:
+    """
+    按键（沙箱名或任务编号）累计的 Usage，最多 capacity 个
+
+    超出容量时最久没有活动的条目合并到 "(other)"。
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: Dict[str, Usage] = {}
+
+    def _entry(self, key: str) -> Usage:
+        usage = self.entries.get(key)
+        if usage is None:
+            if len(self.entries) >= self.capacity:
+                self._evict()
+            usage = self.entries.setdefault(key, Usage())
+        return usage
+
+    def _evict(self):
+        candidates = [k for k in self.entries if k != OTHER]
+        if not candidates:
+            return
+        oldest = min(candidates, key=lambda k: self.entries[k].last_seen)
+        usage = self.entries.pop(oldest)
+        self.entries.setdefault(OTHER, Usage()).merge(usage)
+
+    def record(self, key: str, req_log):
+        """记入一条 RequestLog"""
+        usage = self._entry(key)
+        now = time.time()
+        if not usage.first_seen:
+            usage.first_seen = now
+        usage.last_seen = now
+        usage.requests += 1
+        usage.bytes_up += req_log.request_size
+        usage.bytes_down += req_log.response_size
+        if req_log.method == 'CONNECT':
+            usage.tunnels += 1
+        if req_log.error:
+            usage.failed += 1
+            return
+        if req_log.ttfb_ms is not None:
+            usage.latency['ttfb'].record(req_log.ttfb_ms)
+        usage.latency['total'].record(req_log.duration_ms)
+
+    def copy(self) -> 'TrafficAccounts':
+        accounts = TrafficAccounts(self.capacity)
+        accounts.entries = {key: usage.copy() for key, usage in self.entries.items()}
+        return accounts
+
+    def merge(self, other: 'TrafficAccounts'):
+        for key, usage in other.entries.items():
+            if key not in self.entries and len(self.entries) >= self.capacity:
+                self._evict()
+            self.entries.setdefault(key, Usage()).merge(usage)
+
+    def top(self, by: str = 'bytes_down') -> List[Tuple[str, Usage]]:
+        """按 Usage 的某个字段从大到小排列"""
+        return sorted(self.entries.items(), key=lambda item: getattr(item[1], by), reverse=True)
+
+    def to_dict(self) -> dict:
+        return {key: usage.to_dict() for key, usage in self.top()}
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+代理请求归档
+
+后台线程把 RequestLog 批量写入本地 SQLite（WAL 模式），请求路径上只做一次
+非阻塞的入队操作；按时间、主机、状态码建立索引，百万级记录下按时间范围和
+主机查询仍然很快。进程崩溃最多丢失最后一个批次（默认 1 秒）的记录。
+
+命令行查询：
+    python3 host/proxy_archive.py query --host pypi.org --since 1h
+    python3 host/proxy_archive.py hosts --since 1d
+    python3 host/proxy_archive.py jobs --since 1h
+"""
+
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+DEFAULT_ARCHIVE_PATH = "~/.cowork/proxy.db"
+
+COLUMNS = (
+    ("timestamp", "REAL"),
+    ("method", "TEXT"),
+    ("url", "TEXT"),
+    ("host", "TEXT"),
+    ("path", "TEXT"),
+    ("status_code", "INTEGER"),
+    ("response_size", "INTEGER"),
+    ("request_size", "INTEGER"),
+    ("duration_ms", "REAL"),
+    ("ttfb_ms", "REAL"),
+    ("connect_ms", "REAL"),
+    ("error", "TEXT"),
+    ("close_reason", "TEXT"),
+    ("cache_status", "TEXT"),
+    ("dns_ms", "REAL"),
+    ("client", "TEXT"),
+    ("sandbox", "TEXT"),
+    ("job", "TEXT"),
+    ("trace_id", "TEXT"),
+    ("span_id", "TEXT"),
+    ("parent_span_id", "TEXT"),
+)
+
+# summarize 支持的分组：沙箱没有名字时按客户端地址分组
+GROUPS = {
+    "host": "host",
+    "sandbox": "COALESCE(sandbox, client)",
+    "job": "job",
+}
+
+
+def _to_epoch(timestamp) -> float:
+    if isinstance(timestamp, str):
+        return datetime.fromisoformat(timestamp).timestamp()
+    return float(timestamp)
+
+
+class ProxyArchive:
+    """
+    批量写入的 SQLite 请求归档
+
+    append() 只把记录放入有界队列（队列满时丢弃并计数），由后台线程每
+    flush_interval 秒或攒够 batch_size 条时写入一个事务。
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_ARCHIVE_PATH,
+        batch_size: int = 1000,
+        flush_interval: float = 1.0,
+        max_queue: int = 100000,
+    ):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._closed = False
+
+        conn = self._connect()
+        columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY, {columns})")
+        # 旧版本创建的归档缺少后来增加的列
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(requests)")}
+        for name, kind in COLUMNS:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE requests ADD COLUMN {name} {kind}")
+        conn.execute("CREATE INDEX IF NOT EXISTS requests_time ON requests (timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS requests_host ON requests (host, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS requests_status ON requests (status_code, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS requests_job ON requests (job, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS requests_trace ON requests (trace_id, timestamp)")
+        conn.commit()
+        conn.close()
+
+        self._writer = threading.Thread(target=self._run, name="proxy-archive", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 下 NORMAL 只在断电时可能丢失最后的事务，不会损坏数据库
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def append(self, req_log):
+        """记录一条 RequestLog（非阻塞）"""
+        try:
+            self._queue.put_nowait(req_log)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        conn = self._connect()
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        insert = (
+            f"INSERT INTO requests ({', '.join(name for name, _ in COLUMNS)}) "
+            f"VALUES ({placeholders})"
+        )
+        stop = False
+        while not stop:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            if not batch:
+                continue
+            rows = [
+                (
+                    _to_epoch(r.timestamp), r.method, r.url, r.host, r.path, r.status_code,
+                    r.response_size, r.request_size, r.duration_ms, r.ttfb_ms,
+                    r.connect_ms, r.error, r.close_reason, r.cache_status, r.dns_ms,
+                    r.client, r.sandbox, r.job, r.trace_id, r.span_id, r.parent_span_id,
+                )
+                for r in batch
+            ]
+            try:
+                with conn:
+                    conn.executemany(insert, rows)
+                self.written += len(rows)
+            except sqlite3.Error as e:
+                self.dropped += len(rows)
+                print(f"Proxy archive write failed: {e}", file=sys.stderr)
+        conn.close()
+
+    def close(self, timeout: float = 10.0):
+        """写完队列中剩余的记录后停止后台线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join(timeout)
+
+    def query(
+        self,
+        host: Optional[str] = None,
+        status: Optional[int] = None,
+        method: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        errors_only: bool = False,
+        limit: int = 100,
+        sandbox: Optional[str] = None,
+        job: Optional[str] = None,
+        trace_id: Optional[str] = None,
+    ) -> List[dict]:
+        """按条件查询，返回最近的 limit 条（按时间顺序）"""
+        return query_archive(
+            self.path, host=host, status=status, method=method, since=since,
+            until=until, errors_only=errors_only, limit=limit, sandbox=sandbox, job=job,
+            trace_id=trace_id,
+        )
+
+
+def _where(host, status, method, since, until, errors_only, sandbox=None, job=None, trace_id=None) -> tuple:
+    clauses, params = [], []
+    if host:
+        clauses.append("host = ?")
+        params.append(host)
+    if sandbox:
+        clauses.append(f"{GROUPS['sandbox']} = ?")
+        params.append(sandbox)
+    if job:
+        clauses.append("job = ?")
+        params.append(job)
+    if trace_id:
+        clauses.append("trace_id = ?")
+        params.append(trace_id)
+    if status is not None:
+        clauses.append("status_code = ?")
+        params.append(status)
+    if method:
+        clauses.append("method = ?")
+        params.append(method.upper())
+    if since is not None:
+        clauses.append("timestamp >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("timestamp < ?")
+        params.append(until)
+    if errors_only:
+        clauses.append("error IS NOT NULL")
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def query_archive(
+    path: str,
+    host: Optional[str] = None,
+    status: Optional[int] = None,
+    method: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    errors_only: bool = False,
+    limit: int = 100,
+    sandbox: Optional[str] = None,
+    job: Optional[str] = None,
+    trace_id: Optional[str] = None,
+) -> List[dict]:
+    """查询归档（只读连接，可与正在写入的代理并发使用）"""
+    where, params = _where(host, status, method, since, until, errors_only, sandbox, job, trace_id)
+    conn = sqlite3.connect(str(Path(path).expanduser()), timeout=30)
+    try:
+        cursor = conn.execute(
+            f"SELECT * FROM requests{where} ORDER BY timestamp DESC LIMIT ?",
+            params + [limit],
+        )
+        names = [d[0] for d in cursor.description]
+        rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+    rows.reverse()
+    for row in rows:
+        row.pop("id", None)
+        row["timestamp"] = datetime.fromtimestamp(row["timestamp"]).isoformat()
+    return rows
+
+
+def summarize(
+    path: str,
+    group_by: str = "host",
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 50,
+) -> List[dict]:
+    """
+    按主机、沙箱或任务汇总请求数、错误数、字节数和平均耗时
+
+    按沙箱和任务汇总时按下行字节数排序（找出占满带宽的任务），
+    按主机汇总时按请求数排序。
+    """
+    if group_by not in GROUPS:
+        raise ValueError(f"Cannot group by {group_by}")
+    where, params = _where(None, None, None, since, until, False)
+    if group_by == "job":
+        where += " AND job IS NOT NULL" if where else " WHERE job IS NOT NULL"
+    order = "requests" if group_by == "host" else "response_bytes"
+    extra = ""
+    if group_by == "job":
+        # 任务通常只来自一个沙箱
+        extra = "MIN(COALESCE(sandbox, client)) AS sandbox, "
+    conn = sqlite3.connect(str(Path(path).expanduser()), timeout=30)
+    try:
+        cursor = conn.execute(
+            f"""
+            SELECT {GROUPS[group_by]} AS {group_by},
+                   {extra}COUNT(*) AS requests,
+                   SUM(error IS NOT NULL) AS errors,
+                   SUM(response_size) AS response_bytes,
+                   SUM(request_size) AS request_bytes,
+                   ROUND(AVG(duration_ms), 1) AS avg_duration_ms,
+                   datetime(MIN(timestamp), 'unixepoch', 'localtime') AS first_request
+            FROM requests{where}
+            GROUP BY 1
+            ORDER BY {order} DESC
+            LIMIT ?
+            """,
+            params + [limit],
+        )
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def summarize_hosts(
+    path: str,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 50,
+) -> List[dict]:
+    """按主机汇总请求数、错误数、字节数和平均耗时"""
+    return summarize(path, "host", since=since, until=until, limit=limit)
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """解析时间参数：相对时间（30s / 15m / 2h / 7d）或 ISO 格式时间"""
+    if not value:
+        return None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd])", value)
+    if match:
+        seconds = float(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match.group(2)]
+        return time.time() - seconds
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    """命令行入口"""
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Query the proxy request archive")
+    parser.add_argument(
+        "--db",
+        default=os.environ.get("COWORK_PROXY_ARCHIVE", DEFAULT_ARCHIVE_PATH),
+        help=f"Archive database (default: $COWORK_PROXY_ARCHIVE or {DEFAULT_ARCHIVE_PATH})",
+    )
+    parser.add_argument("--json", action="store_true", help="Output in JSON format")
+    sub = parser.add_subparsers(dest="command")
+
+    query = sub.add_parser("query", help="List archived requests")
+    query.add_argument("--host", help="Only this host")
+    query.add_argument("--status", type=int, help="Only this status code")
+    query.add_argument("--method", help="Only this method (e.g. CONNECT)")
+    query.add_argument("--errors", action="store_true", help="Only failed requests")
+    query.add_argument("--sandbox", help="Only this sandbox (or client address)")
+    query.add_argument("--job", help="Only this job")
+    query.add_argument("--trace", help="Only this trace id (see host/tracing.py)")
+    query.add_argument("-n", "--limit", type=int, default=100, help="Number of records (default: 100)")
+
+    hosts = sub.add_parser("hosts", help="Summarize requests by host")
+    hosts.add_argument("-n", "--limit", type=int, default=50, help="Number of hosts (default: 50)")
+
+    sandboxes = sub.add_parser("sandboxes", help="Summarize traffic by sandbox (or client address)")
+    sandboxes.add_argument("-n", "--limit", type=int, default=50, help="Number of sandboxes (default: 50)")
+
+    jobs = sub.add_parser("jobs", help="Summarize traffic by job")
+    jobs.add_argument("-n", "--limit", type=int, default=50, help="Number of jobs (default: 50)")
+
+    for command in (query, hosts, sandboxes, jobs):
+        command.add_argument("--since", help="Start time: 15m, 2h, 7d or ISO time")
+        command.add_argument("--until", help="End time: 15m, 2h, 7d or ISO time")
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        return
+    if not Path(args.db).expanduser().exists():
+        print(f"Archive not found: {args.db}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        since, until = parse_time(args.since), parse_time(args.until)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.command == "query":
+        rows = query_archive(
+            args.db, host=args.host, status=args.status, method=args.method,
+            since=since, until=until, errors_only=args.errors, limit=args.limit,
+            sandbox=args.sandbox, job=args.job, trace_id=args.trace,
+        )
+    else:
+        group_by = {"hosts": "host", "sandboxes": "sandbox", "jobs": "job"}[args.command]
+        rows = summarize(args.db, group_by, since=since, until=until, limit=args.limit)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    if not rows:
+        print("No records")
+        return
+    if args.command == "query":
+        for row in rows:
+            if row["error"]:
+                outcome = f"ERROR: {row['error']}"
+            else:
+                outcome = f"{row['status_code']} ({row['response_size']} bytes, {row['duration_ms']:.0f}ms)"
+            if row["job"]:
+                outcome += f" [job {row['job']}]"
+            print(f"{row['timestamp']} {row['method']} {row['url']} - {outcome}")
+    else:
+        headers = list(rows[0])
+        print("\t".join(headers))
+        for row in rows:
+            print("\t".join("" if row[h] is None else str(row[h]) for h in headers))
+
+
+if __name__ == "__main__":
+    main()
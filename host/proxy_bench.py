@@ -0,0 +1,845 @@
+#!/usr/bin/env python3
+"""
+代理性能测试
+
+在本机启动源站和代理，用多个负载进程通过代理发送请求，结果以 JSON 输出。
+全部在本地回环地址上运行，不需要外网。
+
+    # worker 数从 1 到 4 的扩展性
+    python3 host/proxy_bench.py workers --max-workers 4 --duration 10
+
+    # 混合负载：小文件 GET、大文件下载、SSE 慢速流和长时间 CONNECT 隧道
+    python3 host/proxy_bench.py mix --mix small=48,large=4,sse=8,tunnel=4 --duration 30
+
+    # 与之前保存的结果比较，RPS / p99 变差超过 10% 时退出码为 1
+    python3 host/proxy_bench.py mix -o new.json --baseline old.json
+
+    # 访问策略的匹配开销随规则数的变化（不启动代理）
+    python3 host/proxy_bench.py policy --rules 1000,10000,100000
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from host.proxy_policy import Policy, PolicyEngine, Rule
+except ImportError:  # 作为脚本从 host/ 运行
+    from proxy_policy import Policy, PolicyEngine, Rule
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Port {port} did not open within {timeout}s")
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return round(sorted_values[index], 3)
+
+
+# ---------------------------------------------------------------------------
+# 源站
+# ---------------------------------------------------------------------------
+
+# 负载场景：小文件 GET、大文件下载、SSE 式慢速流、长时间 CONNECT 隧道
+SCENARIOS = ('small', 'large', 'sse', 'tunnel')
+# 隧道中每次往返的数据量（源站原样返回）
+TUNNEL_RECORD_SIZE = 16 * 1024
+READ_CHUNK_SIZE = 256 * 1024
+
+
+def _origin_main(
+    port: int,
+    body_size: int,
+    echo_port: Optional[int] = None,
+    large_size: int = 8 * 1024 * 1024,
+    sse_events: int = 20,
+    sse_interval: float = 0.1,
+):
+    """
+    最小的 keep-alive HTTP 源站
+
+    /large 返回 large_size 字节，/sse 以 chunked 编码每 sse_interval 秒发送
+    一个事件（共 sse_events 个），其他路径返回 body_size 字节。echo_port
+    上的 TCP 服务原样返回收到的数据，作为 CONNECT 隧道的目标（代理只转发
+    隧道中的字节，与 TLS 源站没有区别）。
+    """
+    def response(size: int) -> bytes:
+        return (
+            f"HTTP/1.1 200 OK\r\nContent-Length: {size}\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode('latin-1') + b'x' * size
+
+    small = response(body_size)
+    large = response(large_size)
+    sse_head = (
+        b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+        b"Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n"
+    )
+
+    async def send_events(writer):
+        writer.write(sse_head)
+        for i in range(sse_events):
+            if i:
+                await asyncio.sleep(sse_interval)
+            event = f"id: {i}\ndata: {{\"seq\": {i}, \"text\": \"{'x' * 64}\"}}\n\n".encode()
+            writer.write(b'%x\r\n%s\r\n' % (len(event), event))
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                path = head.split(b' ', 2)[1]
+                if path.startswith(b'/large'):
+                    writer.write(large)
+                elif path.startswith(b'/sse'):
+                    await send_events(writer)
+                else:
+                    writer.write(small)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    async def echo(reader, writer):
+        try:
+            while True:
+                data = await reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', port, reuse_port=True, backlog=4096)
+        if echo_port is not None:
+            await asyncio.start_server(echo, '127.0.0.1', echo_port, reuse_port=True, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def start_origin(processes: int = 2, body_size: int = 1024, **options):
+    """
+    启动源站进程（SO_REUSEPORT 共享端口，避免源站成为瓶颈）
+
+    返回 (HTTP 端口, 回显端口, 进程列表)；options 为 _origin_main 的其他参数。
+    """
+    port = free_port()
+    echo_port = free_port()
+    context = multiprocessing.get_context('spawn')
+    workers = [
+        context.Process(
+            target=_origin_main, args=(port, body_size, echo_port), kwargs=options, daemon=True
+        )
+        for _ in range(processes)
+    ]
+    for process in workers:
+        process.start()
+    wait_for_port(port)
+    wait_for_port(echo_port)
+    return port, echo_port, workers
+
+
+# ---------------------------------------------------------------------------
+# 负载生成
+# ---------------------------------------------------------------------------
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """"small=70,large=10,sse=10,tunnel=10" -> 各场景的权重"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"Unknown scenario {name!r} (expected one of {', '.join(SCENARIOS)})")
+        mix[name] = float(weight) if weight else 1.0
+        if mix[name] < 0:
+            raise ValueError(f"Negative weight for {name}")
+    if not any(mix.values()):
+        raise ValueError("Mix has no scenario with a positive weight")
+    return mix
+
+
+def split_connections(mix: Dict[str, float], connections: int) -> Dict[str, int]:
+    """按权重把连接数分给各场景，权重为正的场景至少一个连接"""
+    total = sum(mix.values())
+    counts = {name: max(1, round(connections * weight / total))
+              for name, weight in mix.items() if weight > 0}
+    return counts
+
+
+async def _read_response_body(reader, head: bytes, on_first_chunk=None) -> int:
+    """读取并丢弃响应体（Content-Length 或 chunked），返回载荷字节数"""
+    length = 0
+    chunked = False
+    for line in head.split(b'\r\n'):
+        lower = line.lower()
+        if lower.startswith(b'content-length:'):
+            length = int(line.split(b':', 1)[1])
+        elif lower.startswith(b'transfer-encoding:') and b'chunked' in lower:
+            chunked = True
+    received = 0
+    if not chunked:
+        while received < length:
+            data = await reader.read(min(READ_CHUNK_SIZE, length - received))
+            if not data:
+                raise asyncio.IncompleteReadError(b'', length - received)
+            if not received and on_first_chunk:
+                on_first_chunk()
+            received += len(data)
+        return received
+    while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+        if size == 0:
+            # 没有 trailer 时只剩结尾的空行
+            while await reader.readuntil(b'\r\n') != b'\r\n':
+                pass
+            return received
+        await reader.readexactly(size + 2)
+        if not received and on_first_chunk:
+            on_first_chunk()
+        received += size
+
+
+class _ScenarioResult:
+    """一个负载进程中某个场景的结果"""
+
+    def __init__(self):
+        self.latencies: List[float] = []  # 完成一次请求的时间（隧道为每次往返）
+        self.ttfb: List[float] = []       # 收到响应头 / 第一个事件 / 隧道建立的时间
+        self.completed = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def to_dict(self) -> dict:
+        return vars(self)
+
+
+def _load_main(
+    results,
+    proxy_port: int,
+    origin_port: int,
+    echo_port: int,
+    connections: Dict[str, int],
+    duration: float,
+    tunnel_duration: float = 5.0,
+    tunnel_interval: float = 0.1,
+):
+    """
+    一个负载进程：每个场景 connections[场景] 个连接循环发送请求
+
+    small / large / sse 复用 keep-alive 连接；tunnel 每次新建 CONNECT 隧道，
+    每 tunnel_interval 秒往返一次数据，保持 tunnel_duration 秒后关闭。
+    """
+    target = f"127.0.0.1:{origin_port}"
+    requests = {
+        name: (
+            f"GET http://{target}/{name} HTTP/1.1\r\nHost: {target}\r\n"
+            + ("Accept: text/event-stream\r\n" if name == 'sse' else "")
+            + "\r\n"
+        ).encode('latin-1')
+        for name in ('small', 'large', 'sse')
+    }
+    connect = f"CONNECT 127.0.0.1:{echo_port} HTTP/1.1\r\nHost: 127.0.0.1:{echo_port}\r\n\r\n".encode()
+    record = os.urandom(TUNNEL_RECORD_SIZE)
+    stats = {name: _ScenarioResult() for name in connections}
+    errors = (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError)
+
+    async def http_client(name: str, deadline: float):
+        result = stats[name]
+        reader = writer = None
+        while time.monotonic() < deadline:
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+                start = time.perf_counter()
+                first: List[float] = []
+                writer.write(requests[name])
+                head = await reader.readuntil(b'\r\n\r\n')
+                if not head.startswith(b'HTTP/1.1 200'):
+                    raise ValueError(head.split(b'\r\n', 1)[0])
+                if name != 'sse':
+                    result.ttfb.append((time.perf_counter() - start) * 1000)
+                size = await _read_response_body(
+                    reader, head, lambda: first.append(time.perf_counter())
+                )
+                if name == 'sse' and first:
+                    result.ttfb.append((first[0] - start) * 1000)
+                result.latencies.append((time.perf_counter() - start) * 1000)
+                result.completed += 1
+                result.bytes += len(head) + size
+            except errors:
+                result.errors += 1
+                if writer is not None:
+                    writer.close()
+                reader = writer = None
+                await asyncio.sleep(0.01)
+        if writer is not None:
+            writer.close()
+
+    async def tunnel_client(deadline: float):
+        result = stats['tunnel']
+        while time.monotonic() < deadline:
+            writer = None
+            try:
+                start = time.perf_counter()
+                reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+                writer.write(connect)
+                head = await reader.readuntil(b'\r\n\r\n')
+                if head.split(b' ', 2)[1] != b'200':
+                    raise ValueError(head.split(b'\r\n', 1)[0])
+                result.ttfb.append((time.perf_counter() - start) * 1000)
+                end = min(deadline, time.monotonic() + tunnel_duration)
+                while time.monotonic() < end:
+                    sent = time.perf_counter()
+                    writer.write(record)
+                    await reader.readexactly(len(record))
+                    result.latencies.append((time.perf_counter() - sent) * 1000)
+                    result.bytes += len(record)
+                    await asyncio.sleep(tunnel_interval)
+                result.completed += 1
+            except errors:
+                result.errors += 1
+                await asyncio.sleep(0.01)
+            finally:
+                if writer is not None:
+                    writer.close()
+
+    async def main():
+        deadline = time.monotonic() + duration
+        clients = []
+        for name, count in connections.items():
+            for _ in range(count):
+                clients.append(tunnel_client(deadline) if name == 'tunnel' else http_client(name, deadline))
+        await asyncio.gather(*clients)
+
+    asyncio.run(main())
+    results.put({name: result.to_dict() for name, result in stats.items()})
+
+
+def _summarize(parts: List[dict], duration: float) -> dict:
+    latencies = sorted(x for part in parts for x in part['latencies'])
+    ttfb = sorted(x for part in parts for x in part['ttfb'])
+    completed = sum(part['completed'] for part in parts)
+    total_bytes = sum(part['bytes'] for part in parts)
+    return {
+        'requests': completed,
+        'errors': sum(part['errors'] for part in parts),
+        'rps': round(completed / duration, 1),
+        'throughput_mbps': round(total_bytes * 8 / duration / 1e6, 2),
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'ttfb_p50_ms': percentile(ttfb, 50),
+        'ttfb_p99_ms': percentile(ttfb, 99),
+    }
+
+
+def run_load(
+    proxy_port: int,
+    origin_port: int,
+    processes: int = 2,
+    connections: int = 64,
+    duration: float = 10.0,
+    mix: Optional[Dict[str, float]] = None,
+    echo_port: Optional[int] = None,
+    **options,
+) -> dict:
+    """
+    用 processes 个负载进程、共 connections 个连接压测 duration 秒
+
+    mix 为各场景的权重（默认只有 small），连接数按权重分配；options 为
+    _load_main 的隧道参数。只有一个场景时返回汇总结果，否则另含按场景
+    的 "scenarios"。
+    """
+    counts = split_connections(mix or {'small': 1}, connections)
+    # 每个场景的连接尽量均匀地分到各负载进程
+    shares = [
+        {name: count // processes + (i < count % processes) for name, count in counts.items()}
+        for i in range(processes)
+    ]
+    shares = [{name: n for name, n in share.items() if n} for share in shares]
+    shares = [share for share in shares if share]
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    loaders = [
+        context.Process(
+            target=_load_main,
+            args=(results, proxy_port, origin_port, echo_port, share, duration),
+            kwargs=options,
+            daemon=True,
+        )
+        for share in shares
+    ]
+    start = time.monotonic()
+    for process in loaders:
+        process.start()
+    parts = [results.get() for _ in loaders]
+    elapsed = time.monotonic() - start
+    for process in loaders:
+        process.join()
+
+    report = _summarize([s for part in parts for s in part.values()], duration)
+    report['elapsed_s'] = round(elapsed, 2)
+    if len(counts) > 1:
+        report['scenarios'] = {
+            name: dict(
+                _summarize([part[name] for part in parts if name in part], duration),
+                connections=count,
+            )
+            for name, count in counts.items()
+        }
+    return report
+
+
+# ---------------------------------------------------------------------------
+# 代理进程的 CPU 和内存
+# ---------------------------------------------------------------------------
+
+def _proc_stat(pid: int) -> Optional[Tuple[int, int]]:
+    """(父进程号, utime + stime 时钟数)，进程不存在时为 None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # 进程名在括号中，可能包含空格
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return int(fields[1]), int(fields[11]) + int(fields[12])
+
+
+def _proc_rss(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class ProcessSampler:
+    """
+    采样代理进程（含 worker 子进程）的 CPU 时间和常驻内存
+
+    读取 /proc，只在 Linux 上有效；其他平台的结果为 None。
+    """
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.supported = os.path.isdir(f'/proc/{pid}')
+        self._ticks = os.sysconf('SC_CLK_TCK') if self.supported else 100
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_cpu = 0.0
+        self._start_time = 0.0
+        self.peak_rss = 0
+        self.rss_samples: List[int] = []
+
+    def _tree(self) -> Dict[int, int]:
+        """{进程号: CPU 时钟数}，包括所有后代进程"""
+        stats = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                stat = _proc_stat(int(entry))
+                if stat is not None:
+                    stats[int(entry)] = stat
+        tree = {}
+        pending = [self.pid]
+        while pending:
+            pid = pending.pop()
+            if pid in stats:
+                tree[pid] = stats[pid][1]
+                pending.extend(child for child, (ppid, _) in stats.items() if ppid == pid)
+        return tree
+
+    def cpu_seconds(self) -> float:
+        return sum(self._tree().values()) / self._ticks
+
+    def rss(self) -> int:
+        return sum(_proc_rss(pid) for pid in self._tree())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = self.rss()
+            self.rss_samples.append(rss)
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def start(self):
+        if not self.supported:
+            return
+        self._start_cpu = self.cpu_seconds()
+        self._start_time = time.monotonic()
+        self._thread = threading.Thread(target=self._sample, name='bench-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> dict:
+        """结束采样，返回 CPU 占用（100 为一个核）和内存"""
+        if not self.supported:
+            return {'cpu_percent': None, 'cpu_seconds': None, 'rss_mb': None, 'peak_rss_mb': None}
+        cpu = self.cpu_seconds() - self._start_cpu
+        elapsed = time.monotonic() - self._start_time
+        self._stop.set()
+        self._thread.join()
+        rss = self.rss()
+        return {
+            'cpu_percent': round(cpu / elapsed * 100, 1) if elapsed > 0 else None,
+            'cpu_seconds': round(cpu, 2),
+            'rss_mb': round(rss / 1e6, 1),
+            'peak_rss_mb': round(max(self.peak_rss, rss) / 1e6, 1),
+        }
+
+
+# ---------------------------------------------------------------------------
+# 代理
+# ---------------------------------------------------------------------------
+
+def start_proxy(port: int, workers: int = 1, extra_args: Optional[List[str]] = None) -> subprocess.Popen:
+    """以子进程启动 proxy_monitor.py（日志输出丢弃）"""
+    command = [
+        sys.executable, os.path.join(HOST_DIR, 'proxy_monitor.py'),
+        '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+    ] + (extra_args or [])
+    proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return proxy
+
+
+def stop_proxy(proxy: subprocess.Popen):
+    proxy.send_signal(2)  # SIGINT，与 Ctrl+C 相同的退出路径
+    try:
+        proxy.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proxy.kill()
+        proxy.wait()
+
+
+def bench_workers(
+    max_workers: int,
+    duration: float,
+    connections: int,
+    load_processes: int,
+    body_size: int,
+) -> dict:
+    """worker 数从 1 到 max_workers 的吞吐量和延迟"""
+    origin_port, _, origin = start_origin(body_size=body_size)
+    results = []
+    try:
+        counts = sorted({1, *[n for n in (2, 4, 8, 16, 32) if n <= max_workers], max_workers})
+        for workers in counts:
+            port = free_port()
+            proxy = start_proxy(port, workers)
+            try:
+                # 预热：建立连接和连接池
+                run_load(port, origin_port, 1, min(connections, 8), 1.0)
+                sampler = ProcessSampler(proxy.pid)
+                sampler.start()
+                result = run_load(port, origin_port, load_processes, connections, duration)
+                result.update(sampler.stop())
+            finally:
+                stop_proxy(proxy)
+            result['workers'] = workers
+            results.append(result)
+            print(json.dumps(result), file=sys.stderr)
+    finally:
+        for process in origin:
+            process.terminate()
+
+    baseline = results[0]['rps'] or 1
+    for result in results:
+        result['speedup'] = round(result['rps'] / baseline, 2)
+    return {
+        'benchmark': 'workers',
+        'cpu_count': os.cpu_count(),
+        'platform': sys.platform,
+        'duration_s': duration,
+        'connections': connections,
+        'load_processes': load_processes,
+        'body_size': body_size,
+        'results': results,
+    }
+
+
+def bench_mix(
+    mix: Dict[str, float],
+    duration: float,
+    connections: int,
+    load_processes: int,
+    workers: int = 1,
+    proxy_args: Optional[List[str]] = None,
+    body_size: int = 1024,
+    large_size: int = 8 * 1024 * 1024,
+    sse_events: int = 20,
+    sse_interval: float = 0.1,
+    tunnel_duration: float = 5.0,
+) -> dict:
+    """混合负载下的吞吐量、延迟和代理的 CPU / 内存"""
+    origin_port, echo_port, origin = start_origin(
+        body_size=body_size, large_size=large_size,
+        sse_events=sse_events, sse_interval=sse_interval,
+    )
+    try:
+        port = free_port()
+        proxy = start_proxy(port, workers, proxy_args)
+        try:
+            run_load(port, origin_port, 1, min(connections, 8), 1.0)
+            sampler = ProcessSampler(proxy.pid)
+            sampler.start()
+            result = run_load(
+                port, origin_port, load_processes, connections, duration,
+                mix=mix, echo_port=echo_port, tunnel_duration=tunnel_duration,
+            )
+            result.update(sampler.stop())
+        finally:
+            stop_proxy(proxy)
+    finally:
+        for process in origin:
+            process.terminate()
+    result['cpu_ms_per_request'] = (
+        round(result['cpu_seconds'] * 1000 / result['requests'], 3)
+        if result['cpu_seconds'] is not None and result['requests'] else None
+    )
+    return {
+        'benchmark': 'mix',
+        'cpu_count': os.cpu_count(),
+        'platform': sys.platform,
+        'python': sys.version.split()[0],
+        'duration_s': duration,
+        'connections': connections,
+        'load_processes': load_processes,
+        'workers': workers,
+        'proxy_args': proxy_args or [],
+        'mix': mix,
+        'body_size': body_size,
+        'large_size': large_size,
+        'sse': {'events': sse_events, 'interval_s': sse_interval},
+        'tunnel_duration_s': tunnel_duration,
+        'result': result,
+    }
+
+
+def compare_reports(baseline: dict, report: dict, tolerance: float) -> List[str]:
+    """
+    与基线比较混合负载的结果，返回变差超过 tolerance（比例）的指标
+
+    比较总体和每个场景的 rps / throughput_mbps（越大越好）以及 p99_ms /
+    ttfb_p99_ms（越小越好）。
+    """
+    regressions = []
+
+    def check(name: str, old: dict, new: dict):
+        for key in ('rps', 'throughput_mbps'):
+            if old.get(key) and new.get(key) is not None and new[key] < old[key] * (1 - tolerance):
+                regressions.append(f"{name} {key}: {old[key]} -> {new[key]}")
+        for key in ('p99_ms', 'ttfb_p99_ms'):
+            if old.get(key) and new.get(key) is not None and new[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {old[key]} -> {new[key]}")
+
+    old, new = baseline['result'], report['result']
+    check('total', old, new)
+    for scenario, values in new.get('scenarios', {}).items():
+        if scenario in old.get('scenarios', {}):
+            check(scenario, old['scenarios'][scenario], values)
+    return regressions
+
+
+# ---------------------------------------------------------------------------
+# 访问策略
+# ---------------------------------------------------------------------------
+
+def _policy_rules(count: int, rng: random.Random) -> List[Rule]:
+    """60% 精确主机、30% 通配后缀、10% 地址段"""
+    rules = []
+    for i in range(count):
+        kind = i % 10
+        action = 'deny' if i % 3 == 0 else 'allow'
+        if kind < 6:
+            pattern = f"h{i}.d{i % 1000}.example{i % 50}.com"
+        elif kind < 9:
+            pattern = f"*.d{i}.cdn{i % 100}.net"
+        else:
+            prefixlen = rng.choice((16, 20, 24, 28, 32))
+            address = rng.getrandbits(32) >> (32 - prefixlen) << (32 - prefixlen)
+            pattern = f"{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}/{prefixlen}"
+        rules.append(Rule(pattern, action))
+    return rules
+
+
+def _policy_queries(count: int, size: int, rng: random.Random) -> List[str]:
+    """命中精确规则、命中通配规则、未命中的主机和 IP 各占四分之一"""
+    queries = []
+    for n in range(size):
+        i = rng.randrange(count)
+        kind = n % 4
+        if kind == 0:
+            i -= i % 10  # 精确主机规则的下标
+            queries.append(f"h{i}.d{i % 1000}.example{i % 50}.com")
+        elif kind == 1:
+            i = i - i % 10 + 6  # 通配规则的下标
+            queries.append(f"files.v{n}.d{i}.cdn{i % 100}.net")
+        elif kind == 2:
+            queries.append(f"www.unmatched{n}.example.org")
+        else:
+            queries.append(f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}")
+    return queries
+
+
+def bench_policy(rule_counts: List[int], lookups: int) -> dict:
+    """编译时间和单次匹配开销随规则数的变化"""
+    rng = random.Random(0)
+    results = []
+    for count in rule_counts:
+        rules = _policy_rules(count, rng)
+        start = time.perf_counter()
+        policy = Policy(rules, default='allow')
+        compile_ms = (time.perf_counter() - start) * 1000
+        engine = PolicyEngine(policy=policy)
+        queries = _policy_queries(count, 10000, rng)
+        rounds = max(1, lookups // len(queries))
+
+        matched = sum(policy.match(host) is not policy.default_rule for host in queries)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for host in queries:
+                policy.match(host)
+        match_ns = (time.perf_counter() - start) / (rounds * len(queries)) * 1e9
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for host in queries:
+                engine.check(host, '192.168.5.15')
+        check_ns = (time.perf_counter() - start) / (rounds * len(queries)) * 1e9
+
+        result = {
+            'rules': count,
+            'compile_ms': round(compile_ms, 1),
+            'match_ns': round(match_ns),
+            'check_ns': round(check_ns),
+            'matched_ratio': round(matched / len(queries), 3),
+        }
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+    return {
+        'benchmark': 'policy',
+        'platform': sys.platform,
+        'python': sys.version.split()[0],
+        'lookups_per_run': rounds * 10000,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cowork proxy on loopback")
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file')
+    sub = parser.add_subparsers(dest='command')
+
+    workers = sub.add_parser('workers', help='Scale --workers from 1 to N')
+    workers.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    workers.add_argument('--duration', type=float, default=10.0, help='Seconds per run (default: 10)')
+    workers.add_argument('--connections', type=int, default=64, help='Concurrent client connections')
+    workers.add_argument('--load-processes', type=int, default=2, help='Load generator processes')
+    workers.add_argument('--body-size', type=int, default=1024, help='Origin response size in bytes')
+
+    mix = sub.add_parser('mix', help='Mixed GET / download / SSE / CONNECT load against one proxy')
+    mix.add_argument('--mix', default='small=48,large=4,sse=8,tunnel=4',
+                     help='Scenario weights used to split --connections '
+                          '(default: small=48,large=4,sse=8,tunnel=4)')
+    mix.add_argument('--duration', type=float, default=20.0, help='Seconds to run (default: 20)')
+    mix.add_argument('--connections', type=int, default=64, help='Concurrent client connections')
+    mix.add_argument('--load-processes', type=int, default=2, help='Load generator processes')
+    mix.add_argument('--workers', type=int, default=1, help='Proxy worker processes')
+    mix.add_argument('--proxy-args', default='',
+                     help='Extra proxy_monitor.py arguments, e.g. "--idle-timeout 60"')
+    mix.add_argument('--body-size', type=int, default=1024, help='Small response size in bytes')
+    mix.add_argument('--large-size', type=int, default=8 * 1024 * 1024,
+                     help='Download size in bytes (default: 8 MiB)')
+    mix.add_argument('--sse-events', type=int, default=20, help='Events per SSE stream')
+    mix.add_argument('--sse-interval', type=float, default=0.1, help='Seconds between SSE events')
+    mix.add_argument('--tunnel-duration', type=float, default=5.0, help='Seconds each tunnel stays open')
+    mix.add_argument('--baseline', help='Compare with an earlier mix report; exit 1 on regression')
+    mix.add_argument('--tolerance', type=float, default=0.1,
+                     help='Allowed relative regression against --baseline (default: 0.1)')
+
+    policy = sub.add_parser('policy', help='Policy matching cost against the number of rules')
+    policy.add_argument('--rules', default='100,1000,10000,100000',
+                        help='Comma-separated rule counts (default: 100,1000,10000,100000)')
+    policy.add_argument('--lookups', type=int, default=200000, help='Lookups per rule count')
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        return
+
+    regressions = []
+    if args.command == 'policy':
+        report = bench_policy([int(n) for n in args.rules.split(',')], args.lookups)
+    elif args.command == 'mix':
+        try:
+            weights = parse_mix(args.mix)
+        except ValueError as e:
+            parser.error(str(e))
+        report = bench_mix(
+            weights, args.duration, args.connections, args.load_processes,
+            workers=args.workers, proxy_args=shlex.split(args.proxy_args),
+            body_size=args.body_size, large_size=args.large_size,
+            sse_events=args.sse_events, sse_interval=args.sse_interval,
+            tunnel_duration=args.tunnel_duration,
+        )
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_reports(json.load(f), report, args.tolerance)
+            report['regressions'] = regressions
+    else:
+        report = bench_workers(
+            args.max_workers, args.duration, args.connections, args.load_processes, args.body_size
+        )
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+代理的 DNS 缓存和并行连接
+
+asyncio 的 open_connection / create_connection 每次都在线程池中调用一次系统
+getaddrinfo，VM 连续下载大量依赖时同一个主机会被反复解析。DnsCache 在进程内
+缓存解析结果：
+
+- 成功的结果缓存 ttl 秒（系统解析器不返回记录的 TTL，使用固定值）
+- 解析失败缓存 negative_ttl 秒，避免对不存在的主机反复查询
+- 剩余寿命不足 20% 时被访问的条目在后台刷新，请求不等待解析；刷新失败时
+  继续使用旧结果直到过期
+- 同一主机的并发解析只查询一次
+- 条目数超过 max_entries 时按 LRU 淘汰
+
+连接时按 RFC 8305（Happy Eyeballs v2）交替 IPv6 / IPv4 地址，每隔 delay 秒
+并行发起下一个连接尝试，第一个成功的连接胜出，其余取消。某个地址不可达时
+不必等待它超时。
+"""
+
+import asyncio
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# 成功 / 失败结果的缓存时间（秒）
+DEFAULT_TTL = 60.0
+NEGATIVE_TTL = 5.0
+# 条目经过 TTL 的这个比例后被访问，就在后台刷新
+REFRESH_AHEAD = 0.8
+# 并行连接尝试的间隔（RFC 8305 建议 250ms）
+HAPPY_EYEBALLS_DELAY = 0.25
+
+
+@dataclass
+class _Entry:
+    addresses: List[Tuple[int, tuple]]  # [(family, sockaddr)]，sockaddr 中的端口为 0
+    error: Optional[str]
+    stored: float
+    ttl: float
+
+    def expired(self, now: float) -> bool:
+        return now - self.stored >= self.ttl
+
+
+def interleave(addresses: List[Tuple[int, tuple]]) -> List[Tuple[int, tuple]]:
+    """按地址族交替排列（保持解析器给出的首选地址族在前）"""
+    if not addresses:
+        return []
+    first = addresses[0][0]
+    preferred = [a for a in addresses if a[0] == first]
+    others = [a for a in addresses if a[0] != first]
+    result = []
+    for i in range(max(len(preferred), len(others))):
+        if i < len(preferred):
+            result.append(preferred[i])
+        if i < len(others):
+            result.append(others[i])
+    return result
+
+
+def _with_port(sockaddr: tuple, port: int) -> tuple:
+    return (sockaddr[0], port) + tuple(sockaddr[2:])
+
+
+async def _attempt(loop: asyncio.AbstractEventLoop, family: int, sockaddr: tuple) -> socket.socket:
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, sockaddr)
+        return sock
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def happy_eyeballs_connect(
+    addresses: List[Tuple[int, tuple]],
+    port: int,
+    delay: float = HAPPY_EYEBALLS_DELAY,
+) -> socket.socket:
+    """
+    并行尝试连接 addresses，返回第一个连接成功的 socket
+
+    上一个尝试失败时立即开始下一个；否则每隔 delay 秒追加一个尝试。
+    全部失败时抛出 OSError（只有一个地址时为原始异常）。
+    """
+    loop = asyncio.get_running_loop()
+    remaining = [(family, _with_port(sockaddr, port)) for family, sockaddr in interleave(addresses)]
+    pending: Set[asyncio.Task] = set()
+    errors: List[BaseException] = []
+    winner: Optional[socket.socket] = None
+    try:
+        while remaining or pending:
+            if remaining:
+                family, sockaddr = remaining.pop(0)
+                pending.add(loop.create_task(_attempt(loop, family, sockaddr)))
+            done, pending = await asyncio.wait(
+                pending, timeout=delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()
+            if winner is not None:
+                return winner
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, socket.socket):
+                result.close()
+
+    if len(errors) == 1:
+        raise errors[0]
+    raise OSError(f"Multiple exceptions: {', '.join(str(e) for e in errors)}")
+
+
+class DnsCache:
+    """
+    进程内的 DNS 缓存（在事件循环线程中使用）
+
+    Args:
+        ttl: 成功结果的缓存时间（秒）
+        negative_ttl: 解析失败的缓存时间（秒）
+        max_entries: 最多缓存的主机数
+        resolve_timeout: 单次解析的超时（秒）
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_TTL,
+        negative_ttl: float = NEGATIVE_TTL,
+        max_entries: int = 4096,
+        resolve_timeout: float = 10.0,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.resolve_timeout = resolve_timeout
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.refreshes = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def resolve(self, host: str) -> List[Tuple[int, tuple]]:
+        """解析 host，返回 [(family, sockaddr)]；失败时抛出 socket.gaierror"""
+        try:
+            ip = ipaddress.ip_address(host.strip('[]'))
+        except ValueError:
+            pass
+        else:
+            if ip.version == 6:
+                return [(socket.AF_INET6, (str(ip), 0, 0, 0))]
+            return [(socket.AF_INET, (str(ip), 0))]
+
+        now = time.monotonic()
+        entry = self._entries.get(host)
+        if entry is not None and not entry.expired(now):
+            self._entries.move_to_end(host)
+            self.hits += 1
+            if (
+                entry.error is None
+                and now - entry.stored >= entry.ttl * REFRESH_AHEAD
+                and host not in self._inflight
+            ):
+                self._refresh(host)
+            return self._result(host, entry)
+
+        self.misses += 1
+        return self._result(host, await self._lookup(host))
+
+    def _result(self, host: str, entry: _Entry) -> List[Tuple[int, tuple]]:
+        if entry.error is not None:
+            raise socket.gaierror(socket.EAI_NONAME, f"DNS lookup failed for {host}: {entry.error}")
+        return entry.addresses
+
+    def _refresh(self, host: str):
+        """后台刷新（结果替换缓存条目；失败时保留旧条目）"""
+        self.refreshes += 1
+        self._start_lookup(host, keep_stale=True)
+
+    async def _lookup(self, host: str) -> _Entry:
+        # 查询在独立的任务中进行：等待者被取消（如连接超时）不会中断其他等待者
+        return await asyncio.shield(self._start_lookup(host))
+
+    def _start_lookup(self, host: str, keep_stale: bool = False) -> asyncio.Task:
+        """开始查询（同一主机的并发查询共享一个任务）"""
+        task = self._inflight.get(host)
+        if task is None:
+            task = self._inflight[host] = asyncio.ensure_future(self._query(host, keep_stale))
+
+            def done(_):
+                if self._inflight.get(host) is task:
+                    del self._inflight[host]
+
+            task.add_done_callback(done)
+        return task
+
+    async def _query(self, host: str, keep_stale: bool) -> _Entry:
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await asyncio.wait_for(
+                loop.getaddrinfo(host, None, type=socket.SOCK_STREAM),
+                self.resolve_timeout,
+            )
+            addresses = list(dict.fromkeys((family, sockaddr) for family, _, _, _, sockaddr in infos))
+            entry = _Entry(addresses, None, time.monotonic(), self.ttl)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.failures += 1
+            # 过期后加入同一查询的等待者不应拿到旧结果
+            old = self._entries.get(host)
+            if keep_stale and old is not None and old.error is None and not old.expired(time.monotonic()):
+                return old
+            message = (
+                getattr(e, 'strerror', None) or str(e)
+                or f"timed out after {self.resolve_timeout:g}s"
+            )
+            entry = _Entry([], message, time.monotonic(), self.negative_ttl)
+
+        self._entries[host] = entry
+        self._entries.move_to_end(host)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def connect(
+        self,
+        host: str,
+        port: int,
+        timeout: float,
+        delay: float = HAPPY_EYEBALLS_DELAY,
+        address_filter: Optional[Callable[[str], bool]] = None,
+    ) -> Tuple[socket.socket, float, float]:
+        """
+        解析并连接 host:port
+
+        address_filter 返回 False 的地址不会被连接；没有可用地址时抛出 PermissionError。
+
+        Returns:
+            (已连接的非阻塞 socket, 解析耗时 ms, 建立 TCP 连接耗时 ms)
+        """
+        start = time.monotonic()
+        addresses = await self.resolve(host)
+        if address_filter is not None:
+            addresses = [a for a in addresses if address_filter(a[1][0])]
+            if not addresses:
+                raise PermissionError(f"{host} resolves to an address blocked by proxy policy")
+        resolved = time.monotonic()
+        try:
+            sock = await asyncio.wait_for(happy_eyeballs_connect(addresses, port, delay), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Connect to {host}:{port} timed out after {timeout:g}s") from None
+        return sock, (resolved - start) * 1000, (time.monotonic() - resolved) * 1000
+
+    def invalidate(self, host: str):
+        self._entries.pop(host, None)
+
+    def close(self):
+        for task in self._inflight.values():
+            task.cancel()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "refreshes": self.refreshes,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+代理监控的本地 HTTP 接口
+
+在代理所在的事件循环中额外监听一个端口（默认只绑定 127.0.0.1）：
+- GET /metrics  Prometheus 文本格式
+- GET /stats    统计信息（JSON，与导出文件中的 stats 相同）
+- GET /recent   最近的请求日志（JSON），支持 n / host / status / method / errors /
+                sandbox / job 参数
+
+统计在锁内只做复制，分位数计算和序列化放到线程池中进行，不阻塞代理的数据路径。
+"""
+
+import asyncio
+import http.client
+import ipaddress
+import json
+import math
+import time
+from typing import List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+# /recent 单次最多返回的记录数
+MAX_RECENT = 1000
+# 请求头最大长度
+MAX_REQUEST_HEAD = 16 * 1024
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+QUANTILES = (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items()) + '}'
+
+
+def _number(value) -> str:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NaN'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _Exposition:
+    """按指标分组输出 HELP / TYPE 和样本行"""
+
+    def __init__(self, prefix: str = 'cowork_proxy_'):
+        self.prefix = prefix
+        self.lines: List[str] = []
+
+    def metric(self, name: str, kind: str, help_text: str, samples):
+        """samples: [(后缀, 标签字典, 值)]"""
+        name = self.prefix + name
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+        for suffix, labels, value in samples:
+            self.lines.append(f'{name}{suffix}{_labels(**labels)} {_number(value)}')
+
+    def render(self) -> str:
+        return '\n'.join(self.lines) + '\n'
+
+
+def _latency_samples(histograms, **labels) -> list:
+    """把各阶段的 LatencyHistogram 转成 Prometheus summary 样本（单位：秒）"""
+    samples = []
+    for phase, histogram in histograms.items():
+        summary = histogram.summary()
+        for quantile, key in QUANTILES:
+            value = summary[key]
+            samples.append((
+                '', dict(labels, phase=phase, quantile=quantile),
+                round(value / 1000, 6) if value is not None else None,
+            ))
+        samples.append(('_sum', dict(labels, phase=phase), histogram.total_ms / 1000))
+        samples.append(('_count', dict(labels, phase=phase), histogram.count))
+    return samples
+
+
+def _account_metrics(out: _Exposition, name: str, label: str, accounts):
+    """按沙箱或任务输出请求数、字节数和延迟"""
+    entries = accounts.top()
+    out.metric(f'{name}_requests_total', 'counter', f'Requests per {label}.',
+               [('', {label: key}, usage.requests) for key, usage in entries])
+    out.metric(f'{name}_failed_total', 'counter', f'Failed requests per {label}.',
+               [('', {label: key}, usage.failed) for key, usage in entries])
+    out.metric(f'{name}_bytes_total', 'counter', f'Bytes relayed per {label} and direction.',
+               [('', {label: key, 'direction': direction}, value)
+                for key, usage in entries
+                for direction, value in (('up', usage.bytes_up), ('down', usage.bytes_down))])
+    samples = []
+    for key, usage in entries:
+        samples.extend(_latency_samples(usage.latency, **{label: key}))
+    out.metric(f'{name}_latency_seconds', 'summary', f'Request latency per {label} and phase.', samples)
+
+
+def render_prometheus(
+    stats, active_connections: int = 0, archive=None, cache=None, dns=None,
+    pending_connections: int = 0,
+) -> str:
+    """
+    把 ProxyStats（通常是快照）渲染为 Prometheus 文本格式
+
+    按主机的计数只包含 Top-K 主机（Space-Saving），数值为高估上限。
+    """
+    out = _Exposition()
+    out.metric('requests_total', 'counter', 'Requests handled (HTTP requests and CONNECT tunnels).',
+               [('', {}, stats.total_requests)])
+    out.metric('requests_failed_total', 'counter', 'Requests that ended with a proxy error.',
+               [('', {}, stats.failed_requests)])
+    out.metric('response_bytes_total', 'counter', 'Response bytes relayed to clients.',
+               [('', {}, stats.total_bytes)])
+    out.metric('unique_hosts', 'gauge', 'Estimated number of distinct hosts (HyperLogLog).',
+               [('', {}, stats.unique_hosts.count())])
+    out.metric('host_requests_total', 'counter', 'Requests per host (top hosts only).',
+               [('', {'host': host}, n) for host, n, _ in stats.requests_by_host.top()])
+    out.metric('host_response_bytes_total', 'counter', 'Response bytes per host (top hosts only).',
+               [('', {'host': host}, n) for host, n, _ in stats.bytes_by_host.top()])
+    out.metric('active_connections', 'gauge', 'Open client connections.',
+               [('', {}, active_connections)])
+    out.metric('pending_connections', 'gauge', 'Client connections waiting for a free slot.',
+               [('', {}, pending_connections)])
+    out.metric('client_connections_total', 'counter', 'Accepted client connections.',
+               [('', {}, stats.client_connections)])
+    out.metric('connections_rejected_total', 'counter', 'Connections rejected with 503 by admission control.',
+               [('', {'reason': 'overload'}, stats.rejected_overload),
+                ('', {'reason': 'client_limit'}, stats.rejected_client_limit)])
+    out.metric('timeouts_total', 'counter', 'Connections closed by a timeout.',
+               [('', {'kind': 'header'}, stats.timeouts_header),
+                ('', {'kind': 'keepalive_idle'}, stats.timeouts_keepalive),
+                ('', {'kind': 'idle'}, stats.timeouts_idle),
+                ('', {'kind': 'lifetime'}, stats.timeouts_lifetime)])
+    out.metric('client_requests_total', 'counter', 'HTTP requests received from clients.',
+               [('', {}, stats.client_requests)])
+    out.metric('upstream_connections_total', 'counter', 'Upstream connections opened.',
+               [('', {}, stats.upstream_connections)])
+    out.metric('upstream_requests_total', 'counter', 'HTTP requests sent upstream.',
+               [('', {}, stats.upstream_requests)])
+    out.metric('upstream_reused_total', 'counter', 'Upstream requests sent on a pooled connection.',
+               [('', {}, stats.upstream_reused)])
+    out.metric('upstream_evicted_total', 'counter', 'Pooled upstream connections closed as idle or stale.',
+               [('', {}, stats.upstream_evicted)])
+    out.metric('cache_requests_total', 'counter', 'Cacheable requests by cache result.',
+               [('', {'result': 'hit'}, stats.cache_hits),
+                ('', {'result': 'revalidated'}, stats.cache_revalidated),
+                ('', {'result': 'miss'}, stats.cache_misses)])
+    out.metric('cache_served_bytes_total', 'counter', 'Response bytes served from the HTTP cache.',
+               [('', {}, stats.cache_bytes_served)])
+    out.metric('policy_denied_total', 'counter', 'Requests blocked by the access policy.',
+               [('', {}, stats.policy_denied)])
+    out.metric('rate_limited_total', 'counter', 'Requests rejected by a request rate limit.',
+               [('', {}, stats.rate_limited)])
+    if cache is not None:
+        cache_stats = cache.stats()
+        out.metric('cache_entries', 'gauge', 'Entries in the HTTP cache.',
+                   [('', {}, cache_stats['entries'])])
+        out.metric('cache_bytes', 'gauge', 'Bytes stored in the HTTP cache.',
+                   [('', {}, cache_stats['bytes'])])
+        out.metric('cache_evictions_total', 'counter', 'HTTP cache entries evicted by the size limit.',
+                   [('', {}, cache_stats['evictions'])])
+    if dns is not None:
+        dns_stats = dns.stats()
+        out.metric('dns_lookups_total', 'counter', 'Upstream host lookups by DNS cache result.',
+                   [('', {'result': 'hit'}, dns_stats['hits']),
+                    ('', {'result': 'miss'}, dns_stats['misses'])])
+        out.metric('dns_failures_total', 'counter', 'Failed DNS resolutions.',
+                   [('', {}, dns_stats['failures'])])
+        out.metric('dns_cache_entries', 'gauge', 'Hosts in the DNS cache.',
+                   [('', {}, dns_stats['entries'])])
+    # 没有沙箱名的请求按客户端地址归属
+    _account_metrics(out, 'sandbox', 'sandbox', stats.by_sandbox)
+    _account_metrics(out, 'job', 'job', stats.by_job)
+    out.metric('latency_seconds', 'summary', 'Request latency by phase (dns, connect, ttfb, total).',
+               _latency_samples(stats.latency))
+    host_samples = []
+    for host, phases in stats.host_latency.items():
+        host_samples.extend(_latency_samples(phases, host=host))
+    out.metric('host_latency_seconds', 'summary', 'Request latency by host and phase.', host_samples)
+    if archive is not None:
+        out.metric('archive_written_total', 'counter', 'Request logs written to the SQLite archive.',
+                   [('', {}, archive.written)])
+        out.metric('archive_dropped_total', 'counter', 'Request logs dropped by the SQLite archive.',
+                   [('', {}, archive.dropped)])
+    out.metric('uptime_seconds', 'gauge', 'Seconds since the proxy started.',
+               [('', {}, time.time() - stats.start_time)])
+    return out.render()
+
+
+def _is_loopback(peer) -> bool:
+    try:
+        return ipaddress.ip_address(peer[0]).is_loopback
+    except (TypeError, ValueError, IndexError):
+        # Unix socket 等没有 IP 地址的连接
+        return True
+
+
+class MetricsServer:
+    """
+    /metrics、/stats、/recent 接口
+
+    Args:
+        monitor: ProxyMonitor
+        proxy: ProxyServer（可选，用于活动连接数）
+        host: 监听地址，默认只监听本机
+        port: 监听端口
+        allow_remote: 为 False 时拒绝非回环地址的客户端（即使监听在 0.0.0.0）
+    """
+
+    def __init__(
+        self,
+        monitor,
+        proxy=None,
+        host: str = '127.0.0.1',
+        port: int = 7891,
+        allow_remote: bool = False,
+    ):
+        self.monitor = monitor
+        self.proxy = proxy
+        self.host = host
+        self.port = port
+        self.allow_remote = allow_remote
+        self.scrapes = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle, self.host, self.port, limit=MAX_REQUEST_HEAD, reuse_address=True
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    def _active_connections(self) -> int:
+        return self.proxy.active_connections if self.proxy is not None else 0
+
+    def _pending_connections(self) -> int:
+        return getattr(self.proxy, 'pending_connections', 0)
+
+    def _metrics(self) -> bytes:
+        stats = self.monitor.snapshot_stats()
+        return render_prometheus(
+            stats, self._active_connections(), getattr(self.monitor, 'archive', None),
+            getattr(self.proxy, 'cache', None), getattr(self.proxy, 'dns', None),
+            self._pending_connections(),
+        ).encode('utf-8')
+
+    def _stats(self) -> bytes:
+        data = self.monitor.snapshot_stats().to_dict()
+        data['active_connections'] = self._active_connections()
+        data['pending_connections'] = self._pending_connections()
+        if self.proxy is not None:
+            data['peak_connections'] = self.proxy.peak_connections
+            cache = getattr(self.proxy, 'cache', None)
+            if cache is not None:
+                data['cache'].update(cache.stats())
+            dns = getattr(self.proxy, 'dns', None)
+            if dns is not None:
+                data['dns'] = dns.stats()
+        return json.dumps(data).encode('utf-8')
+
+    def _recent(self, query: dict) -> bytes:
+        def first(name):
+            values = query.get(name)
+            return values[0] if values else None
+
+        count = min(int(first('n') or 100), MAX_RECENT)
+        status = first('status')
+        logs = self.monitor.query_logs(
+            host=first('host'),
+            status=int(status) if status else None,
+            method=first('method'),
+            errors_only=first('errors') in ('1', 'true', 'yes'),
+            limit=count,
+            sandbox=first('sandbox'),
+            job=first('job'),
+        )
+        return json.dumps(logs).encode('utf-8')
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            if not self.allow_remote and not _is_loopback(writer.get_extra_info('peername')):
+                await self._respond(writer, 403, b'Forbidden\n')
+                return
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+                method, target, _ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                    ConnectionError):
+                return
+            except ValueError:
+                await self._respond(writer, 400, b'Bad Request\n')
+                return
+            if method not in ('GET', 'HEAD'):
+                await self._respond(writer, 405, b'Method Not Allowed\n')
+                return
+
+            url = urlsplit(target)
+            loop = asyncio.get_running_loop()
+            if url.path == '/metrics':
+                self.scrapes += 1
+                body = await loop.run_in_executor(None, self._metrics)
+                content_type = PROMETHEUS_CONTENT_TYPE
+            elif url.path == '/stats':
+                body = await loop.run_in_executor(None, self._stats)
+                content_type = 'application/json'
+            elif url.path == '/recent':
+                try:
+                    body = await loop.run_in_executor(None, self._recent, parse_qs(url.query))
+                except ValueError as e:
+                    await self._respond(writer, 400, f'Bad Request: {e}\n'.encode('utf-8'))
+                    return
+                content_type = 'application/json'
+            else:
+                await self._respond(writer, 404, b'Not Found\n')
+                return
+            await self._respond(writer, 200, body, content_type, head_only=method == 'HEAD')
+        except Exception as e:
+            self.monitor.logger.debug(f"Metrics endpoint error: {e}")
+        finally:
+            writer.close()
+
+    async def _respond(
+        self,
+        writer: asyncio.StreamWriter,
+        code: int,
+        body: bytes,
+        content_type: str = 'text/plain; charset=utf-8',
+        head_only: bool = False,
+    ):
+        writer.write(
+            f"HTTP/1.1 {code} {http.client.responses[code]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Cache-Control: no-store\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + (b'' if head_only else body)
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+代理监控的统计结构
+
+- LatencyHistogram：HDR 风格的对数分桶延迟直方图，内存固定，记录为 O(1)
+- HyperLogLog：近似不同元素计数（独立主机数），内存固定
+- SpaceSaving：固定大小的 Top-K 高频项统计（按主机的请求数 / 字节数）
+"""
+
+import hashlib
+import math
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+
+class LatencyHistogram:
+    """
+    HDR 风格的延迟直方图（单位：毫秒，内部按微秒分桶）
+
+    小于 16µs 的值每微秒一个桶；更大的值每个 2 的幂区间再等分为 16 个子桶，
+    因此任意分位数的相对误差不超过 1/16（6.25%）。最大可记录约 50 天，
+    每个直方图固定占用约 2.5 KB。
+    """
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    MAX_BITS = 42  # 2^42 微秒 ≈ 50 天
+    BUCKETS = (MAX_BITS - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+
+    __slots__ = ('counts', 'count', 'total_ms', 'min_ms', 'max_ms')
+
+    def __init__(self):
+        self.counts = array('I', bytes(4 * self.BUCKETS))
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = math.inf
+        self.max_ms = 0.0
+
+    @classmethod
+    def _index(cls, us: int) -> int:
+        if us < cls.SUB_BUCKETS:
+            return max(us, 0)
+        shift = us.bit_length() - cls.SUB_BUCKET_BITS - 1
+        index = shift * cls.SUB_BUCKETS + (us >> shift)
+        return min(index, cls.BUCKETS - 1)
+
+    @classmethod
+    def _bounds_us(cls, index: int) -> tuple:
+        """桶 index 覆盖的微秒区间 [low, high)"""
+        if index < cls.SUB_BUCKETS:
+            return index, index + 1
+        shift = index // cls.SUB_BUCKETS - 1
+        sub = index - shift * cls.SUB_BUCKETS
+        return sub << shift, (sub + 1) << shift
+
+    def record(self, value_ms: float):
+        """记录一个延迟值（毫秒）"""
+        self.counts[self._index(int(value_ms * 1000))] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        if value_ms < self.min_ms:
+            self.min_ms = value_ms
+        if value_ms > self.max_ms:
+            self.max_ms = value_ms
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """第 pct 百分位的延迟（毫秒），没有数据时返回 None"""
+        if not self.count:
+            return None
+        target = max(1, math.ceil(pct / 100 * self.count))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            if not n:
+                continue
+            seen += n
+            if seen >= target:
+                low, high = self._bounds_us(index)
+                value = (low + high) / 2 / 1000
+                return min(max(value, self.min_ms), self.max_ms)
+        return self.max_ms
+
+    def copy(self) -> 'LatencyHistogram':
+        clone = LatencyHistogram.__new__(LatencyHistogram)
+        clone.counts = array('I', self.counts)
+        clone.count = self.count
+        clone.total_ms = self.total_ms
+        clone.min_ms = self.min_ms
+        clone.max_ms = self.max_ms
+        return clone
+
+    def merge(self, other: 'LatencyHistogram'):
+        """合并另一个直方图"""
+        for index, n in enumerate(other.counts):
+            if n:
+                self.counts[index] += n
+        self.count += other.count
+        self.total_ms += other.total_ms
+        self.min_ms = min(self.min_ms, other.min_ms)
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        """count / mean / p50 / p90 / p99 / max（一次遍历计算所有分位数）"""
+        if not self.count:
+            return {"count": 0, "mean": None, "p50": None, "p90": None, "p99": None, "max": None}
+        result = {"count": self.count, "mean": round(self.total_ms / self.count, 3)}
+        targets = [(name, max(1, math.ceil(pct / 100 * self.count)))
+                   for name, pct in (("p50", 50), ("p90", 90), ("p99", 99))]
+        seen = 0
+        for index, n in enumerate(self.counts):
+            if not n:
+                continue
+            seen += n
+            while targets and seen >= targets[0][1]:
+                low, high = self._bounds_us(index)
+                value = min(max((low + high) / 2 / 1000, self.min_ms), self.max_ms)
+                result[targets.pop(0)[0]] = round(value, 3)
+            if not targets:
+                break
+        result["max"] = round(self.max_ms, 3)
+        return result
+
+
+class HyperLogLog:
+    """
+    HyperLogLog 近似基数估计
+
+    2^precision 个寄存器，每个 1 字节；默认 precision=12 占用 4 KB，
+    标准误差约 1.04 / sqrt(4096) ≈ 1.6%（约 95% 的估计误差在 ±3.3% 以内）。
+    基数较小时使用线性计数修正，几百个以内的主机基本是精确的。
+    """
+
+    def __init__(self, precision: int = 12):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        self._alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    @staticmethod
+    def _hash(item: str) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(item.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'big'
+        )
+
+    def add(self, item: str):
+        h = self._hash(item)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        # 剩余位中第一个 1 的位置（从 1 开始计）
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> int:
+        """估计的不同元素个数"""
+        estimate = self._alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * self.m:
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    @property
+    def relative_error(self) -> float:
+        """标准误差"""
+        return 1.04 / math.sqrt(self.m)
+
+    def copy(self) -> 'HyperLogLog':
+        clone = HyperLogLog(self.precision)
+        clone.registers = bytearray(self.registers)
+        return clone
+
+    def merge(self, other: 'HyperLogLog'):
+        """合并另一个相同精度的 HyperLogLog（取寄存器最大值）"""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs with different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+
+class SpaceSaving:
+    """
+    Space-Saving Top-K 高频项统计（Metwally 等，2005）
+
+    最多跟踪 capacity 个项。新项在表满时替换当前计数最小的项，并继承其
+    计数作为误差上限。对总权重为 N 的数据流：
+    - 每个被跟踪项的计数是高估值，高估量不超过其 error（≤ N / capacity）
+    - 真实权重超过 N / capacity 的项一定在表中
+    """
+
+    def __init__(self, capacity: int = 100):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.total = 0
+        self._counts: Dict[str, int] = {}
+        self._errors: Dict[str, int] = {}
+
+    def add(self, item: str, weight: int = 1):
+        self.total += weight
+        if item in self._counts:
+            self._counts[item] += weight
+            return
+        if len(self._counts) < self.capacity:
+            self._counts[item] = weight
+            self._errors[item] = 0
+            return
+        victim = min(self._counts, key=self._counts.get)
+        floor = self._counts.pop(victim)
+        del self._errors[victim]
+        self._counts[item] = floor + weight
+        self._errors[item] = floor
+
+    def top(self, k: Optional[int] = None) -> List[Tuple[str, int, int]]:
+        """按计数降序的 (项, 计数, 误差上限)"""
+        items = sorted(self._counts.items(), key=lambda kv: kv[1], reverse=True)
+        if k is not None:
+            items = items[:k]
+        return [(item, count, self._errors[item]) for item, count in items]
+
+    def get(self, item: str) -> int:
+        return self._counts.get(item, 0)
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    @property
+    def max_error(self) -> int:
+        """任一计数的最大高估量（N / capacity 的上限）"""
+        return self.total // self.capacity if len(self._counts) >= self.capacity else 0
+
+    def copy(self) -> 'SpaceSaving':
+        clone = SpaceSaving(self.capacity)
+        clone.total = self.total
+        clone._counts = dict(self._counts)
+        clone._errors = dict(self._errors)
+        return clone
+
+    def merge(self, other: 'SpaceSaving'):
+        """合并另一个 Space-Saving（逐项累加，误差上限随之累加）"""
+        for item, count, error in other.top():
+            if item in self._counts:
+                self._counts[item] += count
+                self._errors[item] += error
+                self.total += count
+            else:
+                self.add(item, count)
+                self._errors[item] += error
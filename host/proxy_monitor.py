@@ -6,24 +6,65 @@
 1. 监控 VM 的网络流量
 2. 记录所有 HTTP/HTTPS 请求
 3. 提供实时日志和统计信息
-4. 支持流量过滤和告警
+4. 支持按主机 / 地址段的访问策略和限速
+5. 按客户端地址、沙箱和任务归属流量并分别统计
 """
 
 import os
 import sys
 import json
+import asyncio
+import logging
 import socket
 import threading
-import logging
 import time
 from datetime import datetime
-from typing import Dict, List, Optional, Set
-from dataclasses import dataclass, field, asdict
+from typing import Callable, Dict, List, Optional, Set
+from dataclasses import dataclass, field, replace
 from collections import defaultdict
-from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
 import http.client
 
+try:
+    from host.proxy_metrics import HyperLogLog, LatencyHistogram, SpaceSaving
+    from host.proxy_store import RequestLogStore
+    from host.proxy_archive import DEFAULT_ARCHIVE_PATH, ProxyArchive
+    from host.proxy_endpoints import MetricsServer
+    from host.proxy_workers import WorkerPool
+    from host.proxy_cache import (
+        DEFAULT_CACHE_DIR, HttpCache, cached_response_head, request_cacheable,
+        request_requires_revalidation,
+    )
+    from host.proxy_dns import DEFAULT_TTL, DnsCache
+    from host.proxy_policy import PolicyEngine, Shaper
+    from host.proxy_accounting import (
+        JOB_HEADER, MAX_JOBS, MAX_SANDBOXES, TrafficAccounts, parse_attribution,
+    )
+    from host.tracing import new_span_id
+    from host.logger import LogPipeline
+except ImportError:  # 作为脚本从 host/ 运行
+    from proxy_metrics import HyperLogLog, LatencyHistogram, SpaceSaving
+    from proxy_store import RequestLogStore
+    from proxy_archive import DEFAULT_ARCHIVE_PATH, ProxyArchive
+    from proxy_endpoints import MetricsServer
+    from proxy_workers import WorkerPool
+    from proxy_cache import (
+        DEFAULT_CACHE_DIR, HttpCache, cached_response_head, request_cacheable,
+        request_requires_revalidation,
+    )
+    from proxy_dns import DEFAULT_TTL, DnsCache
+    from proxy_policy import PolicyEngine, Shaper
+    from proxy_accounting import (
+        JOB_HEADER, MAX_JOBS, MAX_SANDBOXES, TrafficAccounts, parse_attribution,
+    )
+    from tracing import new_span_id
+    from logger import LogPipeline
+
+# 记录延迟直方图的阶段：DNS 解析、建立上游连接、首字节、总耗时
+LATENCY_PHASES = ('dns', 'connect', 'ttfb', 'total')
+# 按主机统计请求数 / 字节数时跟踪的主机数
+TOP_HOSTS = 100
+
 
 @dataclass
 class RequestLog:
@@ -37,6 +78,29 @@ class RequestLog:
     response_size: int = 0
     duration_ms: float = 0.0
     error: Optional[str] = None
+    ttfb_ms: Optional[float] = None  # 收到上游响应头（隧道：上游首字节）的耗时
+    request_size: int = 0
+    close_reason: Optional[str] = None  # 隧道关闭原因
+    connect_ms: Optional[float] = None  # 建立上游 TCP 连接的耗时（复用连接时为 None）
+    cache_status: Optional[str] = None  # HIT / MISS / REVALIDATED（未经过缓存时为 None）
+    dns_ms: Optional[float] = None  # 解析上游主机的耗时（命中 DNS 缓存时接近 0；复用连接时为 None）
+    client: str = ''  # 客户端 IP
+    sandbox: Optional[str] = None  # 代理认证用户名 / X-Cowork-Job 中的沙箱名
+    job: Optional[str] = None  # 代理认证密码 / X-Cowork-Job 中的任务编号
+    trace_id: Optional[str] = None  # 所属 trace（代理认证中的 traceparent 或 traceparent 头部）
+    span_id: Optional[str] = None  # 本请求的 span（有 trace 时生成）
+    parent_span_id: Optional[str] = None  # 发起请求的 span（如控制器的 vm_shell）
+
+    def attribute(self, origin: tuple):
+        """记录请求归属：(客户端地址, 沙箱, 任务, trace, 父 span)"""
+        self.client, self.sandbox, self.job, self.trace_id, self.parent_span_id = origin
+        if self.trace_id:
+            self.span_id = new_span_id()
+
+    @property
+    def source(self) -> str:
+        """按沙箱统计时使用的键：沙箱名，没有时为客户端地址"""
+        return self.sandbox or self.client or '(unknown)'
 
 
 @dataclass
@@ -46,32 +110,206 @@ class ProxyStats:
     successful_requests: int = 0
     failed_requests: int = 0
     total_bytes: int = 0
-    unique_hosts: Set[str] = field(default_factory=set)
-    requests_by_host: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    # 主机维度的统计内存固定：独立主机数用 HyperLogLog 估计（误差约 1.6%），
+    # 按主机的请求数 / 字节数只保留 Top-K（Space-Saving，高估量 ≤ 总数 / K）
+    unique_hosts: HyperLogLog = field(default_factory=HyperLogLog)
+    requests_by_host: SpaceSaving = field(default_factory=lambda: SpaceSaving(TOP_HOSTS))
+    bytes_by_host: SpaceSaving = field(default_factory=lambda: SpaceSaving(TOP_HOSTS))
     start_time: float = field(default_factory=time.time)
+    # 连接复用（keep-alive / 上游连接池）
+    client_connections: int = 0
+    client_requests: int = 0
+    upstream_connections: int = 0
+    upstream_requests: int = 0
+    upstream_reused: int = 0
+    upstream_evicted: int = 0
+    # HTTP 缓存
+    cache_hits: int = 0
+    cache_misses: int = 0
+    cache_revalidated: int = 0
+    cache_bytes_served: int = 0
+    # 访问策略：被拒绝的请求和超过请求速率限制的请求
+    policy_denied: int = 0
+    rate_limited: int = 0
+    # 准入控制：因过载（排队已满 / 等待超时）或单个客户端连接数超限被拒绝（503）的连接
+    rejected_overload: int = 0
+    rejected_client_limit: int = 0
+    # 超时：首个请求头、keep-alive 空闲、传输空闲（HTTP 转发和隧道）、连接寿命
+    timeouts_header: int = 0
+    timeouts_keepalive: int = 0
+    timeouts_idle: int = 0
+    timeouts_lifetime: int = 0
+    # 按沙箱（没有沙箱名时按客户端地址）和按任务的流量
+    by_sandbox: TrafficAccounts = field(default_factory=lambda: TrafficAccounts(MAX_SANDBOXES))
+    by_job: TrafficAccounts = field(default_factory=lambda: TrafficAccounts(MAX_JOBS))
+    # 延迟直方图：全局和按主机（按主机最多 max_latency_hosts 个，其余合并到 "(other)"）
+    latency: Dict[str, LatencyHistogram] = field(
+        default_factory=lambda: {phase: LatencyHistogram() for phase in LATENCY_PHASES}
+    )
+    host_latency: Dict[str, Dict[str, LatencyHistogram]] = field(default_factory=dict)
+    max_latency_hosts: int = 128
+
+    def record_latency(self, req_log: 'RequestLog'):
+        """把一条请求的各阶段耗时记入直方图"""
+        host = req_log.host
+        per_host = self.host_latency.get(host)
+        if per_host is None:
+            if len(self.host_latency) >= self.max_latency_hosts:
+                host = '(other)'
+                per_host = self.host_latency.get(host)
+            if per_host is None:
+                per_host = self.host_latency[host] = {
+                    phase: LatencyHistogram() for phase in LATENCY_PHASES
+                }
+        for phase, value in (
+            ('dns', req_log.dns_ms),
+            ('connect', req_log.connect_ms),
+            ('ttfb', req_log.ttfb_ms),
+            ('total', req_log.duration_ms),
+        ):
+            if value is not None:
+                self.latency[phase].record(value)
+                per_host[phase].record(value)
+
+    def snapshot(self) -> 'ProxyStats':
+        """复制一份统计（调用方持有锁；分位数计算和序列化可在锁外进行）"""
+        return replace(
+            self,
+            unique_hosts=self.unique_hosts.copy(),
+            requests_by_host=self.requests_by_host.copy(),
+            bytes_by_host=self.bytes_by_host.copy(),
+            by_sandbox=self.by_sandbox.copy(),
+            by_job=self.by_job.copy(),
+            latency={phase: h.copy() for phase, h in self.latency.items()},
+            host_latency={
+                host: {phase: h.copy() for phase, h in phases.items()}
+                for host, phases in self.host_latency.items()
+            },
+        )
+
+    def merge(self, other: 'ProxyStats'):
+        """合并另一份统计（多进程模式下汇总各 worker）"""
+        for name in (
+            'total_requests', 'successful_requests', 'failed_requests', 'total_bytes',
+            'client_connections', 'client_requests', 'upstream_connections',
+            'upstream_requests', 'upstream_reused', 'upstream_evicted',
+            'cache_hits', 'cache_misses', 'cache_revalidated', 'cache_bytes_served',
+            'policy_denied', 'rate_limited', 'rejected_overload', 'rejected_client_limit',
+            'timeouts_header', 'timeouts_keepalive', 'timeouts_idle', 'timeouts_lifetime',
+        ):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.unique_hosts.merge(other.unique_hosts)
+        self.requests_by_host.merge(other.requests_by_host)
+        self.bytes_by_host.merge(other.bytes_by_host)
+        self.by_sandbox.merge(other.by_sandbox)
+        self.by_job.merge(other.by_job)
+        self.start_time = min(self.start_time, other.start_time)
+        for phase, histogram in other.latency.items():
+            self.latency[phase].merge(histogram)
+        for host, phases in other.host_latency.items():
+            if host not in self.host_latency and len(self.host_latency) >= self.max_latency_hosts:
+                host = '(other)'
+            per_host = self.host_latency.setdefault(
+                host, {phase: LatencyHistogram() for phase in LATENCY_PHASES}
+            )
+            for phase, histogram in phases.items():
+                per_host[phase].merge(histogram)
 
     def to_dict(self) -> dict:
         """转换为字典（用于 JSON 序列化）"""
+        cache_lookups = self.cache_hits + self.cache_revalidated + self.cache_misses
         return {
             "total_requests": self.total_requests,
             "successful_requests": self.successful_requests,
             "failed_requests": self.failed_requests,
             "total_bytes": self.total_bytes,
-            "unique_hosts": list(self.unique_hosts),
-            "requests_by_host": dict(self.requests_by_host),
+            "unique_hosts": self.unique_hosts.count(),
+            "requests_by_host": {host: n for host, n, _ in self.requests_by_host.top()},
+            "bytes_by_host": {host: n for host, n, _ in self.bytes_by_host.top()},
+            # 上面三项均为近似值：unique_hosts 的相对标准误差，
+            # 以及 Top-K 计数的最大高估量
+            "host_stats_error": {
+                "unique_hosts_relative": round(self.unique_hosts.relative_error, 4),
+                "requests_by_host_max": self.requests_by_host.max_error,
+                "bytes_by_host_max": self.bytes_by_host.max_error,
+            },
             "uptime_seconds": time.time() - self.start_time,
+            "client_connections": self.client_connections,
+            "client_requests": self.client_requests,
+            # 每个客户端连接上的请求中复用已有连接的比例
+            "client_reuse_ratio": (
+                1 - self.client_connections / self.client_requests
+                if self.client_requests > self.client_connections else 0.0
+            ),
+            "upstream_connections": self.upstream_connections,
+            "upstream_requests": self.upstream_requests,
+            "upstream_reused": self.upstream_reused,
+            "upstream_evicted": self.upstream_evicted,
+            "upstream_reuse_ratio": (
+                self.upstream_reused / self.upstream_requests if self.upstream_requests else 0.0
+            ),
+            # 缓存命中率 = 从缓存返回（含重新验证）的请求 / 所有经过缓存的请求
+            "cache": {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "revalidated": self.cache_revalidated,
+                "bytes_served": self.cache_bytes_served,
+                "hit_ratio": (
+                    (self.cache_hits + self.cache_revalidated) / cache_lookups
+                    if cache_lookups else 0.0
+                ),
+            },
+            "policy_denied": self.policy_denied,
+            "rate_limited": self.rate_limited,
+            "rejected": {
+                "overload": self.rejected_overload,
+                "client_limit": self.rejected_client_limit,
+            },
+            "timeouts": {
+                "header": self.timeouts_header,
+                "keepalive_idle": self.timeouts_keepalive,
+                "idle": self.timeouts_idle,
+                "lifetime": self.timeouts_lifetime,
+            },
+            # 按下行字节数从大到小排列
+            "by_sandbox": self.by_sandbox.to_dict(),
+            "by_job": self.by_job.to_dict(),
+            # 各阶段延迟分位数（毫秒）
+            "latency": {phase: h.summary() for phase, h in self.latency.items()},
+            "latency_by_host": {
+                host: {phase: h.summary() for phase, h in phases.items()}
+                for host, phases in self.host_latency.items()
+            },
         }
 
 
 class ProxyMonitor:
     """代理监控器"""
 
-    def __init__(self, log_file: Optional[str] = None, verbose: bool = False):
+    def __init__(
+        self,
+        log_file: Optional[str] = None,
+        verbose: bool = False,
+        max_logs: int = 100000,
+        archive: Optional[ProxyArchive] = None,
+        forward: Optional[Callable[[RequestLog], None]] = None,
+    ):
         self.log_file = log_file
         self.verbose = verbose
         self.stats = ProxyStats()
-        self.request_logs: List[RequestLog] = []
-        self.max_logs = 1000  # 最多保留的日志数量
+        # 多进程模式下各 worker 最近上报的统计（worker 编号 -> 快照）
+        self.worker_stats: Dict[int, ProxyStats] = {}
+        # 已退出（被重启替换）的 worker 最后一次上报的统计之和
+        self.retired_stats = ProxyStats()
+        # 统计信息可能被多个线程读写（统计输出线程 / 外部调用）
+        self._lock = threading.Lock()
+        self.max_logs = max_logs  # 内存中最多保留的日志数量
+        # forward 不为空时（多进程模式的 worker）请求日志只转发给汇总进程，
+        # 不在本地保存和输出
+        self.forward = forward
+        self.request_logs = RequestLogStore(capacity=max_logs) if forward is None else None
+        # 持久化归档（可选，后台线程批量写入 SQLite）
+        self.archive = archive
 
         # 设置日志
         self.logger = logging.getLogger("ProxyMonitor")
@@ -82,7 +320,7 @@ class ProxyMonitor:
         console_handler.setFormatter(
             logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
         )
-        self.logger.addHandler(console_handler)
+        handlers = [console_handler]
 
         # 文件输出
         if log_file:
@@ -90,25 +328,73 @@ class ProxyMonitor:
             file_handler.setFormatter(
                 logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
             )
-            self.logger.addHandler(file_handler)
+            handlers.append(file_handler)
+
+        # 每个请求一行日志：事件循环中只入队，由后台线程批量格式化和写入
+        # （队列满时丢弃 INFO / WARNING 并报告条数，统计和归档不受影响）
+        self._log_pipeline = LogPipeline(handlers)
+        self.logger.addHandler(self._log_pipeline)
+
+    def close(self):
+        """写完队列中的日志并停止写入线程"""
+        self.logger.removeHandler(self._log_pipeline)
+        self._log_pipeline.close()
 
     def log_request(self, req_log: RequestLog):
         """记录请求"""
         # 更新统计信息
-        self.stats.total_requests += 1
-        self.stats.unique_hosts.add(req_log.host)
-        self.stats.requests_by_host[req_log.host] += 1
-
-        if req_log.error:
-            self.stats.failed_requests += 1
+        with self._lock:
+            self.stats.total_requests += 1
+            self.stats.unique_hosts.add(req_log.host)
+            self.stats.requests_by_host.add(req_log.host)
+
+            if req_log.error:
+                self.stats.failed_requests += 1
+            else:
+                self.stats.successful_requests += 1
+                self.stats.total_bytes += req_log.response_size
+                if req_log.response_size:
+                    self.stats.bytes_by_host.add(req_log.host, req_log.response_size)
+                self.stats.record_latency(req_log)
+                if req_log.cache_status in ('HIT', 'REVALIDATED'):
+                    self.stats.cache_bytes_served += req_log.response_size
+            if req_log.cache_status == 'HIT':
+                self.stats.cache_hits += 1
+            elif req_log.cache_status == 'REVALIDATED':
+                self.stats.cache_revalidated += 1
+            elif req_log.cache_status == 'MISS':
+                self.stats.cache_misses += 1
+            self.stats.by_sandbox.record(req_log.source, req_log)
+            if req_log.job:
+                self.stats.by_job.record(req_log.job, req_log)
+
+        if self.forward is not None:
+            self.forward(req_log)
         else:
-            self.stats.successful_requests += 1
-            self.stats.total_bytes += req_log.response_size
-
-        # 保存日志
+            self._record(req_log)
+
+    def ingest(self, logs: List[RequestLog]):
+        """保存并输出 worker 转发来的请求日志（统计已由 worker 计入）"""
+        for req_log in logs:
+            self._record(req_log)
+
+    def update_worker_stats(self, worker_id: int, stats: ProxyStats):
+        """更新某个 worker 上报的统计快照"""
+        with self._lock:
+            self.worker_stats[worker_id] = stats
+
+    def retire_worker(self, worker_id: int):
+        """worker 意外退出：把它最后一次上报的统计并入 retired_stats，重启的 worker 从零开始上报"""
+        with self._lock:
+            stats = self.worker_stats.pop(worker_id, None)
+            if stats is not None:
+                self.retired_stats.merge(stats)
+
+    def _record(self, req_log: RequestLog):
+        # 保存日志（环形缓冲区，满后覆盖最旧的记录）
         self.request_logs.append(req_log)
-        if len(self.request_logs) > self.max_logs:
-            self.request_logs.pop(0)
+        if self.archive is not None:
+            self.archive.append(req_log)
 
         # 输出日志
         if req_log.error:
@@ -116,18 +402,38 @@ class ProxyMonitor:
                 f"{req_log.method} {req_log.url} - ERROR: {req_log.error}"
             )
         else:
+            extra = f", ttfb {req_log.ttfb_ms:.0f}ms" if req_log.ttfb_ms is not None else ""
+            if req_log.close_reason:
+                extra += f", {req_log.request_size} bytes up, {req_log.close_reason}"
+            if req_log.cache_status:
+                extra += f", cache {req_log.cache_status}"
+            if req_log.job:
+                extra += f", job {req_log.job}"
             self.logger.info(
                 f"{req_log.method} {req_log.url} - {req_log.status_code} "
-                f"({req_log.response_size} bytes, {req_log.duration_ms:.0f}ms)"
+                f"({req_log.response_size} bytes, {req_log.duration_ms:.0f}ms{extra})"
             )
 
+    def snapshot_stats(self) -> ProxyStats:
+        """统计信息的快照（只在复制期间持有锁）"""
+        with self._lock:
+            snapshot = self.stats.snapshot()
+            snapshot.merge(self.retired_stats)
+            for stats in self.worker_stats.values():
+                snapshot.merge(stats)
+            return snapshot
+
     def get_stats(self) -> dict:
         """获取统计信息"""
-        return self.stats.to_dict()
+        return self.snapshot_stats().to_dict()
 
     def get_recent_logs(self, count: int = 100) -> List[dict]:
         """获取最近的日志"""
-        return [asdict(log) for log in self.request_logs[-count:]]
+        return self.request_logs.recent(count)
+
+    def query_logs(self, **filters) -> List[dict]:
+        """按主机、状态码、方法或时间范围查询日志（参数见 RequestLogStore.query）"""
+        return self.request_logs.query(**filters)
 
     def export_logs(self, output_file: str):
         """导出日志到文件"""
@@ -140,178 +446,1440 @@ class ProxyMonitor:
         self.logger.info(f"Logs exported to {output_file}")
 
 
-class ProxyHandler(BaseHTTPRequestHandler):
-    """HTTP 代理处理器"""
+# 请求头最大长度（超过则视为非法请求）
+MAX_HEADER_SIZE = 64 * 1024
+# 请求体 / 响应体转发时每次读取的字节数
+RELAY_CHUNK_SIZE = 64 * 1024
+# 每个连接发送缓冲区上限，超过后暂停读取对端（背压）
+WRITE_BUFFER_LIMIT = 256 * 1024
+# 隧道每个方向复用的接收缓冲区大小
+TUNNEL_BUFFER_SIZE = 256 * 1024
+# 上游响应完成后等待请求体上传结束的时间
+UPLOAD_GRACE_SECONDS = 1.0
+# 被拒绝的连接在返回 503 前读取请求头的最长时间（不读请求就关闭会导致 RST，客户端收不到响应）
+SHED_READ_TIMEOUT = 1.0
+# 503 响应中建议的重试间隔（秒）
+SHED_RETRY_AFTER = 5
+# 从缓存返回时每次 sendfile 的字节数（每段之后更新空闲计时）
+SENDFILE_CHUNK_SIZE = 4 * 1024 * 1024
+# 逐跳头部（以及代理自用的任务标记头），不转发给上游
+HOP_BY_HOP_HEADERS = {
+    'connection', 'proxy-connection', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailers', 'upgrade', JOB_HEADER,
+}
+
+
+@dataclass
+class HTTPRequestHead:
+    """解析后的请求行和请求头"""
+    method: str
+    target: str
+    version: str
+    headers: List[tuple]
+
+    def get_header(self, name: str, default: str = '') -> str:
+        return get_header(self.headers, name, default)
+
+
+@dataclass
+class HTTPResponseHead:
+    """解析后的状态行和响应头"""
+    version: str
+    status: int
+    reason: str
+    headers: List[tuple]
+
+    def get_header(self, name: str, default: str = '') -> str:
+        return get_header(self.headers, name, default)
+
+
+def get_header(headers: List[tuple], name: str, default: str = '') -> str:
+    """按名称（不区分大小写）查找头部"""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return default
+
+
+def _parse_header_lines(lines: List[str]) -> List[tuple]:
+    headers = []
+    for line in lines:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError(f"Bad header line: {line!r}")
+        headers.append((name.strip(), value.strip()))
+    return headers
+
+
+def parse_request_head(data: bytes) -> HTTPRequestHead:
+    """解析 HTTP 请求头（data 以空行结尾）"""
+    lines = data.decode('latin-1').split('\r\n')
+    parts = lines[0].split()
+    if len(parts) != 3:
+        raise ValueError(f"Bad request line: {lines[0]!r}")
+    method, target, version = parts
+    return HTTPRequestHead(method.upper(), target, version, _parse_header_lines(lines[1:]))
+
+
+def parse_response_head(data: bytes) -> HTTPResponseHead:
+    """解析 HTTP 响应头"""
+    lines = data.decode('latin-1').split('\r\n')
+    parts = lines[0].split(None, 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise ValueError(f"Bad status line: {lines[0]!r}")
+    reason = parts[2] if len(parts) > 2 else ''
+    return HTTPResponseHead(parts[0], int(parts[1]), reason, _parse_header_lines(lines[1:]))
+
+
+def body_framing(headers: List[tuple]) -> tuple:
+    """
+    根据头部确定消息体的分帧方式
+
+    Returns:
+        ('chunked', None) / ('length', n) / ('eof', None)
+    """
+    transfer_encoding = get_header(headers, 'Transfer-Encoding').lower()
+    if transfer_encoding and transfer_encoding.split(',')[-1].strip() == 'chunked':
+        return 'chunked', None
+    content_length = get_header(headers, 'Content-Length')
+    if content_length:
+        return 'length', int(content_length.split(',')[0])
+    return 'eof', None
+
+
+async def relay_body(
+    source: asyncio.StreamReader,
+    destination: asyncio.StreamWriter,
+    framing: str,
+    length: Optional[int] = None,
+    on_data=None,
+    shaper: Optional[Shaper] = None,
+) -> int:
+    """
+    按分帧方式流式转发一个消息体，返回载荷字节数
+
+    chunked 消息体原样转发（含分块头和 trailer），边解析分块大小边转发，
+    内存占用不超过 RELAY_CHUNK_SIZE；每次写入后 drain，对端读得慢时暂停读取。
+    on_data 在每段数据写出后调用（用于记录首字节时间等）；指定 shaper 时按其
+    带宽限制暂停转发。
+    """
+    total = 0
+
+    async def copy(remaining: Optional[int]):
+        nonlocal total
+        while remaining is None or remaining > 0:
+            size = RELAY_CHUNK_SIZE if remaining is None else min(remaining, RELAY_CHUNK_SIZE)
+            data = await source.read(size)
+            if not data:
+                if remaining is None:
+                    return
+                raise asyncio.IncompleteReadError(b'', remaining)
+            destination.write(data)
+            total += len(data)
+            if remaining is not None:
+                remaining -= len(data)
+            if on_data:
+                on_data()
+            await destination.drain()
+            if shaper is not None:
+                await shaper.throttle(len(data))
+
+    if framing == 'length':
+        await copy(length or 0)
+    elif framing == 'eof':
+        await copy(None)
+    elif framing == 'chunked':
+        while True:
+            size_line = await source.readuntil(b'\r\n')
+            destination.write(size_line)
+            chunk_size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if chunk_size == 0:
+                # trailer 以空行结束
+                while True:
+                    line = await source.readuntil(b'\r\n')
+                    destination.write(line)
+                    if line == b'\r\n':
+                        break
+                await destination.drain()
+                break
+            await copy(chunk_size)
+            destination.write(await source.readexactly(2))
+    return total
+
+
+async def iter_body(
+    source: asyncio.StreamReader,
+    framing: str,
+    length: Optional[int] = None,
+):
+    """按分帧方式逐段读取消息体的载荷（chunked 时去掉分块头和 trailer）"""
+    async def read(remaining: Optional[int]):
+        while remaining is None or remaining > 0:
+            size = RELAY_CHUNK_SIZE if remaining is None else min(remaining, RELAY_CHUNK_SIZE)
+            data = await source.read(size)
+            if not data:
+                if remaining is None:
+                    return
+                raise asyncio.IncompleteReadError(b'', remaining)
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    if framing == 'length':
+        async for data in read(length or 0):
+            yield data
+    elif framing == 'eof':
+        async for data in read(None):
+            yield data
+    elif framing == 'chunked':
+        while True:
+            size_line = await source.readuntil(b'\r\n')
+            chunk_size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if chunk_size == 0:
+                while await source.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                return
+            async for data in read(chunk_size):
+                yield data
+            await source.readexactly(2)
+
+
+def request_target(head: HTTPRequestHead) -> tuple:
+    """请求的 (主机, 路径)，目标不是绝对 URL 时从 Host 头获取主机"""
+    parsed_url = urlparse(head.target)
+    if not parsed_url.netloc:
+        return head.get_header('Host'), head.target
+    path = parsed_url.path or '/'
+    if parsed_url.query:
+        path += '?' + parsed_url.query
+    return parsed_url.netloc, path
+
+
+def split_host_port(netloc: str, default_port: int) -> tuple:
+    """拆分 host:port（支持 [IPv6]:port）"""
+    if netloc.startswith('['):
+        host, _, rest = netloc[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else ''
+    else:
+        host, _, port = netloc.rpartition(':') if netloc.count(':') == 1 else (netloc, '', '')
+    return host, int(port) if port else default_port
+
+
+class IdleTimer:
+    """
+    空闲超时：超过 timeout 秒没有 touch() 时调用 on_timeout（timeout <= 0 时不启用）
+
+    touch() 只记录时间；定时器到期时才检查最近一次 touch，未超时则按其重新
+    安排，数据路径上没有额外的定时器操作。
+    """
+
+    def __init__(self, timeout: float, on_timeout: Callable[[], None]):
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.fired = False
+        self._loop = asyncio.get_running_loop()
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self.last = self._loop.time()
+        self.start()
+
+    def touch(self):
+        self.last = self._loop.time()
+
+    def start(self):
+        """（重新）开始计时"""
+        self.touch()
+        if self.timeout > 0 and self._handle is None and not self.fired:
+            self._handle = self._loop.call_at(self.last + self.timeout, self._check)
+
+    def _check(self):
+        deadline = self.last + self.timeout
+        if self._loop.time() < deadline:
+            self._handle = self._loop.call_at(deadline, self._check)
+            return
+        self._handle = None
+        self.fired = True
+        self.on_timeout()
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class TunnelProtocol(asyncio.BufferedProtocol):
+    """
+    隧道的一端（客户端或上游）
+
+    数据直接接收到复用的缓冲区，再写入对端 transport：能立即发送时不产生
+    额外拷贝，对端发送缓冲区满时暂停本端读取（背压）。对端 transport 可能
+    保留未发送部分的 memoryview（Python 3.12+ 不拷贝），此时换用新的接收
+    缓冲区，避免下一次接收覆盖尚未发出的数据。
+    """
+
+    def __init__(self, tunnel: 'Tunnel', side: str):
+        self.tunnel = tunnel
+        self.side = side  # 'client' / 'upstream'
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer: Optional['TunnelProtocol'] = None
+        self.buffer = memoryview(bytearray(TUNNEL_BUFFER_SIZE))
+        self.bytes_received = 0
+        self.eof = False
+        self.closed = False
+        # 暂停读取的两个原因：对端发送缓冲区满（背压）、超过带宽限制
+        self.blocked = False
+        self.throttled = False
+        # 对端接入隧道前收到的数据，对端 connection_made 时发送
+        self.early: List[bytes] = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+        if self.peer.transport is None:
+            # 上游先于客户端接入隧道：对端就绪前不读取（上游可能先发数据，如 SSH）；
+            # 部分解释器上 pause_reading 不会立即生效，先到的数据暂存在 early 中
+            transport.pause_reading()
+            return
+        for data in self.peer.early:
+            transport.write(data)
+        self.peer.early.clear()
+        if self.peer.eof and transport.can_write_eof():
+            transport.write_eof()
+        if self.peer.closed:
+            transport.close()
+        elif not self.peer.throttled:
+            self.peer.transport.resume_reading()
+
+    def get_buffer(self, sizehint: int):
+        return self.buffer
+
+    def buffer_updated(self, nbytes: int):
+        if self.bytes_received == 0 and self.side == 'upstream':
+            self.tunnel.first_upstream_byte = time.monotonic()
+        self.bytes_received += nbytes
+        if self.tunnel.idle is not None:
+            self.tunnel.idle.touch()
+        peer = self.peer.transport
+        if peer is None:
+            self.early.append(bytes(self.buffer[:nbytes]))
+        elif not self.peer.closed:
+            if peer.get_write_buffer_size():
+                # 已有积压：数据不会立即发送，交给 transport 一份拷贝
+                peer.write(bytes(self.buffer[:nbytes]))
+            else:
+                peer.write(self.buffer[:nbytes])
+                if peer.get_write_buffer_size():
+                    # 未发送的部分可能仍引用 self.buffer
+                    self.buffer = memoryview(bytearray(TUNNEL_BUFFER_SIZE))
+        if self.tunnel.shaper is not None:
+            delay = self.tunnel.shaper.consume(nbytes)
+            if delay > 0 and not self.throttled:
+                self.throttled = True
+                self.transport.pause_reading()
+                asyncio.get_running_loop().call_later(delay, self._unthrottle)
+
+    def _unthrottle(self):
+        self.throttled = False
+        if not self.closed and not self.blocked:
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        # 半关闭：把 EOF 传递给对端，另一个方向继续转发
+        self.eof = True
+        self.tunnel.note_close(f"{self.side}_closed")
+        if self.peer.transport is None:
+            return True  # 对端 connection_made 时传递 EOF
+        if self.peer.transport.can_write_eof() and not self.peer.closed:
+            self.peer.transport.write_eof()
+        if self.peer.eof:
+            self.transport.close()
+            self.peer.transport.close()
+        return True  # 由我们决定何时关闭 transport
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if exc is not None:
+            self.tunnel.note_close(f"{self.side}_error: {exc}")
+        else:
+            self.tunnel.note_close(f"{self.side}_closed")
+        # 对端 transport.close() 会先发送完缓冲区中的数据
+        if not self.peer.closed and self.peer.transport is not None:
+            self.peer.transport.close()
+        self.tunnel.check_done()
+
+    # 本端发送缓冲区满 / 清空时，暂停 / 恢复读取对端
+    def pause_writing(self):
+        self.peer.blocked = True
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.blocked = False
+        if not self.peer.closed and not self.peer.throttled:
+            self.peer.transport.resume_reading()
+
+
+class Tunnel:
+    """CONNECT 隧道：一对 TunnelProtocol 及其字节和时间统计"""
+
+    def __init__(self, shaper: Optional[Shaper] = None):
+        self.shaper = shaper  # 两个方向共用的带宽限制
+        self.client = TunnelProtocol(self, 'client')
+        self.upstream = TunnelProtocol(self, 'upstream')
+        self.client.peer = self.upstream
+        self.upstream.peer = self.client
+        self.started = time.monotonic()
+        self.first_upstream_byte: Optional[float] = None
+        self.close_reason: Optional[str] = None
+        self.done = asyncio.get_running_loop().create_future()
+        # 空闲 / 寿命超时（start_timers 之后）；timed_out 为 'idle' / 'lifetime'
+        self.idle: Optional[IdleTimer] = None
+        self.timed_out: Optional[str] = None
+        self._lifetime: Optional[asyncio.TimerHandle] = None
+
+    def start_timers(self, idle_timeout: float, max_lifetime: float):
+        """两个方向都超过 idle_timeout 秒没有数据，或隧道存在超过 max_lifetime 秒时中止（<= 0 不限制）"""
+        if idle_timeout > 0:
+            self.idle = IdleTimer(idle_timeout, lambda: self.abort('idle'))
+        if max_lifetime > 0:
+            self._lifetime = asyncio.get_running_loop().call_later(
+                max_lifetime, self.abort, 'lifetime'
+            )
+
+    def stop_timers(self):
+        if self.idle is not None:
+            self.idle.cancel()
+        if self._lifetime is not None:
+            self._lifetime.cancel()
+
+    def abort(self, kind: str):
+        """超时中止：丢弃未发送的数据（对端不读取时 close() 会一直等待）"""
+        self.timed_out = kind
+        self.close_reason = 'idle_timeout' if kind == 'idle' else 'lifetime_exceeded'
+        for side in (self.client, self.upstream):
+            if side.transport is not None and not side.closed:
+                side.transport.abort()
+
+    def note_close(self, reason: str):
+        """记录最先发生的关闭事件"""
+        if self.close_reason is None:
+            self.close_reason = reason
+
+    def check_done(self):
+        if self.client.closed and self.upstream.closed and not self.done.done():
+            self.done.set_result(None)
+
+    @property
+    def bytes_up(self) -> int:
+        return self.client.bytes_received
+
+    @property
+    def bytes_down(self) -> int:
+        return self.upstream.bytes_received
+
+
+def connection_tokens(headers: List[tuple]) -> Set[str]:
+    """Connection / Proxy-Connection 头中的选项（小写）"""
+    tokens = set()
+    for name, value in headers:
+        if name.lower() in ('connection', 'proxy-connection'):
+            tokens.update(t.strip().lower() for t in value.split(',') if t.strip())
+    return tokens
+
+
+def wants_keep_alive(version: str, headers: List[tuple]) -> bool:
+    """HTTP/1.1 默认持久连接，HTTP/1.0 需显式 keep-alive"""
+    tokens = connection_tokens(headers)
+    if 'close' in tokens:
+        return False
+    return version.upper() == 'HTTP/1.1' or 'keep-alive' in tokens
 
-    monitor: ProxyMonitor = None  # 将由主程序设置
 
-    def do_GET(self):
-        """处理 GET 请求"""
-        self._proxy_request('GET')
+@dataclass
+class UpstreamConnection:
+    """连接池中的一个上游连接"""
+    key: tuple
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    created: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+    requests: int = 0
+    dns_ms: Optional[float] = None
+    connect_ms: Optional[float] = None
+
+    def healthy(self, idle_timeout: float, max_lifetime: float = 0) -> bool:
+        """空闲未超时、未超过寿命（max_lifetime <= 0 时不限制）且对端未关闭"""
+        now = time.monotonic()
+        return (
+            not self.reader.at_eof()
+            and not self.writer.is_closing()
+            and now - self.last_used < idle_timeout
+            and (max_lifetime <= 0 or now - self.created < max_lifetime)
+        )
 
-    def do_POST(self):
-        """处理 POST 请求"""
-        self._proxy_request('POST')
 
-    def do_HEAD(self):
-        """处理 HEAD 请求"""
-        self._proxy_request('HEAD')
+class UpstreamPool:
+    """
+    按 (host, port) 划分的上游 HTTP 连接池
+
+    - max_per_host：每个主机同时打开的连接上限，超出的请求等待空闲连接
+    - idle_timeout：空闲连接超过该时间后关闭
+    - max_lifetime：建立超过该时间的连接在归还后不再复用（<= 0 不限制）
+    - 取出连接时检查健康状态（对端已关闭 / 超时的连接被驱逐）
+    """
+
+    def __init__(
+        self,
+        stats: ProxyStats,
+        max_per_host: int = 32,
+        idle_timeout: float = 30.0,
+        connect_timeout: float = 30.0,
+        dns: Optional[DnsCache] = None,
+        max_lifetime: float = 0,
+    ):
+        self.stats = stats
+        self.dns = dns or DnsCache()
+        # 解析得到的地址的过滤器（访问策略中的地址段规则）
+        self.address_filter: Optional[Callable[[str], bool]] = None
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.connect_timeout = connect_timeout
+        self._idle: Dict[tuple, List[UpstreamConnection]] = defaultdict(list)
+        self._slots: Dict[tuple, asyncio.Semaphore] = {}
+        self._open: Dict[tuple, int] = defaultdict(int)
+
+    async def acquire(self, host: str, port: int) -> UpstreamConnection:
+        """取出一个空闲连接，没有则新建"""
+        key = (host, port)
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = asyncio.Semaphore(self.max_per_host)
+        await slots.acquire()
 
-    def do_PUT(self):
-        """处理 PUT 请求"""
-        self._proxy_request('PUT')
+        try:
+            idle = self._idle.get(key)
+            while idle:
+                conn = idle.pop()  # 取最近使用的连接，更可能仍然存活
+                if conn.healthy(self.idle_timeout, self.max_lifetime):
+                    self.stats.upstream_reused += 1
+                    return conn
+                self._discard(conn)
+                self.stats.upstream_evicted += 1
+
+            sock, dns_ms, connect_ms = await self.dns.connect(
+                host, port, self.connect_timeout, address_filter=self.address_filter
+            )
+            reader, writer = await asyncio.open_connection(sock=sock, limit=MAX_HEADER_SIZE)
+            writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+            self._open[key] += 1
+            self.stats.upstream_connections += 1
+            conn = UpstreamConnection(key, reader, writer)
+            conn.dns_ms = dns_ms
+            conn.connect_ms = connect_ms
+            return conn
+        except BaseException:
+            self._release_slot(key)
+            raise
+
+    def release(self, conn: UpstreamConnection, reusable: bool):
+        """归还连接；不可复用的连接直接关闭"""
+        conn.requests += 1
+        conn.last_used = time.monotonic()
+        if reusable and not conn.writer.is_closing() and not conn.reader.at_eof():
+            self._idle[conn.key].append(conn)
+        else:
+            self._discard(conn)
+        self._release_slot(conn.key)
+
+    def _release_slot(self, key: tuple):
+        slots = self._slots.get(key)
+        if slots is not None:
+            slots.release()
+
+    def _discard(self, conn: UpstreamConnection):
+        conn.writer.close()
+        self._open[conn.key] -= 1
+        if self._open[conn.key] <= 0:
+            self._open.pop(conn.key, None)
+
+    def reap(self):
+        """关闭超时或已断开的空闲连接"""
+        for key in list(self._idle):
+            idle = self._idle[key]
+            alive = []
+            for conn in idle:
+                if conn.healthy(self.idle_timeout, self.max_lifetime):
+                    alive.append(conn)
+                else:
+                    self._discard(conn)
+                    self.stats.upstream_evicted += 1
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+                # 没有空闲也没有使用中的连接时释放该主机的信号量
+                if key not in self._open and key in self._slots:
+                    if not self._slots[key].locked():
+                        del self._slots[key]
+
+    async def reap_forever(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 2, 1))
+            self.reap()
+
+    def close(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.writer.close()
+        self._idle.clear()
+
+
+class ProxyServer:
+    """
+    基于 asyncio 的代理引擎
+
+    单线程事件循环处理 HTTP 转发和 CONNECT 隧道，长连接（如 Claude API 的
+    流式会话）不会阻塞其他请求。
+
+    准入控制：max_connections 限制并发客户端连接数，超出的连接最多 max_pending
+    个排队等待（最长 queue_timeout 秒）；队列已满、等待超时或同一客户端地址的
+    连接数超过 max_client_connections 时返回 503 和 Retry-After，过载时代理仍能
+    及时响应。接受连接时还没有读取请求头，不知道所属沙箱，所以这个限制按来源
+    地址计算；Lima usernet 中所有 VM 的来源地址相同，实际上是所有沙箱共用的上限。
+
+    超时：HTTP 转发超过 idle_timeout 秒没有数据进展时中止（响应开始前返回 504），
+    隧道两个方向超过 tunnel_idle_timeout 秒没有数据时关闭，存在超过
+    tunnel_max_lifetime 秒时关闭；keep-alive 的客户端连接和上游连接超过
+    max_lifetime 秒后在请求之间关闭（这些值 <= 0 时不限制）。
+
+    客户端连接支持 HTTP/1.1 keep-alive（空闲 client_idle_timeout 秒后关闭），
+    上游 HTTP 连接通过 UpstreamPool 复用。
+
+    多进程模式下每个 worker 一个 ProxyServer：reuse_port=True 时各自绑定同一
+    端口（SO_REUSEPORT，由内核分配连接），或通过 sock 共享父进程的监听 socket。
+
+    指定 cache 时，可缓存的 GET 请求经由磁盘 HTTP 缓存处理（见 proxy_cache）。
+    """
+
+    def __init__(
+        self,
+        monitor: ProxyMonitor,
+        host: str = '0.0.0.0',
+        port: int = 7890,
+        max_connections: int = 10000,
+        connect_timeout: float = 30.0,
+        header_timeout: float = 30.0,
+        client_idle_timeout: float = 60.0,
+        max_upstream_per_host: int = 32,
+        upstream_idle_timeout: float = 30.0,
+        dns_ttl: float = DEFAULT_TTL,
+        reuse_port: bool = False,
+        sock: Optional[socket.socket] = None,
+        cache: Optional[HttpCache] = None,
+        policy: Optional[PolicyEngine] = None,
+        max_pending: int = 1000,
+        queue_timeout: float = 10.0,
+        max_client_connections: int = 2000,
+        idle_timeout: float = 300.0,
+        tunnel_idle_timeout: float = 600.0,
+        tunnel_max_lifetime: float = 0,
+        max_lifetime: float = 3600.0,
+    ):
+        self.monitor = monitor
+        self.cache = cache
+        self.policy = policy
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.sock = sock
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.header_timeout = header_timeout
+        self.client_idle_timeout = client_idle_timeout
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.max_client_connections = max_client_connections
+        self.idle_timeout = idle_timeout
+        self.tunnel_idle_timeout = tunnel_idle_timeout
+        self.tunnel_max_lifetime = tunnel_max_lifetime
+        self.max_lifetime = max_lifetime
+        self.dns = DnsCache(ttl=dns_ttl)
+        self.pool = UpstreamPool(
+            monitor.stats,
+            max_per_host=max_upstream_per_host,
+            idle_timeout=upstream_idle_timeout,
+            connect_timeout=connect_timeout,
+            dns=self.dns,
+            max_lifetime=max_lifetime,
+        )
+        if policy is not None:
+            self.pool.address_filter = policy.address_allowed
+        self.active_connections = 0
+        self.peak_connections = 0
+        # 等待空位的连接数，以及每个客户端地址的连接数（含排队中的）
+        self.pending_connections = 0
+        self._client_connections: Dict[str, int] = defaultdict(int)
+        self._slots = asyncio.Semaphore(max_connections)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._reaper: Optional[asyncio.Task] = None
+        self._cache_sync: Optional[asyncio.Task] = None
+        self._policy_watch: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """开始监听"""
+        if self.sock is not None:
+            self._server = await asyncio.start_server(
+                self._handle_client, sock=self.sock, limit=MAX_HEADER_SIZE
+            )
+        else:
+            self._server = await asyncio.start_server(
+                self._handle_client,
+                self.host,
+                self.port,
+                limit=MAX_HEADER_SIZE,
+                backlog=min(self.max_connections, 4096),
+                reuse_address=True,
+                reuse_port=self.reuse_port or None,
+            )
+        # 绑定端口 0 时回填实际端口
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._reaper = asyncio.create_task(self.pool.reap_forever())
+        if self.cache is not None:
+            self._cache_sync = asyncio.create_task(self._sync_cache_forever())
+        if self.policy is not None and self.policy.path:
+            self._policy_watch = asyncio.create_task(self.policy.watch(self.monitor.logger))
+
+    async def _sync_cache_forever(self, interval: float = 300.0):
+        """定期按磁盘重建缓存索引（多个 worker 共享缓存目录时同步总大小和淘汰）"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            index = await loop.run_in_executor(None, self.cache.scan)
+            self.cache.replace_index(index)
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        if self._reaper is not None:
+            self._reaper.cancel()
+        if self._cache_sync is not None:
+            self._cache_sync.cancel()
+        if self._policy_watch is not None:
+            self._policy_watch.cancel()
+        self.pool.close()
+        self.dns.close()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """处理一个客户端连接：准入控制后交给 _serve_client"""
+        peer = writer.get_extra_info('peername')
+        client = peer[0] if isinstance(peer, tuple) else ''
+        stats = self.monitor.stats
+        if (
+            self.max_client_connections > 0
+            and self._client_connections.get(client, 0) >= self.max_client_connections
+        ):
+            stats.rejected_client_limit += 1
+            await self._shed(reader, writer, f"Too many connections from {client}")
+            return
+
+        self._client_connections[client] += 1
+        try:
+            if not await self._admit():
+                stats.rejected_overload += 1
+                await self._shed(reader, writer, "Proxy overloaded")
+                return
+            try:
+                await self._serve_client(reader, writer, client)
+            finally:
+                self._slots.release()
+        finally:
+            self._client_connections[client] -= 1
+            if self._client_connections[client] <= 0:
+                del self._client_connections[client]
+
+    async def _admit(self) -> bool:
+        """获取一个连接名额；排队已满或等待超过 queue_timeout 时返回 False"""
+        if not self._slots.locked():
+            await self._slots.acquire()
+            return True
+        if self.pending_connections >= self.max_pending:
+            return False
+        self.pending_connections += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.pending_connections -= 1
 
-    def do_DELETE(self):
-        """处理 DELETE 请求"""
-        self._proxy_request('DELETE')
+    async def _shed(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, reason: str):
+        """拒绝连接：读取请求头后返回 503 和 Retry-After"""
+        self.monitor.logger.debug(f"Rejected connection: {reason}")
+        try:
+            try:
+                await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), SHED_READ_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                    ConnectionError):
+                pass
+            await self._send_error(
+                writer, 503, f"Service Unavailable: {reason}",
+                [('Retry-After', str(SHED_RETRY_AFTER))],
+            )
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
 
-    def do_CONNECT(self):
-        """处理 CONNECT 请求（HTTPS 隧道）"""
+    async def _serve_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client: str
+    ):
+        """在一个客户端连接上处理请求（keep-alive 时为多个）"""
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+        self.active_connections += 1
+        self.peak_connections = max(self.peak_connections, self.active_connections)
+        stats = self.monitor.stats
+        stats.client_connections += 1
+        connected = time.monotonic()
+        detached = False
+        served = False
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'),
+                        self.client_idle_timeout if served else self.header_timeout,
+                    )
+                    head = parse_request_head(data)
+                except asyncio.TimeoutError:
+                    if served:
+                        stats.timeouts_keepalive += 1
+                    else:
+                        stats.timeouts_header += 1
+                    return
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except (asyncio.LimitOverrunError, ValueError) as e:
+                    await self._send_error(writer, 400, f"Bad Request: {e}")
+                    return
+
+                # 请求归属：(客户端地址, 沙箱, 任务, trace, 父 span)
+                origin = (client, *parse_attribution(head.headers))
+                shaper = None
+                if self.policy is not None:
+                    decision = self._check_policy(head, client, origin[1])
+                    if not decision.allowed:
+                        await self._reject(head, decision, writer, origin)
+                        return
+                    shaper = decision.shaper
+
+                if head.method == 'CONNECT':
+                    detached = await self._handle_connect(head, reader, writer, origin, shaper)
+                    return
+                stats.client_requests += 1
+                if self.cache is not None and request_cacheable(head.method, head.headers):
+                    keep_alive = await self._cached_request(head, writer, origin, shaper)
+                else:
+                    keep_alive = await self._proxy_request(head, reader, writer, origin, shaper)
+                if not keep_alive:
+                    return
+                # 超过寿命的持久连接在请求之间关闭
+                if self.max_lifetime > 0 and time.monotonic() - connected >= self.max_lifetime:
+                    stats.timeouts_lifetime += 1
+                    return
+                # 持久连接：等待同一连接上的下一个请求
+                served = True
+        except Exception as e:
+            self.monitor.logger.debug(f"Connection error: {e}")
+        finally:
+            self.active_connections -= 1
+            if not detached:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except Exception:
+                    pass
+
+    def _check_policy(self, head: HTTPRequestHead, client: str, sandbox: Optional[str]):
+        if head.method == 'CONNECT':
+            host = split_host_port(head.target, 443)[0]
+        else:
+            host = split_host_port(request_target(head)[0], 80)[0]
+        return self.policy.check(host, client, sandbox)
+
+    async def _reject(
+        self, head: HTTPRequestHead, decision, writer: asyncio.StreamWriter, origin: tuple
+    ):
+        """拒绝违反访问策略或超过请求速率的请求（403 / 429）并记录"""
+        if head.method == 'CONNECT':
+            host = split_host_port(head.target, 443)[0]
+            url, path = f"https://{head.target}", head.target
+        else:
+            host, path = request_target(head)
+            url = f"http://{host}{path}"
+        if decision.status == 429:
+            self.monitor.stats.rate_limited += 1
+            headers = [('Retry-After', str(max(1, round(decision.retry_after + 0.5))))]
+        else:
+            self.monitor.stats.policy_denied += 1
+            headers = []
+        req_log = RequestLog(
+            timestamp=datetime.now().isoformat(),
+            method=head.method,
+            url=url,
+            host=host,
+            path=path,
+            status_code=decision.status,
+            error=decision.reason,
+        )
+        req_log.attribute(origin)
+        await self._send_error(writer, decision.status, decision.reason, headers)
+        self.monitor.log_request(req_log)
+
+    async def _send_error(
+        self, writer: asyncio.StreamWriter, code: int, message: str, headers: List[tuple] = ()
+    ):
+        """向客户端发送错误响应"""
+        body = message.encode('utf-8', 'replace')
+        reason = http.client.responses.get(code, 'Error')
+        extra = ''.join(f"{name}: {value}\r\n" for name, value in headers)
+        try:
+            writer.write(
+                f"HTTP/1.1 {code} {reason}\r\n"
+                f"Content-Type: text/plain; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"{extra}"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _error_status(e: BaseException) -> int:
+        """上游错误对应的状态码：策略拒绝 403，超时 504，其他 502"""
+        if isinstance(e, PermissionError):
+            return 403
+        if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+            return 504
+        return 502
+
+    def _stall_error(self, stall: IdleTimer) -> TimeoutError:
+        """空闲超时取消了当前任务：撤销取消状态并返回对应的超时错误"""
+        task = asyncio.current_task()
+        if hasattr(task, 'uncancel'):
+            task.uncancel()
+        self.monitor.stats.timeouts_idle += 1
+        return TimeoutError(f"No data transferred for {stall.timeout:g}s")
+
+    async def _handle_connect(
+        self, head: HTTPRequestHead, reader, writer, origin: tuple, shaper: Optional[Shaper] = None
+    ) -> bool:
+        """
+        处理 CONNECT 请求（HTTPS 隧道）
+
+        Returns:
+            客户端 transport 是否已交给隧道（此时由隧道负责关闭）
+        """
         # 对于 HTTPS，我们只记录连接，不解密内容
-        host, port = self.path.split(':')
-        port = int(port)
+        host, port = split_host_port(head.target, 443)
 
         req_log = RequestLog(
             timestamp=datetime.now().isoformat(),
             method='CONNECT',
             url=f"https://{host}:{port}",
             host=host,
-            path=self.path,
+            path=head.target,
         )
+        req_log.attribute(origin)
 
         start_time = time.time()
+        loop = asyncio.get_running_loop()
+        tunnel = Tunnel(shaper)
 
         try:
             # 建立到目标服务器的连接
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.connect((host, port))
+            try:
+                sock, req_log.dns_ms, req_log.connect_ms = await self.dns.connect(
+                    host, port, self.connect_timeout, address_filter=self.pool.address_filter
+                )
+                await loop.create_connection(lambda: tunnel.upstream, sock=sock)
+            except Exception as e:
+                req_log.error = str(e) or type(e).__name__
+                await self._send_error(
+                    writer, self._error_status(e), f"Proxy Error: {req_log.error}"
+                )
+                return False
 
             # 发送成功响应
-            self.send_response(200, 'Connection Established')
-            self.end_headers()
-
+            writer.write(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+            await writer.drain()
             req_log.status_code = 200
-            req_log.duration_ms = (time.time() - start_time) * 1000
-
-            # 双向转发数据
-            client_socket = self.connection
-            self._tunnel(client_socket, target_socket)
 
-        except Exception as e:
-            req_log.error = str(e)
-            self.send_error(502, f"Proxy Error: {e}")
+            # 把客户端 transport 从 StreamReader 切换到隧道协议；先取出
+            # StreamReader 中已缓冲的数据（如紧随 CONNECT 发送的 TLS ClientHello）
+            transport = writer.transport
+            transport.pause_reading()
+            pending = asyncio.ensure_future(reader.read(TUNNEL_BUFFER_SIZE))
+            await asyncio.sleep(0)
+            if pending.done():
+                early_data = pending.result()
+            else:
+                pending.cancel()
+                early_data = b''
+            tunnel.client.connection_made(transport)
+            transport.set_protocol(tunnel.client)
+            if early_data:
+                tunnel.client.bytes_received += len(early_data)
+                tunnel.upstream.transport.write(early_data)
+            if reader.at_eof():
+                tunnel.client.eof_received()
+            else:
+                transport.resume_reading()
+
+            # 双向转发数据，直到两端都关闭（或超时中止）
+            tunnel.start_timers(self.tunnel_idle_timeout, self.tunnel_max_lifetime)
+            await tunnel.done
+            return True
         finally:
-            if self.monitor:
-                self.monitor.log_request(req_log)
-
-    def _proxy_request(self, method: str):
-        """代理 HTTP 请求"""
-        parsed_url = urlparse(self.path)
-
-        # 如果没有 scheme，尝试从 Host 头获取
-        if not parsed_url.netloc:
-            host = self.headers.get('Host', '')
-            path = self.path
-        else:
-            host = parsed_url.netloc
-            path = parsed_url.path or '/'
-            if parsed_url.query:
-                path += '?' + parsed_url.query
+            tunnel.stop_timers()
+            if tunnel.timed_out == 'idle':
+                self.monitor.stats.timeouts_idle += 1
+            elif tunnel.timed_out == 'lifetime':
+                self.monitor.stats.timeouts_lifetime += 1
+            for side in (tunnel.client, tunnel.upstream):
+                if side.transport is not None and not side.closed:
+                    side.transport.close()
+            req_log.duration_ms = (time.time() - start_time) * 1000
+            req_log.request_size = tunnel.bytes_up
+            req_log.response_size = tunnel.bytes_down
+            req_log.close_reason = tunnel.close_reason
+            if tunnel.first_upstream_byte is not None:
+                req_log.ttfb_ms = (tunnel.first_upstream_byte - tunnel.started) * 1000
+            self.monitor.log_request(req_log)
+
+    async def _proxy_request(
+        self, head: HTTPRequestHead, reader, writer, origin: tuple, shaper: Optional[Shaper] = None
+    ) -> bool:
+        """
+        代理 HTTP 请求
+
+        Returns:
+            客户端连接能否继续用于下一个请求
+        """
+        host, path = request_target(head)
 
         req_log = RequestLog(
             timestamp=datetime.now().isoformat(),
-            method=method,
+            method=head.method,
             url=f"http://{host}{path}",
             host=host,
             path=path,
         )
+        req_log.attribute(origin)
 
         start_time = time.time()
+        response_started = False
+        client_keep_alive = wants_keep_alive(head.version, head.headers)
+        # 没有数据进展超过 idle_timeout 秒时取消本任务（上游不响应 / 客户端不读取）
+        stall = IdleTimer(self.idle_timeout, asyncio.current_task().cancel)
 
         try:
-            # 建立连接
-            conn = http.client.HTTPConnection(host, timeout=30)
-
-            # 转发请求头
-            headers = dict(self.headers)
-            headers.pop('Proxy-Connection', None)
-
-            # 读取请求体
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length) if content_length > 0 else None
-
-            # 发送请求
-            conn.request(method, path, body=body, headers=headers)
-
-            # 获取响应
-            response = conn.getresponse()
-            req_log.status_code = response.status
-
-            # 转发响应头
-            self.send_response(response.status)
-            for header, value in response.getheaders():
-                if header.lower() not in ('transfer-encoding',):
-                    self.send_header(header, value)
-            self.end_headers()
-
-            # 转发响应体
-            response_data = response.read()
-            req_log.response_size = len(response_data)
-            self.wfile.write(response_data)
+            if not host:
+                raise ValueError("Missing Host")
+            request_framing = body_framing(head.headers)
+            if request_framing[0] == 'eof':
+                # 请求没有 Content-Length / chunked 时视为无消息体
+                request_framing = ('length', 0)
+
+            # 转发请求头（去掉逐跳头部及 Connection 中列出的头部）
+            dropped = HOP_BY_HOP_HEADERS | connection_tokens(head.headers)
+            lines = [f"{head.method} {path} HTTP/1.1"]
+            for name, value in head.headers:
+                if name.lower() not in dropped:
+                    lines.append(f"{name}: {value}")
+            if request_framing[0] == 'chunked':
+                lines.append("Transfer-Encoding: chunked")
+            lines.append("Connection: keep-alive")
+            request_data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+            upstream_host, upstream_port = split_host_port(host, 80)
+            conn = await self.pool.acquire(upstream_host, upstream_port)
+            self.monitor.stats.upstream_requests += 1
+            if not conn.requests:
+                req_log.dns_ms, req_log.connect_ms = conn.dns_ms, conn.connect_ms
+            upload = None
+            upstream_reusable = False
+            try:
+                conn.writer.write(request_data)
+                if request_framing == ('length', 0):
+                    await conn.writer.drain()
+                else:
+                    # 请求体与响应并行转发（全双工）：上游可以在请求体发完前
+                    # 开始响应（如 100 Continue 或提前拒绝）
+                    upload = asyncio.create_task(relay_body(
+                        reader, conn.writer, *request_framing, on_data=stall.touch, shaper=shaper
+                    ))
+                    # 客户端中途断开时关闭上游，避免一直等待响应
+                    upload.add_done_callback(
+                        lambda task: conn.writer.close()
+                        if not task.cancelled() and task.exception() else None
+                    )
+
+                # 获取响应头（转发 1xx 中间响应，如 100 Continue）
+                while True:
+                    try:
+                        response_data = await conn.reader.readuntil(b'\r\n\r\n')
+                    except (asyncio.IncompleteReadError, ConnectionError):
+                        if conn.requests and upload is None and req_log.ttfb_ms is None:
+                            # 复用的连接已被上游关闭：换新连接重试一次（仅限无请求体）
+                            self.pool.release(conn, reusable=False)
+                            conn = await self.pool.acquire(upstream_host, upstream_port)
+                            req_log.dns_ms, req_log.connect_ms = conn.dns_ms, conn.connect_ms
+                            conn.writer.write(request_data)
+                            await conn.writer.drain()
+                            continue
+                        raise
+                    response = parse_response_head(response_data)
+                    stall.touch()
+                    if req_log.ttfb_ms is None:
+                        req_log.ttfb_ms = (time.time() - start_time) * 1000
+                    if 100 <= response.status < 200 and response.status != 101:
+                        writer.write(response_data)
+                        await writer.drain()
+                        continue
+                    break
+                req_log.status_code = response.status
+
+                if head.method == 'HEAD' or response.status in (204, 304):
+                    response_framing = ('length', 0)
+                else:
+                    response_framing = body_framing(response.headers)
+
+                # 上游按 EOF 结束响应体时，客户端连接也只能随之关闭
+                if response_framing[0] == 'eof':
+                    client_keep_alive = False
+
+                # 重写响应头中的逐跳头部
+                dropped = HOP_BY_HOP_HEADERS | connection_tokens(response.headers)
+                lines = [f"{response.version} {response.status} {response.reason}".rstrip()]
+                for name, value in response.headers:
+                    if name.lower() not in dropped:
+                        lines.append(f"{name}: {value}")
+                lines.append("Connection: keep-alive" if client_keep_alive else "Connection: close")
+
+                # 流式转发响应
+                response_started = True
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+                req_log.response_size = await relay_body(
+                    conn.reader, writer, *response_framing, on_data=stall.touch, shaper=shaper
+                )
+                await writer.drain()
+
+                if upload is not None and not upload.done():
+                    # 请求体的最后一段可能仍在发送中，稍等片刻
+                    await asyncio.wait([upload], timeout=UPLOAD_GRACE_SECONDS)
+                upload_complete = upload is None or (
+                    upload.done() and not upload.cancelled() and upload.exception() is None
+                )
+                if upload is not None and upload_complete:
+                    req_log.request_size = upload.result()
+                # 请求体未读完时客户端连接上残留数据，不能继续使用
+                if not upload_complete:
+                    client_keep_alive = False
+                upstream_reusable = (
+                    upload_complete
+                    and response_framing[0] != 'eof'
+                    and wants_keep_alive(response.version, response.headers)
+                )
+            finally:
+                if upload is not None and not upload.done():
+                    upload.cancel()
+                self.pool.release(conn, upstream_reusable)
 
+            stall.cancel()
             req_log.duration_ms = (time.time() - start_time) * 1000
-
-            conn.close()
-
-        except Exception as e:
-            req_log.error = str(e)
+            return client_keep_alive
+
+        except (Exception, asyncio.CancelledError) as e:
+            stall.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                if not stall.fired:
+                    raise
+                e = self._stall_error(stall)
+            req_log.error = str(e) or type(e).__name__
             req_log.duration_ms = (time.time() - start_time) * 1000
-            try:
-                self.send_error(502, f"Proxy Error: {e}")
-            except:
-                pass
+            if not response_started:
+                await self._send_error(
+                    writer, self._error_status(e), f"Proxy Error: {req_log.error}"
+                )
+            return False
         finally:
-            if self.monitor:
-                self.monitor.log_request(req_log)
-
-    def _tunnel(self, client_socket, target_socket):
-        """双向转发数据（用于 HTTPS 隧道）"""
-        def forward(source, destination):
-            try:
-                while True:
-                    data = source.recv(8192)
-                    if not data:
-                        break
-                    destination.sendall(data)
-            except:
-                pass
-            finally:
+            self.monitor.log_request(req_log)
+
+    async def _fetch(self, host: str, path: str, headers: List[tuple], req_log: RequestLog,
+                     start_time: float) -> tuple:
+        """
+        向上游发送无请求体的 GET，返回 (连接, 最终响应头)
+
+        复用的连接已被上游关闭时换新连接重试一次；1xx 中间响应直接丢弃。
+        调用方负责归还连接。
+        """
+        dropped = HOP_BY_HOP_HEADERS | connection_tokens(headers)
+        lines = [f"GET {path} HTTP/1.1"]
+        for name, value in headers:
+            if name.lower() not in dropped:
+                lines.append(f"{name}: {value}")
+        lines.append("Connection: keep-alive")
+        request_data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        upstream_host, upstream_port = split_host_port(host, 80)
+        conn = await self.pool.acquire(upstream_host, upstream_port)
+        self.monitor.stats.upstream_requests += 1
+        if not conn.requests:
+            req_log.dns_ms, req_log.connect_ms = conn.dns_ms, conn.connect_ms
+        try:
+            conn.writer.write(request_data)
+            await conn.writer.drain()
+            while True:
                 try:
-                    source.close()
-                    destination.close()
-                except:
-                    pass
-
-        # 创建两个线程进行双向转发
-        client_to_target = threading.Thread(
-            target=forward, args=(client_socket, target_socket)
-        )
-        target_to_client = threading.Thread(
-            target=forward, args=(target_socket, client_socket)
+                    response_data = await conn.reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    if conn.requests and req_log.ttfb_ms is None:
+                        self.pool.release(conn, reusable=False)
+                        conn = None
+                        conn = await self.pool.acquire(upstream_host, upstream_port)
+                        req_log.dns_ms, req_log.connect_ms = conn.dns_ms, conn.connect_ms
+                        conn.writer.write(request_data)
+                        await conn.writer.drain()
+                        continue
+                    raise
+                response = parse_response_head(response_data)
+                if req_log.ttfb_ms is None:
+                    req_log.ttfb_ms = (time.time() - start_time) * 1000
+                if 100 <= response.status < 200:
+                    continue
+                return conn, response
+        except BaseException:
+            if conn is not None:
+                self.pool.release(conn, reusable=False)
+            raise
+
+    async def _send_cached(self, entry, body, head: HTTPRequestHead, writer, req_log: RequestLog,
+                           keep_alive: bool, on_progress: Callable[[], None]):
+        """从缓存返回响应（客户端的条件请求命中时回复 304；每发送一段调用 on_progress）"""
+        with body:
+            not_modified = entry.not_modified_for(head.headers)
+            headers = cached_response_head(entry, time.time(), req_log.cache_status, not_modified)
+            if not_modified:
+                status_line = "HTTP/1.1 304 Not Modified"
+            else:
+                status_line = f"HTTP/1.1 {entry.status} {entry.reason}".rstrip()
+                headers.append(('Content-Length', str(entry.size)))
+            lines = [status_line] + [f"{name}: {value}" for name, value in headers]
+            lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            req_log.status_code = 304 if not_modified else entry.status
+            if not_modified or not entry.size:
+                await writer.drain()
+                return
+            # 正文用 sendfile 直接从文件发送到 socket
+            loop = asyncio.get_running_loop()
+            for offset in range(0, entry.size, SENDFILE_CHUNK_SIZE):
+                count = min(SENDFILE_CHUNK_SIZE, entry.size - offset)
+                await loop.sendfile(writer.transport, body, offset, count)
+                req_log.response_size += count
+                on_progress()
+
+    async def _cached_request(
+        self, head: HTTPRequestHead, writer, origin: tuple, shaper: Optional[Shaper] = None
+    ) -> bool:
+        """
+        经由磁盘缓存处理可缓存的 GET 请求
+
+        新鲜的条目直接从磁盘返回；过期的条目带验证器向上游确认；未命中时
+        边转发边写入缓存。同一 URL 的并发未命中只有一个请求访问上游。
+
+        Returns:
+            客户端连接能否继续用于下一个请求
+        """
+        host, path = request_target(head)
+        url = f"http://{host}{path}"
+        req_log = RequestLog(
+            timestamp=datetime.now().isoformat(),
+            method=head.method,
+            url=url,
+            host=host,
+            path=path,
         )
+        req_log.attribute(origin)
 
-        client_to_target.daemon = True
-        target_to_client.daemon = True
+        start_time = time.time()
+        response_started = False
+        client_keep_alive = wants_keep_alive(head.version, head.headers)
+        cache = self.cache
+        leader = False
+        stored = False
+        stall = IdleTimer(self.idle_timeout, asyncio.current_task().cancel)
 
-        client_to_target.start()
-        target_to_client.start()
+        try:
+            if not host:
+                raise ValueError("Missing Host")
+            revalidate = request_requires_revalidation(head.headers)
+            entry = cache.lookup(url, head.headers)
+            if entry is None or revalidate or not entry.fresh(time.time()):
+                leader, flight = cache.join_flight(url)
+                if not leader:
+                    # 同一 URL 正在从上游获取：等待完成后再查缓存（由获取方的
+                    # 空闲超时保证结束，等待期间不计时）
+                    stall.cancel()
+                    await asyncio.shield(flight)
+                    stall.start()
+                    entry = cache.lookup(url, head.headers)
+                    revalidate = False
+
+            if entry is not None and not revalidate and entry.fresh(time.time()):
+                opened = cache.open_body(entry)
+                if opened is not None:
+                    req_log.cache_status = 'HIT'
+                    response_started = True
+                    await self._send_cached(
+                        *opened, head, writer, req_log, client_keep_alive, stall.touch
+                    )
+                    stall.cancel()
+                    req_log.duration_ms = (time.time() - start_time) * 1000
+                    return client_keep_alive
+
+            # 未命中或需要重新验证。有验证器时用缓存的验证器代替客户端自己的
+            # 条件请求头（客户端的条件由缓存在返回时处理）
+            stale = entry if entry is not None and entry.validators() else None
+            headers = head.headers
+            if stale is not None:
+                headers = [
+                    (k, v) for k, v in headers
+                    if k.lower() not in ('if-none-match', 'if-modified-since')
+                ] + stale.validators()
+            conn, response = await self._fetch(host, path, headers, req_log, start_time)
+            stall.touch()
+
+            upstream_reusable = False
+            cache_writer = None
+            try:
+                if response.status == 304 and stale is not None:
+                    # 未修改：只更新元数据
+                    upstream_reusable = wants_keep_alive(response.version, response.headers)
+                    entry = cache.refresh(stale, response.headers)
+                    stored = True
+                    opened = cache.open_body(entry)
+                    if opened is None:
+                        raise FileNotFoundError("Cached body was evicted during revalidation")
+                    req_log.cache_status = 'REVALIDATED'
+                    response_started = True
+                    await self._send_cached(
+                        *opened, head, writer, req_log, client_keep_alive, stall.touch
+                    )
+                else:
+                    req_log.cache_status = 'MISS'
+                    req_log.status_code = response.status
+                    if response.status in (204, 304):
+                        framing = ('length', 0)
+                    else:
+                        framing = body_framing(response.headers)
+                    if framing[0] == 'eof':
+                        client_keep_alive = False
+                    cache_writer = cache.begin(
+                        url, response.status, response.reason, head.headers, response.headers,
+                        framing[1] if framing[0] == 'length' else None,
+                    )
+                    if cache_writer is None and leader:
+                        # 不会被缓存：不必让等待中的请求等到下载结束
+                        cache.end_flight(url, False)
+                        leader = False
+
+                    dropped = HOP_BY_HOP_HEADERS | connection_tokens(response.headers)
+                    lines = [f"{response.version} {response.status} {response.reason}".rstrip()]
+                    for name, value in response.headers:
+                        if name.lower() not in dropped:
+                            lines.append(f"{name}: {value}")
+                    if framing[0] == 'chunked':
+                        lines.append("Transfer-Encoding: chunked")
+                    lines.append("X-Cache: MISS")
+                    lines.append("Connection: keep-alive" if client_keep_alive else "Connection: close")
+
+                    response_started = True
+                    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+                    # 分块重新编码转发给客户端，缓存中只保存载荷
+                    chunked = framing[0] == 'chunked'
+                    async for data in iter_body(conn.reader, *framing):
+                        if chunked:
+                            writer.write(b'%x\r\n' % len(data))
+                        writer.write(data)
+                        if chunked:
+                            writer.write(b'\r\n')
+                        req_log.response_size += len(data)
+                        if cache_writer is not None:
+                            await cache_writer.write_async(data)
+                        await writer.drain()
+                        stall.touch()
+                        if shaper is not None:
+                            await shaper.throttle(len(data))
+                    if chunked:
+                        writer.write(b'0\r\n\r\n')
+                    await writer.drain()
+
+                    if cache_writer is not None:
+                        stored = await cache_writer.commit_async() is not None
+                        cache_writer = None
+                    upstream_reusable = (
+                        framing[0] != 'eof' and wants_keep_alive(response.version, response.headers)
+                    )
+            finally:
+                if cache_writer is not None:
+                    cache_writer.abort()
+                self.pool.release(conn, upstream_reusable)
+
+            stall.cancel()
+            req_log.duration_ms = (time.time() - start_time) * 1000
+            return client_keep_alive
+
+        except (Exception, asyncio.CancelledError) as e:
+            stall.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                if not stall.fired:
+                    raise
+                e = self._stall_error(stall)
+            req_log.error = str(e) or type(e).__name__
+            req_log.duration_ms = (time.time() - start_time) * 1000
+            if not response_started:
+                await self._send_error(
+                    writer, self._error_status(e), f"Proxy Error: {req_log.error}"
+                )
+            return False
+        finally:
+            if leader:
+                cache.end_flight(url, stored)
+            self.monitor.log_request(req_log)
 
-        # 等待其中一个方向结束
-        client_to_target.join()
-        target_to_client.join()
 
-    def log_message(self, format, *args):
-        """禁用默认日志输出"""
+def raise_fd_limit():
+    """提高文件描述符上限（每个隧道占用两个 fd）"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = hard if hard != resource.RLIM_INFINITY else 65536
+        if soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ImportError, ValueError, OSError):
         pass
 
 
@@ -320,37 +1888,114 @@ def run_proxy_server(
     port: int = 7890,
     log_file: Optional[str] = None,
     verbose: bool = False,
+    max_connections: int = 10000,
+    max_upstream_per_host: int = 32,
+    upstream_idle_timeout: float = 30.0,
+    connect_timeout: float = 30.0,
+    dns_ttl: float = DEFAULT_TTL,
+    archive_path: Optional[str] = None,
+    metrics_port: Optional[int] = None,
+    workers: int = 1,
+    cache_dir: Optional[str] = None,
+    cache_size_mb: int = 10240,
+    policy_path: Optional[str] = None,
+    max_pending: int = 1000,
+    queue_timeout: float = 10.0,
+    max_client_connections: int = 2000,
+    idle_timeout: float = 300.0,
+    tunnel_idle_timeout: float = 600.0,
+    tunnel_max_lifetime: float = 0,
+    max_lifetime: float = 3600.0,
 ):
-    """启动代理服务器"""
+    """启动代理服务器（workers > 1 时为多进程模式，见 proxy_workers）"""
     # 创建监控器
-    monitor = ProxyMonitor(log_file=log_file, verbose=verbose)
-    ProxyHandler.monitor = monitor
-
-    # 创建服务器
-    server = HTTPServer((host, port), ProxyHandler)
+    archive = ProxyArchive(archive_path) if archive_path else None
+    monitor = ProxyMonitor(log_file=log_file, verbose=verbose, archive=archive)
+    raise_fd_limit()
 
-    monitor.logger.info(f"Proxy server listening on {host}:{port}")
-    monitor.logger.info(f"Configure VM to use: http://192.168.5.2:{port}")
-    if log_file:
-        monitor.logger.info(f"Logging to: {log_file}")
+    # 启动前检查策略文件，格式错误时直接退出
+    try:
+        policy = PolicyEngine(policy_path) if policy_path else None
+    except (OSError, ValueError) as e:
+        monitor.logger.error(f"Failed to load proxy policy {policy_path}: {e}")
+        sys.exit(1)
 
-    # 启动统计输出线程
-    def print_stats():
+    # 创建服务器
+    options = dict(
+        max_connections=max_connections,
+        max_upstream_per_host=max_upstream_per_host,
+        upstream_idle_timeout=upstream_idle_timeout,
+        connect_timeout=connect_timeout,
+        dns_ttl=dns_ttl,
+        max_pending=max_pending,
+        queue_timeout=queue_timeout,
+        max_client_connections=max_client_connections,
+        idle_timeout=idle_timeout,
+        tunnel_idle_timeout=tunnel_idle_timeout,
+        tunnel_max_lifetime=tunnel_max_lifetime,
+        max_lifetime=max_lifetime,
+    )
+    cache_max_bytes = cache_size_mb * 1024 * 1024
+    if workers > 1:
+        # worker 各自打开同一个缓存目录
+        if cache_dir:
+            options.update(cache_dir=cache_dir, cache_max_bytes=cache_max_bytes)
+        # 各 worker 各自加载并监视策略文件
+        if policy_path:
+            options.update(policy_path=policy_path)
+        server = WorkerPool(monitor, workers, host=host, port=port, verbose=verbose, **options)
+    else:
+        cache = HttpCache(cache_dir, max_bytes=cache_max_bytes) if cache_dir else None
+        server = ProxyServer(monitor, host=host, port=port, cache=cache, policy=policy, **options)
+    # 本机的 /metrics、/stats、/recent 接口
+    metrics = MetricsServer(monitor, server, port=metrics_port) if metrics_port is not None else None
+
+    async def print_stats():
         while True:
-            time.sleep(60)  # 每分钟输出一次统计
+            await asyncio.sleep(60)  # 每分钟输出一次统计
             stats = monitor.get_stats()
             monitor.logger.info(
                 f"Stats: {stats['total_requests']} requests, "
                 f"{stats['unique_hosts']} unique hosts, "
-                f"{stats['total_bytes'] / 1024 / 1024:.2f} MB transferred"
+                f"p50/p99 {stats['latency']['total']['p50']}/{stats['latency']['total']['p99']} ms, "
+                f"cache hit ratio {stats['cache']['hit_ratio']:.1%}, "
+                f"{stats['total_bytes'] / 1024 / 1024:.2f} MB transferred, "
+                f"{server.active_connections} active connections, "
+                f"{sum(stats['rejected'].values())} rejected"
             )
 
-    stats_thread = threading.Thread(target=print_stats, daemon=True)
-    stats_thread.start()
+    async def main():
+        await server.start()
+        monitor.logger.info(f"Proxy server listening on {host}:{server.port}")
+        if workers > 1:
+            mode = "SO_REUSEPORT" if server.reuse_port else "shared socket"
+            monitor.logger.info(f"Running {workers} worker processes ({mode})")
+        monitor.logger.info(f"Configure VM to use: http://192.168.5.2:{server.port}")
+        if log_file:
+            monitor.logger.info(f"Logging to: {log_file}")
+        if archive:
+            monitor.logger.info(f"Archiving requests to: {archive.path}")
+        if cache_dir:
+            monitor.logger.info(f"Caching HTTP responses in: {cache_dir} (max {cache_size_mb} MB)")
+        if policy:
+            monitor.logger.info(f"Proxy policy: {policy_path} ({len(policy.policy)} rules)")
+        if metrics:
+            await metrics.start()
+            monitor.logger.info(
+                f"Metrics on http://127.0.0.1:{metrics.port}/metrics (also /stats, /recent)"
+            )
+        # 启动统计输出任务
+        stats_task = asyncio.create_task(print_stats())
+        try:
+            await server.serve_forever()
+        finally:
+            stats_task.cancel()
+            if metrics:
+                metrics.close()
 
     # 启动服务器
     try:
-        server.serve_forever()
+        asyncio.run(main())
     except KeyboardInterrupt:
         monitor.logger.info("\nShutting down proxy server...")
 
@@ -359,8 +2004,13 @@ def run_proxy_server(
             export_file = log_file.replace('.log', '_export.json')
             monitor.export_logs(export_file)
 
-        server.shutdown()
         monitor.logger.info("Proxy server stopped")
+    finally:
+        if archive:
+            archive.close()
+            if archive.dropped:
+                monitor.logger.warning(f"Archive dropped {archive.dropped} records")
+        monitor.close()
 
 
 if __name__ == '__main__':
@@ -389,6 +2039,116 @@ if __name__ == '__main__':
         action='store_true',
         help='Enable verbose logging'
     )
+    parser.add_argument(
+        '--max-connections',
+        type=int,
+        default=10000,
+        help='Maximum concurrent client connections, more wait in a queue (default: 10000)'
+    )
+    parser.add_argument(
+        '--max-pending',
+        type=int,
+        default=1000,
+        help='Connections allowed to wait for a free slot, more get 503 (default: 1000)'
+    )
+    parser.add_argument(
+        '--queue-timeout',
+        type=float,
+        default=10.0,
+        help='Reject a queued connection with 503 after N seconds (default: 10)'
+    )
+    parser.add_argument(
+        '--max-client-connections',
+        type=int,
+        default=2000,
+        help='Maximum concurrent connections per client address, 0 for no limit (default: 2000)'
+    )
+    parser.add_argument(
+        '--idle-timeout',
+        type=float,
+        default=300.0,
+        help='Abort an HTTP request that transfers no data for N seconds (default: 300)'
+    )
+    parser.add_argument(
+        '--tunnel-idle-timeout',
+        type=float,
+        default=600.0,
+        help='Close a CONNECT tunnel idle in both directions for N seconds (default: 600)'
+    )
+    parser.add_argument(
+        '--tunnel-max-lifetime',
+        type=float,
+        default=0,
+        help='Close CONNECT tunnels open longer than N seconds, 0 for no limit (default: 0)'
+    )
+    parser.add_argument(
+        '--max-lifetime',
+        type=float,
+        default=3600.0,
+        help='Close keep-alive client and upstream connections older than N seconds '
+             'between requests (default: 3600)'
+    )
+    parser.add_argument(
+        '--max-upstream-per-host',
+        type=int,
+        default=32,
+        help='Maximum pooled upstream connections per host (default: 32)'
+    )
+    parser.add_argument(
+        '--upstream-idle-timeout',
+        type=float,
+        default=30.0,
+        help='Close idle upstream connections after N seconds (default: 30)'
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        type=float,
+        default=30.0,
+        help='Timeout in seconds for connecting to an upstream server (default: 30)'
+    )
+    parser.add_argument(
+        '--dns-ttl',
+        type=float,
+        default=DEFAULT_TTL,
+        help=f'Cache resolved upstream addresses for N seconds (default: {DEFAULT_TTL:g})'
+    )
+    parser.add_argument(
+        '--archive',
+        nargs='?',
+        const=os.environ.get('COWORK_PROXY_ARCHIVE', DEFAULT_ARCHIVE_PATH),
+        help='Persist request logs to a SQLite archive '
+             f'(default path: $COWORK_PROXY_ARCHIVE or {DEFAULT_ARCHIVE_PATH})'
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        help='Serve /metrics, /stats and /recent on 127.0.0.1:PORT (disabled by default)'
+    )
+    parser.add_argument(
+        '--cache',
+        nargs='?',
+        const=os.environ.get('COWORK_PROXY_CACHE', DEFAULT_CACHE_DIR),
+        help='Cache cacheable plain-HTTP GET responses on disk '
+             f'(default dir: $COWORK_PROXY_CACHE or {DEFAULT_CACHE_DIR})'
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=10240,
+        help='Maximum cache size in MB, least recently used entries are evicted (default: 10240)'
+    )
+    parser.add_argument(
+        '--policy',
+        default=os.environ.get('COWORK_PROXY_POLICY'),
+        help='JSON file with host allow/deny rules and rate limits, reloaded on change '
+             '(default: $COWORK_PROXY_POLICY)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of proxy worker processes sharing the port (default: 1)'
+    )
 
     args = parser.parse_args()
 
@@ -397,4 +2157,22 @@ if __name__ == '__main__':
         port=args.port,
         log_file=args.log_file,
         verbose=args.verbose,
+        max_connections=args.max_connections,
+        max_upstream_per_host=args.max_upstream_per_host,
+        upstream_idle_timeout=args.upstream_idle_timeout,
+        connect_timeout=args.connect_timeout,
+        dns_ttl=args.dns_ttl,
+        archive_path=args.archive,
+        metrics_port=args.metrics_port,
+        workers=args.workers,
+        cache_dir=args.cache,
+        cache_size_mb=args.cache_size,
+        policy_path=args.policy,
+        max_pending=args.max_pending,
+        queue_timeout=args.queue_timeout,
+        max_client_connections=args.max_client_connections,
+        idle_timeout=args.idle_timeout,
+        tunnel_idle_timeout=args.tunnel_idle_timeout,
+        tunnel_max_lifetime=args.tunnel_max_lifetime,
+        max_lifetime=args.max_lifetime,
     )
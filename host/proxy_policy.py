@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+代理的访问策略和限速
+
+策略文件（JSON）描述沙盒可以访问哪些主机，以及按主机 / 按客户端的限速：
+
+    {
+      "default": "allow",
+      "rules": [
+        {"match": ["169.254.0.0/16", "10.0.0.0/8"], "action": "deny"},
+        {"match": "*.tracking.example.com", "action": "deny"},
+        {"match": ".githubusercontent.com", "bandwidth": "20MB"},
+        {"match": "pypi.org", "requests_per_second": 50}
+      ],
+      "client": {"bandwidth": "50MB", "requests_per_second": 200}
+    }
+
+match 的写法：
+- pypi.org：只匹配该主机
+- *.example.com：只匹配子域名
+- .example.com：匹配该域名及其子域名
+- 10.0.0.0/8、::1：IP 地址段（匹配 IP 形式的主机，以及域名解析得到的地址）
+
+域名规则编译为按标签反序的后缀树，查找开销只与主机名的标签数有关（与规则数
+无关）；多条规则匹配时取最具体的一条（精确 > 更长的后缀），同一写法出现多次时
+以最后一条为准。IP 规则按前缀长度分组做最长前缀匹配。没有规则匹配时使用 default。
+解析得到的地址命中 deny 的 IP 规则时同样拒绝连接（防止用域名绕过地址段限制）。
+
+限速使用令牌桶：
+- requests_per_second：超过时返回 429（带 Retry-After）
+- bandwidth：每秒字节数（可写作 "512KB"、"20MB"），超过时暂停转发，平均速率
+  不超过该值（允许一秒的突发）
+
+规则中的限速按每个主机分别计算，client 中的限速按每个沙箱计算（沙箱名来自
+控制器注入的代理认证，见 proxy_accounting.parse_attribution；没有沙箱名时按
+来源 IP）。Lima 的 usernet 网络中所有 VM 访问代理的来源地址相同，按来源 IP
+计算时所有沙箱共用一个限额。
+策略文件修改后自动重新加载，不需要重启代理；加载失败时继续使用旧策略。
+"""
+
+import asyncio
+import ipaddress
+import json
+import os
+import re
+import socket
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+# 检查策略文件是否修改的间隔（秒）
+RELOAD_INTERVAL = 2.0
+# 最多保留的令牌桶数（超过时丢弃最久未用的，被丢弃的桶重新创建时是满的）
+MAX_BUCKETS = 100000
+
+ACTIONS = ('allow', 'deny')
+_UNITS = {
+    '': 1, 'B': 1, 'K': 1024, 'KB': 1024,
+    'M': 1024 ** 2, 'MB': 1024 ** 2, 'G': 1024 ** 3, 'GB': 1024 ** 3,
+}
+
+
+class PolicyError(ValueError):
+    """策略文件格式错误"""
+
+
+def parse_rate(value) -> Optional[float]:
+    """解析每秒字节数：数字或 "512KB" / "20MB" / "1.5G"（1024 进制）"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        rate = float(value)
+    else:
+        match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*(?:/s)?\s*', str(value), re.IGNORECASE)
+        if not match:
+            raise PolicyError(f"Invalid rate: {value!r}")
+        rate = float(match.group(1)) * _UNITS[match.group(2).upper()]
+    if rate <= 0:
+        raise PolicyError(f"Rate must be positive: {value!r}")
+    return rate
+
+
+def normalize_host(host: str) -> str:
+    return host.strip('[]').rstrip('.').lower()
+
+
+@dataclass
+class Rule:
+    """一条策略规则"""
+    pattern: str
+    action: str = 'allow'
+    bandwidth: Optional[float] = None  # 每个主机每秒字节数
+    requests_per_second: Optional[float] = None  # 每个主机每秒请求数
+
+    @property
+    def allowed(self) -> bool:
+        return self.action == 'allow'
+
+
+class DomainTrie:
+    """
+    按标签反序的域名后缀树
+
+    节点为 [子节点字典, 精确匹配的规则, 子域名匹配的规则]。
+    """
+
+    def __init__(self):
+        self.root: list = [{}, None, None]
+        self.size = 0
+
+    def add(self, pattern: str, rule: Rule):
+        subdomains = exact = False
+        if pattern.startswith('*.'):
+            pattern, subdomains = pattern[2:], True
+        elif pattern.startswith('.'):
+            pattern, subdomains, exact = pattern[1:], True, True
+        else:
+            exact = True
+        node = self.root
+        for label in reversed(pattern.split('.')):
+            node = node[0].setdefault(label, [{}, None, None])
+        if exact:
+            node[1] = rule
+        if subdomains:
+            node[2] = rule
+        self.size += 1
+
+    def lookup(self, host: str) -> Optional[Rule]:
+        """最具体的匹配规则（O(标签数)）"""
+        labels = host.split('.')
+        node = self.root
+        best = None
+        for i in range(len(labels) - 1, -1, -1):
+            node = node[0].get(labels[i])
+            if node is None:
+                return best
+            if i and node[2] is not None:
+                # 子域名规则只匹配比该节点更深的主机
+                best = node[2]
+        return node[1] or best
+
+
+class CidrTable:
+    """按前缀长度分组的最长前缀匹配（O(不同前缀长度数)）"""
+
+    def __init__(self):
+        # 版本 -> [(前缀长度, {网络号: 规则})]，按前缀长度降序
+        self.tables: Dict[int, List[Tuple[int, Dict[int, Rule]]]] = {4: [], 6: []}
+        self.size = 0
+
+    def add(self, network: ipaddress._BaseNetwork, rule: Rule):
+        bits = network.max_prefixlen
+        groups = self.tables[network.version]
+        for prefixlen, networks in groups:
+            if prefixlen == network.prefixlen:
+                break
+        else:
+            networks = {}
+            groups.append((network.prefixlen, networks))
+            groups.sort(key=lambda group: -group[0])
+        networks[int(network.network_address) >> (bits - network.prefixlen)] = rule
+        self.size += 1
+
+    def lookup(self, address: Tuple[int, int]) -> Optional[Rule]:
+        """address 为 parse_address() 的结果"""
+        version, value = address
+        bits = 32 if version == 4 else 128
+        for prefixlen, networks in self.tables[version]:
+            rule = networks.get(value >> (bits - prefixlen))
+            if rule is not None:
+                return rule
+        return None
+
+
+def parse_address(host: str) -> Optional[Tuple[int, int]]:
+    """IP 地址 -> (版本, 整数值)；不是 IP 地址时返回 None"""
+    # 域名的最后一个标签不会是纯数字，绝大多数主机名不必尝试解析
+    if not host or not (host[-1].isdigit() or ':' in host):
+        return None
+    version = 6 if ':' in host else 4
+    try:
+        packed = socket.inet_pton(socket.AF_INET6 if version == 6 else socket.AF_INET, host)
+    except OSError:
+        return None
+    return version, int.from_bytes(packed, 'big')
+
+
+def _looks_like_network(pattern: str) -> bool:
+    return '/' in pattern or ':' in pattern or pattern[-1:].isdigit()
+
+
+class Policy:
+    """编译后的策略（不可变，重新加载时整体替换）"""
+
+    def __init__(
+        self,
+        rules: List[Rule],
+        default: str = 'allow',
+        client_bandwidth: Optional[float] = None,
+        client_requests_per_second: Optional[float] = None,
+    ):
+        if default not in ACTIONS:
+            raise PolicyError(f"Invalid default action: {default!r}")
+        self.default = default
+        self.client_bandwidth = client_bandwidth
+        self.client_requests_per_second = client_requests_per_second
+        self.default_rule = Rule('(default)', default)
+        self.domains = DomainTrie()
+        self.networks = CidrTable()
+        for rule in rules:
+            pattern = normalize_host(rule.pattern)
+            if _looks_like_network(pattern):
+                try:
+                    self.networks.add(ipaddress.ip_network(pattern, strict=False), rule)
+                except ValueError:
+                    raise PolicyError(f"Invalid address or network: {rule.pattern!r}") from None
+                continue
+            name = pattern[2:] if pattern.startswith('*.') else pattern.lstrip('.')
+            if not name or '*' in name or '/' in name or '..' in name:
+                raise PolicyError(f"Invalid pattern: {rule.pattern!r}")
+            self.domains.add(pattern, rule)
+
+    def __len__(self) -> int:
+        return self.domains.size + self.networks.size
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Policy':
+        if not isinstance(data, dict):
+            raise PolicyError("Policy must be a JSON object")
+        rules = []
+        for n, item in enumerate(data.get('rules', [])):
+            if not isinstance(item, dict) or 'match' not in item:
+                raise PolicyError(f"Rule {n}: expected an object with 'match'")
+            action = item.get('action', 'allow')
+            if action not in ACTIONS:
+                raise PolicyError(f"Rule {n}: invalid action {action!r}")
+            patterns = item['match'] if isinstance(item['match'], list) else [item['match']]
+            bandwidth = parse_rate(item.get('bandwidth'))
+            rps = item.get('requests_per_second')
+            if rps is not None and (not isinstance(rps, (int, float)) or rps <= 0):
+                raise PolicyError(f"Rule {n}: requests_per_second must be a positive number")
+            for pattern in patterns:
+                rules.append(Rule(str(pattern), action, bandwidth, rps))
+        client = data.get('client') or {}
+        client_rps = client.get('requests_per_second')
+        if client_rps is not None and (not isinstance(client_rps, (int, float)) or client_rps <= 0):
+            raise PolicyError("client.requests_per_second must be a positive number")
+        return cls(
+            rules,
+            default=data.get('default', 'allow'),
+            client_bandwidth=parse_rate(client.get('bandwidth')),
+            client_requests_per_second=client_rps,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'Policy':
+        try:
+            with open(os.path.expanduser(path)) as f:
+                data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise PolicyError(f"Invalid JSON: {e}") from None
+        return cls.from_dict(data)
+
+    def match(self, host: str) -> Rule:
+        """host（已规范化）适用的规则，没有匹配时为默认规则"""
+        address = parse_address(host)
+        if address is not None:
+            rule = self.networks.lookup(address)
+        else:
+            rule = self.domains.lookup(host)
+        return rule or self.default_rule
+
+    def address_denied(self, ip: str) -> Optional[Rule]:
+        """解析得到的地址命中的 deny 规则"""
+        address = parse_address(ip)
+        if address is None:
+            return None
+        rule = self.networks.lookup(address)
+        return rule if rule is not None and not rule.allowed else None
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多累积 capacity 个"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n: float = 1.0) -> float:
+        """令牌足够时取走并返回 0，否则不取并返回需要等待的秒数"""
+        self._refill(time.monotonic())
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def consume(self, n: float) -> float:
+        """取走 n 个令牌（允许透支），返回为保持平均速率需要等待的秒数"""
+        self._refill(time.monotonic())
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Shaper:
+    """一个请求适用的带宽令牌桶（主机和客户端）"""
+
+    __slots__ = ('buckets',)
+
+    def __init__(self, buckets: List[TokenBucket]):
+        self.buckets = buckets
+
+    def consume(self, n: int) -> float:
+        return max(bucket.consume(n) for bucket in self.buckets)
+
+    async def throttle(self, n: int):
+        delay = self.consume(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+@dataclass
+class Decision:
+    """一个请求的策略检查结果"""
+    allowed: bool
+    rule: Rule
+    status: int = 200  # 拒绝时为 403 / 429
+    reason: str = ''
+    retry_after: float = 0.0
+    shaper: Optional[Shaper] = None
+
+
+class PolicyEngine:
+    """
+    运行中的策略：编译后的 Policy、令牌桶状态和重新加载
+
+    Args:
+        path: 策略文件路径（修改后自动重新加载）
+        policy: 直接指定的 Policy（程序化使用）
+    """
+
+    def __init__(self, path: Optional[str] = None, policy: Optional[Policy] = None):
+        self.path = path
+        self.policy = policy if policy is not None else Policy.load(path) if path else Policy([])
+        self.reloads = 0
+        self._mtime = self._stat()
+        self._buckets: "OrderedDict[tuple, TokenBucket]" = OrderedDict()
+
+    def _stat(self) -> Optional[float]:
+        try:
+            return os.stat(os.path.expanduser(self.path)).st_mtime if self.path else None
+        except OSError:
+            return None
+
+    def _bucket(self, key: tuple, rate: float) -> TokenBucket:
+        key = key + (rate,)  # 速率变化（重新加载）后使用新的桶
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate)
+            if len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def check(self, host: str, client: str = '', sandbox: Optional[str] = None) -> Decision:
+        """
+        检查一个请求：访问规则、请求速率，并返回适用的带宽限制
+
+        client 为来源 IP；sandbox 为请求所属的沙箱（有时按沙箱而不是来源 IP 限速）
+        """
+        policy = self.policy
+        host = normalize_host(host)
+        rule = policy.match(host)
+        if not rule.allowed:
+            return Decision(False, rule, 403, f"{host} is blocked by proxy policy ({rule.pattern})")
+
+        client_key = ('sandbox', sandbox) if sandbox else ('ip', client)
+        for kind, key, rate in (
+            ('host-rps', host, rule.requests_per_second),
+            ('client-rps', client_key, policy.client_requests_per_second),
+        ):
+            if rate is not None:
+                wait = self._bucket((kind, key), rate).try_take()
+                if wait > 0:
+                    name = key if kind == 'host-rps' else key[1] or 'client'
+                    return Decision(False, rule, 429, f"Rate limit exceeded for {name}", wait)
+
+        buckets = []
+        if rule.bandwidth is not None:
+            buckets.append(self._bucket(('host-bw', host), rule.bandwidth))
+        if policy.client_bandwidth is not None:
+            buckets.append(self._bucket(('client-bw', client_key), policy.client_bandwidth))
+        return Decision(True, rule, shaper=Shaper(buckets) if buckets else None)
+
+    def address_allowed(self, ip: str) -> bool:
+        """解析得到的地址是否允许连接"""
+        return self.policy.address_denied(ip) is None
+
+    async def watch(self, logger, interval: float = RELOAD_INTERVAL):
+        """策略文件修改后自动重新加载"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            mtime = self._stat()
+            if mtime is None or mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                policy = await loop.run_in_executor(None, Policy.load, self.path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to reload proxy policy {self.path}, keeping the previous one: {e}")
+                continue
+            self.policy = policy
+            self.reloads += 1
+            logger.info(f"Reloaded proxy policy from {self.path} ({len(policy)} rules)")
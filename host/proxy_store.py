@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+代理请求日志存储
+
+固定容量的环形缓冲区，按列存储请求记录：
+- 数值列使用 array（时间戳为 Unix 时间浮点数）
+- 方法、主机、错误、关闭原因、客户端、沙箱、任务、trace 等低基数字符串存为符号表中的编号
+- span 编号（64 位，每个请求不同）直接存为整数
+- 路径同样存入符号表：重复路径只保存一份，不再被引用的路径在压缩时释放
+
+追加为 O(1)。10 万条记录的列约占用 10 MB；路径字符串另计，符号表最多
+保留 2 倍容量的不同路径，路径全部不同时（最坏情况）总共约 60 MB。
+"""
+
+import math
+import threading
+import time
+from array import array
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+# 缓存状态的编码（0 表示未经过缓存）
+CACHE_STATUSES = (None, 'HIT', 'MISS', 'REVALIDATED')
+_CACHE_CODES = {status: code for code, status in enumerate(CACHE_STATUSES)}
+
+
+def _span_number(span_id: Optional[str]) -> int:
+    return int(span_id, 16) if span_id else 0
+
+
+def _span_hex(number: int) -> Optional[str]:
+    return f"{number:016x}" if number else None
+
+
+class SymbolTable:
+    """字符串 <-> 编号映射（编号 0 表示 None）"""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._names: List[Optional[str]] = [None]
+
+    def id(self, name: Optional[str]) -> int:
+        if name is None:
+            return 0
+        symbol = self._ids.get(name)
+        if symbol is None:
+            symbol = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return symbol
+
+    def lookup(self, name: Optional[str]) -> Optional[int]:
+        """已存在的编号，不存在时返回 None（不插入）"""
+        if name is None:
+            return 0
+        return self._ids.get(name)
+
+    def name(self, symbol: int) -> Optional[str]:
+        return self._names[symbol]
+
+    def __len__(self) -> int:
+        return len(self._names) - 1
+
+
+class RequestLogStore:
+    """
+    请求日志环形缓冲区
+
+    满了以后新记录覆盖最旧的记录。支持按主机、状态码、方法和时间范围
+    过滤查询，只复制匹配的记录。
+    """
+
+    def __init__(self, capacity: int = 100000):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._start = 0  # 最旧记录的位置
+        self._size = 0
+
+        self._timestamps = array('d', bytes(8 * capacity))
+        # 写入时间：按追加顺序单调递增，用于二分查找时间范围的起点
+        # （隧道在结束时才记录，其 timestamp 是开始时间，并不有序）
+        self._logged = array('d', bytes(8 * capacity))
+        self._methods = array('I', bytes(4 * capacity))
+        self._hosts = array('I', bytes(4 * capacity))
+        self._errors = array('I', bytes(4 * capacity))
+        self._close_reasons = array('I', bytes(4 * capacity))
+        self._status = array('H', bytes(2 * capacity))  # 0 表示无状态码
+        self._response_sizes = array('Q', bytes(8 * capacity))
+        self._request_sizes = array('Q', bytes(8 * capacity))
+        self._durations = array('f', bytes(4 * capacity))
+        self._ttfbs = array('f', bytes(4 * capacity))  # NaN 表示无
+        self._connects = array('f', bytes(4 * capacity))  # NaN 表示无
+        self._dns = array('f', bytes(4 * capacity))  # NaN 表示无
+        self._clients = array('I', bytes(4 * capacity))
+        self._sandboxes = array('I', bytes(4 * capacity))
+        self._jobs = array('I', bytes(4 * capacity))
+        self._traces = array('I', bytes(4 * capacity))
+        # 请求自己的 span 和父 span（0 表示无，W3C 规定全零的 span 编号无效）
+        self._spans = array('Q', bytes(8 * capacity))
+        self._parent_spans = array('Q', bytes(8 * capacity))
+        self._paths = array('I', bytes(4 * capacity))
+        self._schemes = bytearray(capacity)  # 0: http, 1: https（CONNECT）
+        self._cache_status = bytearray(capacity)
+
+        self._methods_table = SymbolTable()
+        self._hosts_table = SymbolTable()
+        self._paths_table = SymbolTable()
+        # 错误信息和关闭原因可能包含可变内容，单独计数以便压缩
+        self._errors_table = SymbolTable()
+        self._close_table = SymbolTable()
+        # 客户端 / 沙箱 / 任务 / trace（一个任务的请求属于同一个 trace）
+        self._clients_table = SymbolTable()
+        self._sandboxes_table = SymbolTable()
+        self._jobs_table = SymbolTable()
+        self._traces_table = SymbolTable()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, req_log):
+        """追加一条记录（O(1)），req_log 为 RequestLog"""
+        timestamp = req_log.timestamp
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+
+        with self._lock:
+            if self._size < self.capacity:
+                i = (self._start + self._size) % self.capacity
+                self._size += 1
+            else:
+                i = self._start
+                self._start = (self._start + 1) % self.capacity
+
+            self._timestamps[i] = timestamp
+            self._logged[i] = time.time()
+            self._methods[i] = self._methods_table.id(req_log.method)
+            self._hosts[i] = self._hosts_table.id(req_log.host)
+            self._errors[i] = self._errors_table.id(req_log.error)
+            self._close_reasons[i] = self._close_table.id(req_log.close_reason)
+            self._status[i] = req_log.status_code or 0
+            self._response_sizes[i] = req_log.response_size
+            self._request_sizes[i] = req_log.request_size
+            self._durations[i] = req_log.duration_ms
+            self._ttfbs[i] = req_log.ttfb_ms if req_log.ttfb_ms is not None else math.nan
+            self._connects[i] = req_log.connect_ms if req_log.connect_ms is not None else math.nan
+            self._dns[i] = req_log.dns_ms if req_log.dns_ms is not None else math.nan
+            self._paths[i] = self._paths_table.id(req_log.path)
+            self._schemes[i] = 1 if req_log.url.startswith('https://') else 0
+            self._cache_status[i] = _CACHE_CODES.get(req_log.cache_status, 0)
+            self._clients[i] = self._clients_table.id(req_log.client or None)
+            self._sandboxes[i] = self._sandboxes_table.id(req_log.sandbox)
+            self._jobs[i] = self._jobs_table.id(req_log.job)
+            self._traces[i] = self._traces_table.id(req_log.trace_id)
+            self._spans[i] = _span_number(req_log.span_id)
+            self._parent_spans[i] = _span_number(req_log.parent_span_id)
+
+            # 符号表只会因不同字符串增长；超过容量时按现存记录重建
+            for table in (
+                self._methods_table, self._hosts_table, self._paths_table, self._errors_table,
+                self._close_table, self._clients_table, self._sandboxes_table, self._jobs_table,
+                self._traces_table,
+            ):
+                if len(table) > 2 * self.capacity:
+                    self._compact()
+                    break
+
+    def _compact(self):
+        """按缓冲区中仍存在的记录重建符号表（调用方持有锁）"""
+        for column, attr in (
+            (self._methods, '_methods_table'),
+            (self._hosts, '_hosts_table'),
+            (self._paths, '_paths_table'),
+            (self._errors, '_errors_table'),
+            (self._close_reasons, '_close_table'),
+            (self._clients, '_clients_table'),
+            (self._sandboxes, '_sandboxes_table'),
+            (self._jobs, '_jobs_table'),
+            (self._traces, '_traces_table'),
+        ):
+            old = getattr(self, attr)
+            new = SymbolTable()
+            for n in range(self._size):
+                i = (self._start + n) % self.capacity
+                column[i] = new.id(old.name(column[i]))
+            setattr(self, attr, new)
+
+    def _row(self, i: int) -> dict:
+        host = self._hosts_table.name(self._hosts[i])
+        path = self._paths_table.name(self._paths[i])
+        ttfb = self._ttfbs[i]
+        connect = self._connects[i]
+        dns = self._dns[i]
+        if self._schemes[i]:
+            url = f"https://{path}"
+        else:
+            url = f"http://{host}{path}"
+        return {
+            "timestamp": datetime.fromtimestamp(self._timestamps[i]).isoformat(),
+            "method": self._methods_table.name(self._methods[i]),
+            "url": url,
+            "host": host,
+            "path": path,
+            "status_code": self._status[i] or None,
+            "response_size": self._response_sizes[i],
+            "duration_ms": self._durations[i],
+            "error": self._errors_table.name(self._errors[i]),
+            "ttfb_ms": None if math.isnan(ttfb) else ttfb,
+            "request_size": self._request_sizes[i],
+            "close_reason": self._close_table.name(self._close_reasons[i]),
+            "connect_ms": None if math.isnan(connect) else connect,
+            "cache_status": CACHE_STATUSES[self._cache_status[i]],
+            "dns_ms": None if math.isnan(dns) else dns,
+            "client": self._clients_table.name(self._clients[i]) or '',
+            "sandbox": self._sandboxes_table.name(self._sandboxes[i]),
+            "job": self._jobs_table.name(self._jobs[i]),
+            "trace_id": self._traces_table.name(self._traces[i]),
+            "span_id": _span_hex(self._spans[i]),
+            "parent_span_id": _span_hex(self._parent_spans[i]),
+        }
+
+    def __getitem__(self, index: int) -> dict:
+        """按时间顺序取第 index 条（支持负数索引）"""
+        with self._lock:
+            if index < 0:
+                index += self._size
+            if not 0 <= index < self._size:
+                raise IndexError("RequestLogStore index out of range")
+            return self._row((self._start + index) % self.capacity)
+
+    def _first_logged_at_or_after(self, since: float) -> int:
+        """二分查找第一条写入时间 >= since 的逻辑位置（调用方持有锁）"""
+        low, high = 0, self._size
+        while low < high:
+            mid = (low + high) // 2
+            if self._logged[(self._start + mid) % self.capacity] < since:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def query(
+        self,
+        host: Optional[str] = None,
+        status: Optional[int] = None,
+        method: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        errors_only: bool = False,
+        limit: Optional[int] = None,
+        sandbox: Optional[str] = None,
+        job: Optional[str] = None,
+    ) -> List[dict]:
+        """
+        过滤查询
+
+        Args:
+            host: 主机名
+            status: 状态码
+            method: 请求方法
+            since / until: Unix 时间戳范围 [since, until)
+            errors_only: 只返回出错的请求
+            limit: 只返回最近的 limit 条
+            sandbox: 沙箱名（没有沙箱名的记录按客户端地址匹配）
+            job: 任务编号
+
+        Returns:
+            按时间顺序排列的记录字典
+        """
+        with self._lock:
+            # 未知的主机/方法/任务不可能匹配，无需扫描
+            host_id = self._hosts_table.lookup(host) if host is not None else None
+            method_id = self._methods_table.lookup(method) if method is not None else None
+            job_id = self._jobs_table.lookup(job) if job is not None else None
+            if (
+                (host is not None and host_id is None)
+                or (method is not None and method_id is None)
+                or (job is not None and job_id is None)
+            ):
+                return []
+            if sandbox is not None:
+                sandbox_id = self._sandboxes_table.lookup(sandbox)
+                client_id = self._clients_table.lookup(sandbox)
+                if sandbox_id is None and client_id is None:
+                    return []
+
+            # 请求开始于 since 之后的记录必然在 since 之后写入，
+            # 用写入时间二分查找扫描起点，跳过更早的记录
+            begin = self._first_logged_at_or_after(since) if since is not None else 0
+
+            rows = []
+            for n in range(self._size - 1, begin - 1, -1):
+                i = (self._start + n) % self.capacity
+                timestamp = self._timestamps[i]
+                if since is not None and timestamp < since:
+                    continue
+                if until is not None and timestamp >= until:
+                    continue
+                if host_id is not None and self._hosts[i] != host_id:
+                    continue
+                if method_id is not None and self._methods[i] != method_id:
+                    continue
+                if status is not None and self._status[i] != status:
+                    continue
+                if errors_only and not self._errors[i]:
+                    continue
+                if job_id is not None and self._jobs[i] != job_id:
+                    continue
+                if sandbox is not None and not (
+                    self._sandboxes[i] == sandbox_id
+                    or (not self._sandboxes[i] and self._clients[i] == client_id)
+                ):
+                    continue
+                rows.append(self._row(i))
+                if limit is not None and len(rows) >= limit:
+                    break
+            rows.reverse()
+            return rows
+
+    def recent(self, count: int = 100) -> List[dict]:
+        """最近 count 条记录（按时间顺序）"""
+        return self.query(limit=count)
+
+    def __iter__(self) -> Iterator[dict]:
+        for n in range(len(self)):
+            yield self[n]
+
+    def clear(self):
+        with self._lock:
+            self._start = 0
+            self._size = 0
+
+    def memory_bytes(self) -> int:
+        """列存储占用的大致字节数（不含符号表中的字符串）"""
+        columns = (
+            self._timestamps, self._logged, self._methods, self._hosts, self._paths, self._errors,
+            self._close_reasons, self._status, self._response_sizes,
+            self._request_sizes, self._durations, self._ttfbs, self._connects, self._dns,
+            self._clients, self._sandboxes, self._jobs, self._traces,
+            self._spans, self._parent_spans,
+        )
+        total = sum(c.itemsize * len(c) for c in columns)
+        return total + len(self._schemes) + len(self._cache_status)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+代理多进程模式
+
+单个 Python 进程的事件循环只能用满一个 CPU 核。多个 VM 同时通过代理执行
+npm install / pip install 时，可以用 --workers N 启动 N 个 worker 进程共同
+监听同一端口：
+
+- Linux：每个 worker 以 SO_REUSEPORT 绑定端口，由内核把新连接均匀分给各进程
+- 其他平台（macOS 的 SO_REUSEPORT 不做负载均衡）：父进程创建监听 socket，
+  各 worker 共享它并各自 accept
+
+父进程是汇总进程：worker 每 0.2 秒批量转发请求日志、每秒上报一次统计快照
+（计数、HyperLogLog、Space-Saving、延迟直方图均可合并），父进程负责日志输出、
+环形缓冲区、SQLite 归档、/metrics 接口和退出时的导出，对外仍是一个统一视图。
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# worker 转发请求日志的间隔（秒）和单批上限
+LOG_FLUSH_INTERVAL = 0.2
+LOG_BATCH_SIZE = 1000
+# worker 上报统计快照的间隔（秒）
+STATS_INTERVAL = 1.0
+
+
+def use_reuse_port() -> bool:
+    """是否由内核通过 SO_REUSEPORT 在 worker 间分配连接"""
+    return sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class _Forwarder:
+    """在 worker 的事件循环中累积待转发的请求日志"""
+
+    def __init__(self):
+        self.pending: List = []
+
+    def append(self, req_log):
+        self.pending.append(req_log)
+
+    def drain(self) -> List:
+        batch, self.pending = self.pending, []
+        return batch
+
+
+def _worker_main(
+    worker_id: int,
+    messages,
+    host: str,
+    port: int,
+    sock: Optional[socket.socket],
+    options: dict,
+    verbose: bool,
+):
+    """worker 进程入口"""
+    try:
+        from host.proxy_monitor import ProxyMonitor, ProxyServer, raise_fd_limit
+        from host.proxy_cache import HttpCache
+        from host.proxy_policy import PolicyEngine
+    except ImportError:  # 作为脚本从 host/ 运行
+        from proxy_monitor import ProxyMonitor, ProxyServer, raise_fd_limit
+        from proxy_cache import HttpCache
+        from proxy_policy import PolicyEngine
+
+    # Ctrl+C 由父进程处理，父进程再用 SIGTERM 通知 worker 退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise_fd_limit()
+
+    options = dict(options)
+    cache_dir = options.pop('cache_dir', None)
+    cache_max_bytes = options.pop('cache_max_bytes', None)
+    if cache_dir:
+        options['cache'] = HttpCache(cache_dir, max_bytes=cache_max_bytes)
+    policy_path = options.pop('policy_path', None)
+    if policy_path:
+        options['policy'] = PolicyEngine(policy_path)
+
+    forwarder = _Forwarder()
+    monitor = ProxyMonitor(verbose=verbose, forward=forwarder.append)
+    server = ProxyServer(
+        monitor, host=host, port=port, reuse_port=sock is None, sock=sock, **options
+    )
+
+    def flush_logs():
+        while forwarder.pending:
+            batch = forwarder.drain()
+            for i in range(0, len(batch), LOG_BATCH_SIZE):
+                messages.put(('logs', worker_id, batch[i:i + LOG_BATCH_SIZE]))
+
+    def report_stats():
+        messages.put((
+            'stats', worker_id, monitor.snapshot_stats(),
+            server.active_connections, server.peak_connections, server.pending_connections,
+            os.getpid(),
+        ))
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        try:
+            await server.start()
+        except OSError as e:
+            messages.put(('error', worker_id, str(e)))
+            return
+        messages.put(('ready', worker_id))
+
+        last_report = time.monotonic()
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), LOG_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            flush_logs()
+            if time.monotonic() - last_report >= STATS_INTERVAL:
+                report_stats()
+                last_report = time.monotonic()
+
+        server.close()
+        flush_logs()
+        report_stats()
+
+    asyncio.run(main())
+    messages.put(('exit', worker_id))
+    # 等待队列的后台线程把剩余消息写入管道
+    messages.close()
+    messages.join_thread()
+
+
+class WorkerPool:
+    """
+    多进程代理（父进程侧）
+
+    接口与 ProxyServer 一致（start / serve_forever / close / port /
+    active_connections / pending_connections），run_proxy_server 和 MetricsServer 可以直接使用。
+
+    Args:
+        monitor: 父进程的 ProxyMonitor，接收各 worker 的日志和统计
+        workers: worker 进程数
+        host / port: 监听地址
+        verbose: worker 是否输出调试日志
+        **options: 传给每个 worker 的 ProxyServer 参数（max_connections 等为每个 worker 的限制）；
+            cache_dir / cache_max_bytes 用于在 worker 中打开共享的 HTTP 缓存，
+            policy_path 为各 worker 加载的策略文件
+    """
+
+    def __init__(
+        self,
+        monitor,
+        workers: int,
+        host: str = '0.0.0.0',
+        port: int = 7890,
+        verbose: bool = False,
+        **options,
+    ):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.monitor = monitor
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.options = options
+        self.reuse_port = use_reuse_port()
+        # spawn：worker 不继承父进程的线程（归档写入线程等）和日志 handler
+        self._context = multiprocessing.get_context('spawn')
+        self._messages = self._context.Queue()
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._gauges: Dict[int, Tuple[int, int, int]] = {}  # (活动, 峰值, 排队) 连接数
+        self._ready: Dict[int, threading.Event] = {}
+        self._errors: Dict[int, str] = {}
+        self._exited: Dict[int, threading.Event] = {}
+        self._sock: Optional[socket.socket] = None
+        self._reader: Optional[threading.Thread] = None
+        self._closed = False
+        self.restarts = 0
+
+    @property
+    def active_connections(self) -> int:
+        return sum(active for active, _, _ in self._gauges.values())
+
+    @property
+    def peak_connections(self) -> int:
+        """各 worker 峰值之和（上限估计）"""
+        return sum(peak for _, peak, _ in self._gauges.values())
+
+    @property
+    def pending_connections(self) -> int:
+        return sum(pending for _, _, pending in self._gauges.values())
+
+    def _bind(self) -> socket.socket:
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        return sock
+
+    async def start(self, timeout: float = 30.0):
+        """启动所有 worker，等待它们开始监听"""
+        # 先在父进程绑定：尽早发现端口冲突，并确定端口 0 对应的实际端口。
+        # SO_REUSEPORT 模式下这个 socket 只占住端口、不 listen，worker 就绪后关闭
+        self._sock = self._bind()
+        self.port = self._sock.getsockname()[1]
+        if not self.reuse_port:
+            self._sock.listen(min(self.options.get('max_connections', 10000), 4096))
+            self._sock.setblocking(False)
+
+        self._reader = threading.Thread(target=self._read_messages, name='proxy-workers', daemon=True)
+        self._reader.start()
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        for worker_id in range(self.workers):
+            ready = await loop.run_in_executor(
+                None, self._ready[worker_id].wait, max(0.0, deadline - time.monotonic())
+            )
+            if worker_id in self._errors or not ready:
+                error = self._errors.get(worker_id, "timed out")
+                self.close()
+                raise OSError(f"Proxy worker {worker_id} failed to start: {error}")
+
+        if self.reuse_port:
+            self._sock.close()
+            self._sock = None
+
+    def _spawn(self, worker_id: int):
+        self._ready[worker_id] = threading.Event()
+        self._exited[worker_id] = threading.Event()
+        self._errors.pop(worker_id, None)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(
+                worker_id, self._messages, self.host, self.port,
+                None if self.reuse_port else self._sock, self.options, self.verbose,
+            ),
+            name=f'proxy-worker-{worker_id}',
+            daemon=True,
+        )
+        process.start()
+        self._processes[worker_id] = process
+
+    def _read_messages(self):
+        """汇总线程：接收 worker 的日志和统计"""
+        while True:
+            message = self._messages.get()
+            if message is None:
+                return
+            kind, worker_id = message[0], message[1]
+            if kind == 'logs':
+                self.monitor.ingest(message[2])
+            elif kind == 'stats':
+                # 已被重启替换的进程排队中的旧快照：统计已经并入 retired_stats
+                process = self._processes.get(worker_id)
+                if process is None or process.pid != message[6]:
+                    continue
+                self.monitor.update_worker_stats(worker_id, message[2])
+                self._gauges[worker_id] = (message[3], message[4], message[5])
+            elif kind == 'ready':
+                self._ready[worker_id].set()
+            elif kind == 'error':
+                self._errors[worker_id] = message[2]
+                self._ready[worker_id].set()
+            elif kind == 'exit':
+                self._gauges.pop(worker_id, None)
+                self._exited[worker_id].set()
+
+    async def serve_forever(self):
+        if self._reader is None:
+            await self.start()
+        try:
+            while True:
+                await asyncio.sleep(1)
+                # 意外退出的 worker 自动重启；它最后一次上报的统计并入汇总，
+                # 之后未上报的部分（最多 STATS_INTERVAL 秒）丢失
+                for worker_id, process in list(self._processes.items()):
+                    if not process.is_alive() and not self._closed:
+                        self.monitor.logger.warning(
+                            f"Proxy worker {worker_id} exited with code {process.exitcode}, restarting"
+                        )
+                        self.restarts += 1
+                        self._gauges.pop(worker_id, None)
+                        # 先替换进程再并入：此后旧进程排队中的快照都会被忽略
+                        self._spawn(worker_id)
+                        self.monitor.retire_worker(worker_id)
+        finally:
+            self.close()
+
+    def close(self, timeout: float = 10.0):
+        """通知 worker 退出，等待它们上报最后的日志和统计"""
+        if self._closed:
+            return
+        self._closed = True
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for worker_id, process in self._processes.items():
+            if self._ready[worker_id].is_set() and worker_id not in self._errors:
+                self._exited[worker_id].wait(max(0.0, deadline - time.monotonic()))
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._reader is not None:
+            self._messages.put(None)
+            self._reader.join(timeout)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Cowork Readiness Probes
+Wait for the sandbox (SSH, Claude CLI, CUI server, ...) to become ready using
+exponential backoff with jitter instead of fixed sleeps, and report the
+time-to-ready of each probe.
+"""
+
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+# PATH used for commands run in the VM (non-login shells miss npm global bins)
+VM_PATH_PREFIX = 'export PATH="$HOME/.npm-global/bin:$HOME/.local/bin:$PATH"'
+
+# Persistent Node compile cache for the Claude CLI, one directory per installed
+# CLI version so an upgrade starts a fresh cache instead of reusing stale entries
+NODE_CACHE_ROOT = "$HOME/.cache/cowork/node-compile-cache"
+VM_NODE_CACHE_ENV = (
+    'CLAUDE_PKG="$HOME/.npm-global/lib/node_modules/@anthropic-ai/claude-code/package.json"; '
+    'CLAUDE_VERSION=$(grep -m1 \'"version"\' "$CLAUDE_PKG" 2>/dev/null | cut -d\'"\' -f4); '
+    f'export NODE_COMPILE_CACHE="{NODE_CACHE_ROOT}/${{CLAUDE_VERSION:-unknown}}"'
+)
+# Warm the cache with a throwaway run and drop caches of other CLI versions
+VM_WARM_CLI_CMD = (
+    f'{VM_PATH_PREFIX} && {VM_NODE_CACHE_ENV}; mkdir -p "$NODE_COMPILE_CACHE"; '
+    f'find "{NODE_CACHE_ROOT}" -mindepth 1 -maxdepth 1 -type d '
+    '! -path "$NODE_COMPILE_CACHE" -exec rm -rf {} +; '
+    "claude --version"
+)
+
+# HTTP codes that mean "server is up" for the CUI health endpoint
+HEALTHY_HTTP_CODES = ("200", "401")
+
+
+@dataclass
+class Probe:
+    """A named readiness check; check() returns True once the target is ready."""
+
+    name: str
+    check: Callable[[], bool]
+
+
+@dataclass
+class ReadinessReport:
+    """Outcome of wait_until_ready."""
+
+    ready: bool
+    total_ms: int = 0
+    # Probe name -> milliseconds from start until ready (None if never ready)
+    probes: Dict[str, Optional[int]] = field(default_factory=dict)
+    error: str = ""
+
+    def summary(self) -> str:
+        """One-line human readable summary, e.g. 'ssh 3.2s, claude 4.0s'."""
+        parts = []
+        for name, ms in self.probes.items():
+            parts.append(f"{name} {ms / 1000:.1f}s" if ms is not None else f"{name} not ready")
+        return ", ".join(parts)
+
+
+def wait_until_ready(
+    checks: List[Probe],
+    deadline: float,
+    initial_delay: float = 0.25,
+    max_delay: float = 5.0,
+    factor: float = 2.0,
+    jitter: float = 0.2,
+    abort: Optional[Callable[[], Optional[str]]] = None,
+    on_ready: Optional[Callable[[str, int], None]] = None,
+) -> ReadinessReport:
+    """
+    Poll probes in order until each reports ready or the deadline passes.
+
+    Probes are treated as a dependency chain (e.g. ssh before claude), so a
+    probe is only polled once every probe before it is ready. Between failed
+    attempts the delay grows exponentially from initial_delay up to max_delay,
+    with +/- jitter (fraction) randomization to avoid synchronized polling.
+
+    Args:
+        checks: Probes to satisfy, in dependency order
+        deadline: Seconds to wait in total
+        abort: Optional callable polled between attempts; returning a message
+               stops waiting immediately (e.g. the start process failed)
+        on_ready: Optional callback(name, elapsed_ms) when a probe becomes ready
+
+    Returns:
+        ReadinessReport with per-probe time-to-ready
+    """
+    start = time.monotonic()
+    end = start + deadline
+    report = ReadinessReport(ready=False, probes={probe.name: None for probe in checks})
+
+    for probe in checks:
+        delay = initial_delay
+        while True:
+            try:
+                ok = probe.check()
+            except Exception:
+                ok = False
+            if ok:
+                elapsed = int((time.monotonic() - start) * 1000)
+                report.probes[probe.name] = elapsed
+                if on_ready:
+                    on_ready(probe.name, elapsed)
+                break
+
+            if abort:
+                message = abort()
+                if message:
+                    report.error = message
+                    report.total_ms = int((time.monotonic() - start) * 1000)
+                    return report
+
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                report.error = f"Timed out after {deadline:.0f}s waiting for {probe.name}"
+                report.total_ms = int((time.monotonic() - start) * 1000)
+                return report
+            sleep_for = delay * random.uniform(1 - jitter, 1 + jitter)
+            time.sleep(min(sleep_for, remaining))
+            delay = min(delay * factor, max_delay)
+
+    report.ready = True
+    report.total_ms = int((time.monotonic() - start) * 1000)
+    return report
+
+
+def _vm_command(vm_name: str, command: str, timeout: float = 10) -> subprocess.CompletedProcess:
+    """Run a bash command in the VM, returning the completed process."""
+    return subprocess.run(
+        ["limactl", "shell", vm_name, "--", "bash", "-c", f"cd ~ 2>/dev/null; {command}"],
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+
+
+def ssh_probe(vm_name: str) -> Probe:
+    """Ready when a command can be executed in the VM over SSH."""
+    return Probe("ssh", lambda: _vm_command(vm_name, "true").returncode == 0)
+
+
+def claude_probe(vm_name: str) -> Probe:
+    """
+    Ready when `claude --version` succeeds in the VM.
+
+    The probe runs through VM_WARM_CLI_CMD, so becoming ready also warms the
+    Node compile cache for subsequent Claude runs.
+    """
+    return Probe(
+        "claude",
+        lambda: _vm_command(vm_name, VM_WARM_CLI_CMD, timeout=30).returncode == 0,
+    )
+
+
+def _vm_http_code(vm_name: str, port: int, path: str) -> str:
+    result = _vm_command(
+        vm_name,
+        f"curl -s -o /dev/null -m 3 -w '%{{http_code}}' http://localhost:{port}{path}",
+    )
+    return result.stdout.strip()
+
+
+def cui_probe(vm_name: str, port: int = 3001) -> Probe:
+    """Ready when the CUI server in the VM answers /api/health with 200 or 401."""
+    return Probe("cui", lambda: _vm_http_code(vm_name, port, "/api/health") in HEALTHY_HTTP_CODES)
+
+
+def cui_down_probe(vm_name: str, port: int = 3001) -> Probe:
+    """Ready when nothing answers on the CUI server port in the VM."""
+    return Probe("cui-down", lambda: _vm_http_code(vm_name, port, "/api/health") in ("", "000"))
+
+
+def http_probe(url: str, ok_codes=(200, 401)) -> Probe:
+    """Ready when a host-side URL answers with one of ok_codes."""
+
+    def check() -> bool:
+        try:
+            with urllib.request.urlopen(url, timeout=3) as response:
+                return response.status in ok_codes
+        except urllib.error.HTTPError as e:
+            return e.code in ok_codes
+        except Exception:
+            return False
+
+    return Probe("http", check)
+
+
+def vm_status_probe(vm_name: str, status: str = "Stopped") -> Probe:
+    """Ready when `limactl list` reports the VM in the given status."""
+
+    def check() -> bool:
+        result = subprocess.run(
+            ["limactl", "list", "--format", "{{.Status}}", vm_name],
+            capture_output=True,
+            text=True,
+            timeout=10,
+        )
+        return result.stdout.strip() == status
+
+    return Probe(status.lower(), check)
+
+
+def build_probe(spec: str, vm_name: str) -> Probe:
+    """
+    Build a probe from a CLI spec.
+
+    Specs: ssh, claude, cui[:PORT], cui-down[:PORT], http:URL, stopped, running
+    """
+    kind, _, arg = spec.partition(":")
+    if kind == "ssh":
+        return ssh_probe(vm_name)
+    if kind == "claude":
+        return claude_probe(vm_name)
+    if kind == "cui":
+        return cui_probe(vm_name, int(arg or 3001))
+    if kind == "cui-down":
+        return cui_down_probe(vm_name, int(arg or 3001))
+    if kind == "http":
+        return http_probe(arg)
+    if kind in ("stopped", "running"):
+        return vm_status_probe(vm_name, kind.capitalize())
+    raise ValueError(f"Unknown probe: {spec}")
+
+
+def main():
+    """CLI entry point (used by scripts/cowork)."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Wait for Cowork sandbox services to become ready"
+    )
+    parser.add_argument(
+        "probes",
+        nargs="+",
+        metavar="PROBE",
+        help="ssh, claude, cui[:PORT], cui-down[:PORT], http:URL, stopped, running",
+    )
+    parser.add_argument(
+        "--vm-name",
+        default=os.environ.get("COWORK_VM_NAME", "sandbox"),
+        help="Name of the Lima VM (default: $COWORK_VM_NAME or sandbox)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=60,
+        help="Seconds to wait before giving up (default: 60)",
+    )
+    parser.add_argument(
+        "--abort-if-dead",
+        type=int,
+        metavar="PID",
+        help="Stop waiting if this host process exits",
+    )
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only set the exit code")
+
+    args = parser.parse_args()
+
+    try:
+        checks = [build_probe(spec, args.vm_name) for spec in args.probes]
+    except ValueError as e:
+        parser.error(str(e))
+
+    abort = None
+    if args.abort_if_dead:
+        def abort() -> Optional[str]:
+            try:
+                os.kill(args.abort_if_dead, 0)
+            except ProcessLookupError:
+                return f"Process {args.abort_if_dead} exited"
+            except PermissionError:
+                pass
+            return None
+
+    report = wait_until_ready(checks, deadline=args.deadline, abort=abort)
+
+    if not args.quiet:
+        if report.ready:
+            print(f"Ready in {report.total_ms / 1000:.1f}s ({report.summary()})")
+        else:
+            print(f"Not ready: {report.error} ({report.summary()})", file=sys.stderr)
+    sys.exit(0 if report.ready else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Cowork Tracing
+Trace and span ids for controller operations, propagated into the VM and to
+the proxy so one job can be rebuilt as a timeline.
+
+- Every traced controller operation is a span; nested operations share the
+  trace id of the outermost one (the current span is kept in a contextvar).
+- ask_claude passes the trace into the VM as TRACEPARENT (W3C trace context)
+  and in the proxy URL's password ("<job>:<traceparent>"), so every request
+  and tunnel the run opens is recorded with the trace id and parent span.
+- CoworkLogger JSON records logged inside a span carry trace_id / span_id.
+- Finished spans are appended to a local file as OTLP/JSON, one
+  ExportTraceServiceRequest per line (the format of the OpenTelemetry
+  collector's file exporter), when a trace file is configured.
+
+Rebuild a job's timeline from the trace file and the proxy archive:
+    python3 host/tracing.py timeline <trace_id or job_id>
+    python3 host/tracing.py timeline <trace_id> --otlp > job.json
+"""
+
+import contextvars
+import json
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    from host.proxy_archive import DEFAULT_ARCHIVE_PATH
+except ImportError:  # run as a script from host/
+    from proxy_archive import DEFAULT_ARCHIVE_PATH
+
+DEFAULT_TRACE_PATH = "~/.cowork/traces.jsonl"
+
+# OTLP enum values
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+STATUS_CODES = {"unset": 0, "ok": 1, "error": 2}
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+_current: contextvars.ContextVar = contextvars.ContextVar("cowork_span", default=None)
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def format_traceparent(trace_id: str, span_id: str) -> str:
+    """W3C traceparent header value (version 00, sampled)."""
+    return f"00-{trace_id}-{span_id}-01"
+
+
+def parse_traceparent(value: str) -> Optional[Tuple[str, str]]:
+    """(trace_id, span_id) from a traceparent value, or None if malformed."""
+    match = _TRACEPARENT.match(value.strip().lower())
+    if not match or set(match.group(1)) == {"0"} or set(match.group(2)) == {"0"}:
+        return None
+    return match.group(1), match.group(2)
+
+
+@dataclass
+class Span:
+    """One timed operation."""
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start_ns: int = 0
+    end_ns: Optional[int] = None
+    kind: str = "internal"
+    attributes: dict = field(default_factory=dict)
+    events: list = field(default_factory=list)
+    status: str = "unset"
+    status_message: str = ""
+
+    @property
+    def traceparent(self) -> str:
+        return format_traceparent(self.trace_id, self.span_id)
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        if self.end_ns is None:
+            return None
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def set(self, **attributes):
+        """Set attributes (None values are skipped)."""
+        self.attributes.update((k, v) for k, v in attributes.items() if v is not None)
+
+    def add_event(self, name: str, time_ns: Optional[int] = None, **attributes):
+        self.events.append({"name": name, "time_ns": time_ns or time.time_ns(), "attributes": attributes})
+
+    def fail(self, message: str = ""):
+        self.status = "error"
+        self.status_message = message
+
+
+def current_span() -> Optional[Span]:
+    """The span of the operation running in this context, if any."""
+    return _current.get()
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}  # int64 is a string in OTLP/JSON
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()]
+
+
+def to_otlp(spans: List[Span], service_name: str, resource: Optional[dict] = None) -> dict:
+    """An OTLP/JSON ExportTraceServiceRequest for spans of one service."""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": service_name, **(resource or {})})},
+            "scopeSpans": [{
+                "scope": {"name": "cowork"},
+                "spans": [
+                    {
+                        "traceId": span.trace_id,
+                        "spanId": span.span_id,
+                        **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                        "name": span.name,
+                        "kind": SPAN_KINDS.get(span.kind, 1),
+                        "startTimeUnixNano": str(span.start_ns),
+                        "endTimeUnixNano": str(span.end_ns or span.start_ns),
+                        "attributes": _otlp_attributes(span.attributes),
+                        "events": [
+                            {
+                                "timeUnixNano": str(event["time_ns"]),
+                                "name": event["name"],
+                                "attributes": _otlp_attributes(event["attributes"]),
+                            }
+                            for event in span.events
+                        ],
+                        "status": {
+                            "code": STATUS_CODES[span.status],
+                            **({"message": span.status_message} if span.status_message else {}),
+                        },
+                    }
+                    for span in spans
+                ],
+            }],
+        }],
+    }
+
+
+class Tracer:
+    """
+    Creates spans and, when path is set, appends finished spans to it.
+
+    Ids are always generated (they are cheap and are what ties proxy records
+    to a job); only the export is optional.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        service_name: str = "cowork-controller",
+        resource: Optional[dict] = None,
+    ):
+        self.path = Path(path).expanduser() if path else None
+        self.service_name = service_name
+        self.resource = resource or {}
+        self._lock = threading.Lock()
+        if self.path:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def start(
+        self,
+        name: str,
+        parent: Optional[Span] = None,
+        start_ns: Optional[int] = None,
+        kind: str = "internal",
+        **attributes,
+    ) -> Span:
+        """Start a span under parent (default: the current span, else a new trace)."""
+        parent = parent or _current.get()
+        span = Span(
+            name=name,
+            trace_id=parent.trace_id if parent else new_trace_id(),
+            span_id=new_span_id(),
+            parent_id=parent.span_id if parent else None,
+            start_ns=start_ns or time.time_ns(),
+            kind=kind,
+        )
+        span.set(**attributes)
+        return span
+
+    def end(self, span: Span, end_ns: Optional[int] = None):
+        span.end_ns = end_ns or time.time_ns()
+        if span.status == "unset":
+            span.status = "ok"
+        self.export([span])
+
+    def record(self, name: str, parent: Span, start_ns: int, end_ns: int, **attributes) -> Span:
+        """Add a finished span whose times were measured elsewhere."""
+        span = self.start(name, parent=parent, start_ns=start_ns, **attributes)
+        self.end(span, end_ns)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """Run a block as the current span; exceptions mark it as failed."""
+        span = self.start(name, **attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current.reset(token)
+            self.end(span)
+
+    def export(self, spans: List[Span]):
+        if not self.path:
+            return
+        line = json.dumps(to_otlp(spans, self.service_name, self.resource), separators=(",", ":"))
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError:
+            pass  # tracing must never fail the operation
+
+
+# ---------------------------------------------------------------------------
+# Timeline
+# ---------------------------------------------------------------------------
+
+def read_spans(path: str) -> Iterator[Tuple[str, dict]]:
+    """(service name, OTLP span) for every span in an OTLP/JSON lines file."""
+    try:
+        f = open(Path(path).expanduser(), encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                continue
+            for resource_spans in request.get("resourceSpans", []):
+                service = next(
+                    (a["value"].get("stringValue", "") for a in resource_spans.get("resource", {}).get("attributes", [])
+                     if a["key"] == "service.name"),
+                    "",
+                )
+                for scope_spans in resource_spans.get("scopeSpans", []):
+                    for span in scope_spans.get("spans", []):
+                        yield service, span
+
+
+def proxy_spans(archive_path: str, trace_id: str) -> List[Span]:
+    """Spans for the proxy requests and tunnels of a trace (from the proxy archive)."""
+    try:
+        conn = sqlite3.connect(f"file:{Path(archive_path).expanduser()}?mode=ro", uri=True, timeout=30)
+    except sqlite3.OperationalError:
+        return []
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            "SELECT * FROM requests WHERE trace_id = ? ORDER BY timestamp", (trace_id,)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return []  # no archive yet, or one written before trace columns existed
+    finally:
+        conn.close()
+
+    spans = []
+    for row in rows:
+        start_ns = int(row["timestamp"] * 1e9)
+        span = Span(
+            name=f"{row['method']} {row['host']}",
+            trace_id=trace_id,
+            span_id=row["span_id"] or new_span_id(),
+            parent_id=row["parent_span_id"],
+            start_ns=start_ns,
+            end_ns=start_ns + int((row["duration_ms"] or 0) * 1e6),
+            kind="server",
+        )
+        span.set(**{
+            "http.request.method": row["method"],
+            "url.full": row["url"],
+            "http.response.status_code": row["status_code"],
+            "cowork.response_bytes": row["response_size"],
+            "cowork.request_bytes": row["request_size"],
+            "cowork.ttfb_ms": row["ttfb_ms"],
+            "cowork.close_reason": row["close_reason"],
+            "cowork.job": row["job"],
+        })
+        if row["error"]:
+            span.fail(row["error"])
+        else:
+            span.status = "ok"
+        spans.append(span)
+    return spans
+
+
+def _from_otlp(span: dict) -> Span:
+    attributes = {}
+    for attribute in span.get("attributes", []):
+        value = next(iter(attribute["value"].values()), None)
+        attributes[attribute["key"]] = value
+    status = {v: k for k, v in STATUS_CODES.items()}.get(span.get("status", {}).get("code", 0), "unset")
+    return Span(
+        name=span["name"],
+        trace_id=span["traceId"],
+        span_id=span["spanId"],
+        parent_id=span.get("parentSpanId"),
+        start_ns=int(span["startTimeUnixNano"]),
+        end_ns=int(span["endTimeUnixNano"]),
+        kind={v: k for k, v in SPAN_KINDS.items()}.get(span.get("kind", 1), "internal"),
+        attributes=attributes,
+        events=[
+            {"name": e["name"], "time_ns": int(e["timeUnixNano"]), "attributes": {}}
+            for e in span.get("events", [])
+        ],
+        status=status,
+        status_message=span.get("status", {}).get("message", ""),
+    )
+
+
+def load_trace(trace: str, trace_path: str, archive_path: Optional[str]) -> Dict[str, List[Span]]:
+    """
+    All spans of a trace, by service.
+
+    trace is a trace id or an ask_claude job id (matched on the job_id
+    attribute of controller spans).
+    """
+    by_service: Dict[str, List[Span]] = {}
+    spans = [(service, _from_otlp(span)) for service, span in read_spans(trace_path)]
+    trace_id = trace
+    if not any(span.trace_id == trace for _, span in spans):
+        trace_id = next(
+            (span.trace_id for _, span in spans if span.attributes.get("job_id") == trace), trace
+        )
+    for service, span in spans:
+        if span.trace_id == trace_id:
+            by_service.setdefault(service, []).append(span)
+    if archive_path:
+        proxied = proxy_spans(archive_path, trace_id)
+        if proxied:
+            by_service.setdefault("cowork-proxy", []).extend(proxied)
+    return by_service
+
+
+def format_timeline(spans: List[Span]) -> str:
+    """Spans as an indented timeline, offsets relative to the first span."""
+    if not spans:
+        return ""
+    children: Dict[Optional[str], List[Span]] = {}
+    ids = {span.span_id for span in spans}
+    for span in spans:
+        parent = span.parent_id if span.parent_id in ids else None
+        children.setdefault(parent, []).append(span)
+    origin = min(span.start_ns for span in spans)
+    lines = []
+
+    def walk(parent: Optional[str], depth: int):
+        for span in sorted(children.get(parent, []), key=lambda s: s.start_ns):
+            offset = (span.start_ns - origin) / 1e6
+            status = " ERROR" if span.status == "error" else ""
+            detail = f" ({span.status_message})" if span.status_message else ""
+            lines.append(
+                f"{offset:10.1f}ms {span.duration_ms or 0:10.1f}ms  {'  ' * depth}{span.name}{status}{detail}"
+            )
+            for event in span.events:
+                lines.append(
+                    f"{(event['time_ns'] - origin) / 1e6:10.1f}ms {'':>10}    {'  ' * depth}* {event['name']}"
+                )
+            walk(span.span_id, depth + 1)
+
+    walk(None, 0)
+    return "\n".join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rebuild a job's timeline from its trace")
+    sub = parser.add_subparsers(dest="command", required=True)
+    timeline = sub.add_parser("timeline", help="Show all spans of a trace (or ask_claude job)")
+    timeline.add_argument("trace", help="Trace id or job id")
+    timeline.add_argument(
+        "--traces",
+        default=os.environ.get("COWORK_TRACE_FILE", DEFAULT_TRACE_PATH),
+        help=f"Controller trace file (default: $COWORK_TRACE_FILE or {DEFAULT_TRACE_PATH})",
+    )
+    timeline.add_argument(
+        "--archive",
+        default=os.environ.get("COWORK_PROXY_ARCHIVE", DEFAULT_ARCHIVE_PATH),
+        help=f"Proxy archive with the trace's requests (default: $COWORK_PROXY_ARCHIVE or {DEFAULT_ARCHIVE_PATH})",
+    )
+    timeline.add_argument("--otlp", action="store_true", help="Print the trace as OTLP/JSON")
+    args = parser.parse_args()
+
+    by_service = load_trace(args.trace, args.traces, args.archive)
+    if not by_service:
+        parser.exit(1, f"No spans found for {args.trace}\n")
+    if args.otlp:
+        requests = [to_otlp(spans, service) for service, spans in by_service.items()]
+        print(json.dumps({"resourceSpans": [r["resourceSpans"][0] for r in requests]}, indent=2))
+    else:
+        print(format_timeline([span for spans in by_service.values() for span in spans]))
+
+
+if __name__ == "__main__":
+    main()
@@ -34,19 +34,19 @@ print_test() {
 
 print_pass() {
     echo -e "${GREEN}✓ PASS:${NC} $1"
-    ((PASSED_TESTS++))
+    ((++PASSED_TESTS))
 }
 
 print_fail() {
     echo -e "${RED}✗ FAIL:${NC} $1"
-    ((FAILED_TESTS++))
+    ((++FAILED_TESTS))
 }
 
 run_test() {
     local test_name="$1"
     local test_command="$2"
 
-    ((TOTAL_TESTS++))
+    ((++TOTAL_TESTS))
     print_test "$test_name"
 
     if eval "$test_command" > /dev/null 2>&1; then
@@ -58,6 +58,22 @@ run_test() {
     fi
 }
 
+# Run Python read from stdin in host/ (for checks of the host modules)
+run_python_test() {
+    local test_name="$1"
+
+    ((++TOTAL_TESTS))
+    print_test "$test_name"
+
+    if (cd "$PROJECT_DIR/host" && python3 -) > /dev/null 2>&1; then
+        print_pass "$test_name"
+        return 0
+    else
+        print_fail "$test_name"
+        return 1
+    fi
+}
+
 print_summary() {
     echo ""
     echo -e "${BLUE}═══════════════════════════════════════${NC}"
@@ -117,13 +133,13 @@ if limactl list --json 2>/dev/null | grep -q '"name":"sandbox"'; then
     VM_STATUS=$(limactl list --json | jq -r '.status' 2>/dev/null || echo "unknown")
     if [ "$VM_STATUS" == "Running" ]; then
         print_pass "VM is running"
-        ((PASSED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++PASSED_TESTS))
+        ((++TOTAL_TESTS))
         VM_RUNNING=true
     else
         print_fail "VM is not running (status: $VM_STATUS)"
-        ((FAILED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++FAILED_TESTS))
+        ((++TOTAL_TESTS))
         VM_RUNNING=false
     fi
 else
@@ -158,26 +174,26 @@ if [ "$VM_RUNNING" = true ]; then
 
     if $PROJECT_DIR/scripts/cowork exec "echo '$TEST_CONTENT' > $TEST_FILE" > /dev/null 2>&1; then
         print_pass "Write file to workspace"
-        ((PASSED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++PASSED_TESTS))
+        ((++TOTAL_TESTS))
 
         READ_CONTENT=$($PROJECT_DIR/scripts/cowork exec "cat $TEST_FILE" 2>/dev/null)
         if [ "$READ_CONTENT" == "$TEST_CONTENT" ]; then
             print_pass "Read file from workspace"
-            ((PASSED_TESTS++))
-            ((TOTAL_TESTS++))
+            ((++PASSED_TESTS))
+            ((++TOTAL_TESTS))
         else
             print_fail "Read file from workspace"
-            ((FAILED_TESTS++))
-            ((TOTAL_TESTS++))
+            ((++FAILED_TESTS))
+            ((++TOTAL_TESTS))
         fi
 
         # Cleanup
         $PROJECT_DIR/scripts/cowork exec "rm -f $TEST_FILE" > /dev/null 2>&1
     else
         print_fail "Write file to workspace"
-        ((FAILED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++FAILED_TESTS))
+        ((++TOTAL_TESTS))
     fi
 
     # Test 15: Python controller status
@@ -197,15 +213,15 @@ if [ "$VM_RUNNING" = true ]; then
 
     if $PROJECT_DIR/scripts/cowork exec "command -v claude" > /dev/null 2>&1; then
         print_pass "Claude Code is installed in VM"
-        ((PASSED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++PASSED_TESTS))
+        ((++TOTAL_TESTS))
 
         # Test 18: Check Claude version
         run_test "Claude Code version check" "$PROJECT_DIR/scripts/cowork exec 'claude --version'"
     else
         print_fail "Claude Code is not installed in VM"
-        ((FAILED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++FAILED_TESTS))
+        ((++TOTAL_TESTS))
     fi
 
     # Test 19: Project directory creation
@@ -216,25 +232,25 @@ if [ "$VM_RUNNING" = true ]; then
     TEST_PROJECT="test_project_$$"
     if $PROJECT_DIR/scripts/cowork exec "mkdir -p /workspace/$TEST_PROJECT && echo 'test' > /workspace/$TEST_PROJECT/test.txt" > /dev/null 2>&1; then
         print_pass "Create project directory"
-        ((PASSED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++PASSED_TESTS))
+        ((++TOTAL_TESTS))
 
         if $PROJECT_DIR/scripts/cowork exec "test -f /workspace/$TEST_PROJECT/test.txt" > /dev/null 2>&1; then
             print_pass "Access files in project directory"
-            ((PASSED_TESTS++))
-            ((TOTAL_TESTS++))
+            ((++PASSED_TESTS))
+            ((++TOTAL_TESTS))
         else
             print_fail "Access files in project directory"
-            ((FAILED_TESTS++))
-            ((TOTAL_TESTS++))
+            ((++FAILED_TESTS))
+            ((++TOTAL_TESTS))
         fi
 
         # Cleanup
         $PROJECT_DIR/scripts/cowork exec "rm -rf /workspace/$TEST_PROJECT" > /dev/null 2>&1
     else
         print_fail "Create project directory"
-        ((FAILED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++FAILED_TESTS))
+        ((++TOTAL_TESTS))
     fi
 
 fi
@@ -256,8 +272,8 @@ run_test "Proxy monitor --help works" "python3 $PROJECT_DIR/host/proxy_monitor.p
 # Test proxy monitor Python imports
 if python3 -c "import sys; sys.path.insert(0, '$PROJECT_DIR/host'); from proxy_monitor import ProxyMonitor, RequestLog" > /dev/null 2>&1; then
     print_pass "Proxy monitor imports successfully"
-    ((PASSED_TESTS++))
-    ((TOTAL_TESTS++))
+    ((++PASSED_TESTS))
+    ((++TOTAL_TESTS))
 
     # Test proxy monitor functionality
     if python3 -c "
@@ -280,22 +296,783 @@ monitor.log_request(req_log)
 stats = monitor.get_stats()
 assert stats['total_requests'] == 1
 assert stats['successful_requests'] == 1
-assert 'example.com' in stats['unique_hosts']
+assert stats['unique_hosts'] == 1
+assert stats['requests_by_host']['example.com'] == 1
+assert stats['bytes_by_host']['example.com'] == 1024
 " > /dev/null 2>&1; then
         print_pass "Proxy monitor basic functionality"
-        ((PASSED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++PASSED_TESTS))
+        ((++TOTAL_TESTS))
     else
         print_fail "Proxy monitor basic functionality"
-        ((FAILED_TESTS++))
-        ((TOTAL_TESTS++))
+        ((++FAILED_TESTS))
+        ((++TOTAL_TESTS))
     fi
 else
     print_fail "Proxy monitor imports successfully"
-    ((FAILED_TESTS++))
-    ((TOTAL_TESTS++))
+    ((++FAILED_TESTS))
+    ((++TOTAL_TESTS))
 fi
 
+# Host module tests (no VM, network or Lima needed)
+echo ""
+echo "Host Module Tests:"
+echo ""
+
+run_python_test "Ledger parses usage from stream-json" <<'EOF' || true
+import json
+from ledger import StreamJsonParser
+
+parser = StreamJsonParser()
+for event in [
+    {"type": "system", "subtype": "init", "model": "claude-sonnet-4", "session_id": "s1"},
+    {"type": "assistant", "message": {"content": [
+        {"type": "text", "text": "Reading"},
+        {"type": "tool_use", "name": "Read", "input": {}},
+    ]}},
+    {"type": "assistant", "message": {"content": [{"type": "tool_use", "name": "Grep", "input": {}}]}},
+    {"type": "result", "result": "done", "num_turns": 3, "total_cost_usd": 0.0125,
+     "duration_api_ms": 2100, "usage": {"input_tokens": 1200, "output_tokens": 340,
+     "cache_read_input_tokens": 5000, "cache_creation_input_tokens": 800}},
+]:
+    parser.feed(json.dumps(event) + "\n")
+parser.feed("not json\n")
+
+record = parser.to_record("job1", project="app")
+assert parser.output == "done"
+assert (record.model, record.session_id) == ("claude-sonnet-4", "s1")
+assert (record.input_tokens, record.output_tokens) == (1200, 340)
+assert (record.cache_read_tokens, record.cache_creation_tokens) == (5000, 800)
+assert record.cost_usd == 0.0125 and record.num_turns == 3 and record.tool_calls == 2
+assert record.ttft_ms is not None and record.api_duration_ms == 2100
+assert record.project == "app"
+EOF
+
+run_python_test "Prompts and attachments reach the VM the chosen way" <<'EOF' || true
+import os, shlex, stat, tempfile
+from pathlib import Path
+from controller import INLINE_PROMPT_LIMIT, CoworkController, ExecutionResult, SandboxConfig
+
+tmp = tempfile.mkdtemp()
+controller = CoworkController(SandboxConfig())
+controller.is_vm_running = lambda: True
+controller.execute_in_vm = lambda command, timeout=None: ExecutionResult(success=True, output="")
+runs, uploads = [], []
+
+def run_streaming(argv, input_text, timeout, env, on_line, cancel=None):
+    runs.append((argv[-1], input_text))
+    on_line("answer\n")
+    return 0, "", None
+
+def upload_to_vm(files, dest_dir, timeout=None):
+    uploads.append(files)
+    return ExecutionResult(success=True, output="", timings={"upload_bytes": 1})
+
+controller._run_streaming = run_streaming
+controller.upload_to_vm = upload_to_vm
+
+def delivered(prompt, **kwargs):
+    runs.clear()
+    assert controller.ask_claude(prompt, **kwargs).output == "answer\n"
+    command, input_text = runs[0]
+    if input_text is None:
+        assert command.endswith(" " + shlex.quote(prompt))
+        return "arg"
+    assert input_text == prompt and shlex.quote(prompt) not in command
+    return "stdin"
+
+small, large = "say hi", "x" * (INLINE_PROMPT_LIMIT + 1)
+assert delivered(small) == "arg" and delivered(large) == "stdin"
+assert delivered(small, prompt_delivery="stdin") == "stdin"
+assert delivered(large, prompt_delivery="arg") == "arg"
+assert not controller.ask_claude(small, prompt_delivery="pipe").success
+controller.ask_claude(small, disallowed_tools=["Bash", "Edit"])
+assert "--disallowedTools=Bash,Edit " in runs[-1][0]
+
+# Attachment names stay unique; the prompt lists them by VM path
+for d in ("a", "b"):
+    os.makedirs(os.path.join(tmp, d))
+    open(os.path.join(tmp, d, "notes.txt"), "w").write(d)
+attachments = [os.path.join(tmp, "a", "notes.txt"), os.path.join(tmp, "b", "notes.txt"),
+               ("notes.txt", b"c"), ("notes-1.txt", "d"), ("README", "e")]
+runs.clear()
+controller.ask_claude("read them", attachments=attachments)
+assert list(uploads[-1]) == ["notes.txt", "notes-1.txt", "notes-2.txt", "notes-1-1.txt", "README"]
+assert uploads[-1]["notes-2.txt"] == b"c"
+prompt = runs[-1][0]
+assert "/context/notes-2.txt" in prompt and "/context/README" in prompt
+
+# A failed upload never starts Claude
+controller.upload_to_vm = lambda files, dest_dir, timeout=None: ExecutionResult(
+    success=False, output="", error="disk full", exit_code=2)
+runs.clear()
+result = controller.ask_claude("read them", attachments=attachments)
+assert not result.success and "disk full" in result.error and runs == []
+
+# upload_to_vm itself, with a limactl that runs the command locally
+bin_dir = os.path.join(tmp, "bin")
+os.makedirs(bin_dir)
+limactl = os.path.join(bin_dir, "limactl")
+open(limactl, "w").write('#!/bin/bash\nshift 3\nexec "$@"\n')
+os.chmod(limactl, stat.S_IRWXU)
+os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+uploader = CoworkController(SandboxConfig())
+dest = os.path.join(tmp, "dest")
+files = {"notes.txt": Path(attachments[0]), "data.bin": b"\0" * 5000, "s": "hi"}
+result = uploader.upload_to_vm(files, dest)
+assert result.success and result.timings["upload_bytes"] == 1 + 5000 + 2
+assert open(os.path.join(dest, "notes.txt")).read() == "a"
+assert os.path.getsize(os.path.join(dest, "data.bin")) == 5000
+for name in ("../escape", "/etc/passwd", ""):
+    result = uploader.upload_to_vm({name: b"x"}, dest)
+    assert not result.success and "Invalid upload file name" in result.error
+result = uploader.upload_to_vm({"gone": Path(tmp, "missing")}, dest)
+assert not result.success and "missing" in result.error
+EOF
+
+run_python_test "Hedged jobs hedge slow read-only runs and restrict tools" <<'EOF' || true
+import threading, time
+from controller import CoworkController, ExecutionResult, SandboxConfig
+from hedging import MUTATING_TOOLS, READ_ONLY_TOOLS, HedgedExecutor, HedgePolicy
+
+calls = []
+
+def stub(vm_name, delay, output_after=None):
+    controller = CoworkController(SandboxConfig(vm_name=vm_name))
+    controller.is_vm_running = lambda: True
+    cancelled = threading.Event()
+
+    def ask_claude(prompt, cancel=None, on_output=None, **kwargs):
+        calls.append((vm_name, kwargs))
+        if output_after is not None:
+            time.sleep(output_after)
+            on_output()
+        if cancel.wait(delay):
+            cancelled.set()
+            return ExecutionResult(success=False, output="", error="Cancelled", exit_code=-1)
+        return ExecutionResult(success=True, output=vm_name)
+
+    controller.ask_claude = ask_claude
+    controller.cancelled = cancelled
+    return controller
+
+policy = HedgePolicy(enabled=True, default_delay_ms=200, min_delay_ms=100)
+
+# No output within the hedge delay: a second VM runs the job, wins, and the first is cancelled
+slow, fast = stub("slow", 5), stub("fast", 0.05)
+executor = HedgedExecutor([slow, fast], policy)
+started = time.monotonic()
+result = executor.ask_claude("summarize", read_only=True, project="app")
+assert result.success and result.output == "fast" and time.monotonic() - started < 1
+assert result.timings["hedged"] is True and result.timings["winner"] == "fast"
+executor.shutdown(5)
+assert slow.cancelled.is_set()
+assert [vm for vm, _ in calls] == ["slow", "fast"]
+for _, kwargs in calls:
+    assert kwargs["allowed_tools"] == READ_ONLY_TOOLS
+    assert set(MUTATING_TOOLS) <= set(kwargs["disallowed_tools"])
+stats = executor.stats()
+assert stats["jobs"] == 1 and stats["hedged"] == 1 and stats["hedge_wins"] == 1
+
+# Output before the delay: no hedge
+calls.clear()
+executor = HedgedExecutor([stub("steady", 0.4, output_after=0.05), stub("spare", 0.05)], policy)
+result = executor.ask_claude("summarize", read_only=True)
+assert result.output == "steady" and result.timings["hedged"] is False
+assert [vm for vm, _ in calls] == ["steady"]
+
+# Jobs that may write are never hedged and keep the caller's tools
+calls.clear()
+executor = HedgedExecutor([stub("slow", 0.4), stub("fast", 0.05)], policy)
+result = executor.ask_claude("fix the bug", allowed_tools=["Edit"])
+assert result.output == "slow" and result.timings["hedged"] is False
+assert calls == [("slow", {"allowed_tools": ["Edit"]})]
+
+# A read-only job can't allow a mutating tool
+try:
+    executor.ask_claude("summarize", read_only=True, allowed_tools=["Read", "Bash(git log:*)"])
+    raise AssertionError("mutating tool allowed")
+except ValueError as e:
+    assert "Bash(git log:*)" in str(e)
+result = executor.ask_claude("summarize", read_only=True, allowed_tools=["Read"],
+                             disallowed_tools=["WebFetch"])
+assert calls[-1][1]["disallowed_tools"] == sorted(MUTATING_TOOLS + ["WebFetch"])
+EOF
+
+run_python_test "Request log ring buffer wraps and filters" <<'EOF' || true
+from proxy_monitor import RequestLog
+from proxy_store import RequestLogStore
+
+store = RequestLogStore(capacity=5)
+for n in range(30):
+    # 30 distinct hosts and paths: the symbol tables outgrow 2 x capacity and are compacted
+    store.append(RequestLog(
+        timestamp=1769300000.0 + n, method="POST" if n % 2 else "GET",
+        url=f"http://h{n}.example/p{n}", host=f"h{n}.example", path=f"/p{n}",
+        status_code=404 if n % 3 == 0 else 200, response_size=n, duration_ms=float(n),
+        error="reset" if n == 28 else None, job="j1" if n >= 27 else None,
+    ))
+
+assert len(store) == 5
+assert [row["path"] for row in store] == ["/p25", "/p26", "/p27", "/p28", "/p29"]
+assert store[0]["host"] == "h25.example" and store[-1]["response_size"] == 29
+assert len(store._hosts_table) <= 2 * store.capacity
+assert len(store._paths_table) <= 2 * store.capacity
+assert [r["path"] for r in store.query(status=404)] == ["/p27"]
+assert [r["path"] for r in store.query(method="POST")] == ["/p25", "/p27", "/p29"]
+assert [r["path"] for r in store.query(job="j1", limit=2)] == ["/p28", "/p29"]
+assert [r["path"] for r in store.query(errors_only=True)] == ["/p28"]
+assert store.query(host="h3.example") == []  # overwritten
+assert [r["path"] for r in store.query(since=1769300027.0, until=1769300029.0)] == ["/p27", "/p28"]
+assert [r["path"] for r in store.recent(2)] == ["/p28", "/p29"]
+EOF
+
+run_python_test "Proxy cache serves HIT and REVALIDATED" <<'EOF' || true
+import asyncio, http.client, http.server, tempfile, threading
+import proxy_monitor as pm
+from proxy_cache import HttpCache
+
+origin_hits = []
+
+class Origin(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        origin_hits.append(self.path)
+        if self.path == "/etag" and self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            return
+        body = self.path.encode() * 100
+        self.send_response(200)
+        if self.path == "/etag":
+            self.send_header("ETag", '"v1"')
+            self.send_header("Cache-Control", "no-cache")
+        else:
+            self.send_header("Cache-Control", "max-age=60")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+origin = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+threading.Thread(target=origin.serve_forever, daemon=True).start()
+monitor = pm.ProxyMonitor()
+server = pm.ProxyServer(monitor, host="127.0.0.1", port=0, cache=HttpCache(tempfile.mkdtemp()))
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+asyncio.run_coroutine_threadsafe(server.start(), loop).result(10)
+
+def get(path):
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+    conn.request("GET", f"http://127.0.0.1:{origin.server_address[1]}{path}")
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response.status, response.getheader("X-Cache"), body
+
+first, second = get("/fresh"), get("/fresh")
+assert first[:2] == (200, "MISS") and second[:2] == (200, "HIT") and first[2] == second[2]
+assert origin_hits.count("/fresh") == 1
+assert get("/etag")[:2] == (200, "MISS")
+revalidated = get("/etag")
+assert revalidated[:2] == (200, "REVALIDATED") and revalidated[2] == b"/etag" * 100
+assert origin_hits.count("/etag") == 2
+EOF
+
+run_python_test "Proxy policy returns 403 and 429" <<'EOF' || true
+import asyncio, http.client, http.server, threading
+import proxy_monitor as pm
+from proxy_policy import Policy, PolicyEngine
+
+policy = Policy.from_dict({"rules": [
+    {"match": [".blocked.test", "10.0.0.0/8"], "action": "deny"},
+    {"match": "10.1.2.0/24"},
+    {"match": "127.0.0.1", "requests_per_second": 2},
+]})
+assert not policy.match("a.b.blocked.test").allowed and not policy.match("blocked.test").allowed
+assert policy.match("notblocked.test").allowed
+assert not policy.match("10.9.9.9").allowed and policy.match("10.1.2.3").allowed
+
+# Client limits apply per sandbox: every VM reaches the proxy from the same usernet address
+engine = PolicyEngine(policy=Policy.from_dict({"client": {"requests_per_second": 1}}))
+assert engine.check("pypi.org", "192.168.5.2", "vm1").allowed
+assert engine.check("pypi.org", "192.168.5.2", "vm1").status == 429
+assert engine.check("pypi.org", "192.168.5.2", "vm2").allowed
+assert engine.check("pypi.org", "192.168.5.2").allowed
+assert engine.check("pypi.org", "192.168.5.2").status == 429
+
+class Origin(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+origin = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+threading.Thread(target=origin.serve_forever, daemon=True).start()
+monitor = pm.ProxyMonitor()
+server = pm.ProxyServer(monitor, host="127.0.0.1", port=0, policy=PolicyEngine(policy=policy))
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+asyncio.run_coroutine_threadsafe(server.start(), loop).result(10)
+
+def get(url):
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+    conn.request("GET", url)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status, response.getheader("Retry-After")
+
+assert get("http://www.blocked.test/")[0] == 403
+url = f"http://127.0.0.1:{origin.server_address[1]}/"
+statuses = [get(url) for _ in range(4)]
+assert statuses[0] == (200, None)
+assert statuses[-1][0] == 429 and int(statuses[-1][1]) >= 1
+stats = monitor.get_stats()
+assert stats["policy_denied"] == 1 and stats["rate_limited"] >= 1
+EOF
+
+run_python_test "Proxy sheds load with 503 and times out slow headers" <<'EOF' || true
+import asyncio, socket, threading, time
+import proxy_monitor as pm
+
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+
+def start(**options):
+    monitor = pm.ProxyMonitor()
+    server = pm.ProxyServer(monitor, host="127.0.0.1", port=0, **options)
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result(10)
+    return monitor, server
+
+def connect(server, request=b"GET http://pkg.test/ HTTP/1.1\r\nHost: pkg.test\r\n\r\n"):
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=10)
+    sock.sendall(request)
+    time.sleep(0.1)  # accepted in order
+    return sock
+
+def response(sock):
+    data = b""
+    while chunk := sock.recv(4096):
+        data += chunk
+    sock.close()
+    return data
+
+monitor, server = start(max_connections=1, max_pending=1, queue_timeout=0.5, header_timeout=1.5)
+# A client that never finishes its headers takes the only slot
+slow = connect(server, b"GET http://pkg.test/ HTTP/1.1\r\n")
+queued = connect(server)            # waits for the slot (max_pending=1)
+began = time.monotonic()
+overflow = response(connect(server))  # queue full: rejected at once
+assert overflow.startswith(b"HTTP/1.1 503") and time.monotonic() - began < 0.5
+queued_reply = response(queued)     # rejected after queue_timeout
+assert queued_reply.startswith(b"HTTP/1.1 503") and b"\r\nRetry-After: 5\r\n" in queued_reply
+assert time.monotonic() - began >= 0.3
+# The header timeout closes the slow client without a response
+assert response(slow) == b"" and time.monotonic() - began < 2.5
+stats = monitor.get_stats()
+assert stats["rejected"]["overload"] == 2 and stats["timeouts"]["header"] == 1
+
+monitor, server = start(max_client_connections=1, header_timeout=1.5)
+slow = connect(server, b"GET http://pkg.test/ HTTP/1.1\r\n")
+reply = response(connect(server))
+assert reply.startswith(b"HTTP/1.1 503") and b"Too many connections from 127.0.0.1" in reply
+assert monitor.get_stats()["rejected"]["client_limit"] == 1
+slow.close()
+EOF
+
+run_python_test "Proxy workers merge /stats and keep a killed worker's counts" <<'EOF' || true
+import http.client, http.server, json, os, signal, socket, subprocess, sys, tempfile, threading, time
+
+class Origin(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def get(port, url):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", url)
+    body = conn.getresponse().read()
+    conn.close()  # a new connection each time: the kernel spreads them over the workers
+    return body
+
+def wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if condition():
+                return
+        except OSError:
+            pass
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.2)
+
+def workers():
+    with open(f"/proc/{proxy.pid}/task/{proxy.pid}/children") as f:
+        pids = [int(pid) for pid in f.read().split()]
+    return [pid for pid in pids if b"resource_tracker" not in open(f"/proc/{pid}/cmdline", "rb").read()]
+
+def stats():
+    return json.loads(get(metrics_port, "/stats"))
+
+origin = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+threading.Thread(target=origin.serve_forever, daemon=True).start()
+url = f"http://127.0.0.1:{origin.server_address[1]}/"
+port, metrics_port = free_port(), free_port()
+output = tempfile.TemporaryFile()
+proxy = subprocess.Popen(
+    [sys.executable, "proxy_monitor.py", "--host", "127.0.0.1", "--port", str(port),
+     "--metrics-port", str(metrics_port), "--workers", "2"],
+    stdout=output, stderr=subprocess.STDOUT, start_new_session=True,
+)
+try:
+    wait_for(lambda: get(port, url) == b"ok")
+    for _ in range(19):
+        assert get(port, url) == b"ok"
+    wait_for(lambda: stats()["total_requests"] == 20)
+    assert len(workers()) == 2
+    assert len(json.loads(get(metrics_port, "/recent?count=100"))) == 20
+
+    # A killed worker is restarted and the requests it served stay in /stats
+    killed = workers()[0]
+    os.kill(killed, signal.SIGKILL)
+    wait_for(lambda: len(workers()) == 2 and killed not in workers())
+    for _ in range(30):
+        time.sleep(0.1)
+        assert stats()["total_requests"] == 20
+    for _ in range(10):
+        assert get(port, url) == b"ok"
+    wait_for(lambda: stats()["total_requests"] == 30)
+    output.seek(0)
+    assert b"exited with code -9, restarting" in output.read()
+finally:
+    os.killpg(proxy.pid, signal.SIGKILL)
+    proxy.wait()
+EOF
+
+run_python_test "CONNECT tunnel delivers a large payload to a slow reader" <<'EOF' || true
+import asyncio, hashlib, os, socket, threading, time
+import proxy_monitor as pm
+
+payload = os.urandom(16 * 1024 * 1024)
+listener = socket.create_server(("127.0.0.1", 0))
+
+def origin():
+    # Sends first (like an SSH or SMTP banner), then the whole payload
+    while True:
+        conn, _ = listener.accept()
+        conn.sendall(payload)
+        conn.close()
+
+threading.Thread(target=origin, daemon=True).start()
+monitor = pm.ProxyMonitor()
+server = pm.ProxyServer(monitor, host="127.0.0.1", port=0)
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+asyncio.run_coroutine_threadsafe(server.start(), loop).result(10)
+
+client = socket.create_connection(("127.0.0.1", server.port), timeout=30)
+client.sendall(f"CONNECT 127.0.0.1:{listener.getsockname()[1]} HTTP/1.1\r\n\r\n".encode())
+data = b""
+while b"\r\n\r\n" not in data:
+    data += client.recv(4096)
+head, data = data.split(b"\r\n\r\n", 1)
+assert head.startswith(b"HTTP/1.1 200")
+received = hashlib.sha256(data)
+total = len(data)
+while True:
+    time.sleep(0.0005)  # slow reader: the proxy's writes to the client stay partial
+    chunk = client.recv(16384)
+    if not chunk:
+        break
+    received.update(chunk)
+    total += len(chunk)
+assert total == len(payload) and received.digest() == hashlib.sha256(payload).digest()
+
+# Upstream data arriving before the client side is attached is kept, not written to None
+async def early_upstream():
+    tunnel = pm.Tunnel()
+    sent = []
+
+    class Transport:
+        def set_write_buffer_limits(self, high): pass
+        def write(self, data): sent.append(bytes(data))
+        def can_write_eof(self): return True
+        def write_eof(self): sent.append(b"EOF")
+        def get_write_buffer_size(self): return 0
+        def pause_reading(self): pass
+        def resume_reading(self): pass
+
+    tunnel.upstream.connection_made(Transport())
+    tunnel.upstream.buffer[:6] = b"SSH-2."
+    tunnel.upstream.buffer_updated(6)
+    tunnel.upstream.eof_received()
+    tunnel.client.connection_made(Transport())
+    assert sent == [b"SSH-2.", b"EOF"] and tunnel.bytes_down == 6
+
+asyncio.run(early_upstream())
+EOF
+
+run_python_test "DNS cache expires, caches failures and shares lookups" <<'EOF' || true
+import asyncio, socket, time, types
+import proxy_dns
+from proxy_dns import DnsCache, happy_eyeballs_connect
+
+clock = [1000.0]
+proxy_dns.time = types.SimpleNamespace(monotonic=lambda: clock[0])
+answers = {"pkg.test": "10.0.0.1"}
+queries = []
+
+async def getaddrinfo(host, port, type=0):
+    queries.append(host)
+    await asyncio.sleep(0.01)
+    if host not in answers:
+        raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (answers[host], 0))]
+
+async def main():
+    asyncio.get_running_loop().getaddrinfo = getaddrinfo
+    cache = DnsCache(ttl=60, negative_ttl=5)
+
+    # Single flight: concurrent lookups of one host share a query
+    results = await asyncio.gather(*[cache.resolve("pkg.test") for _ in range(5)])
+    assert queries == ["pkg.test"] and all(r == [(socket.AF_INET, ("10.0.0.1", 0))] for r in results)
+
+    # Cached until the TTL expires
+    clock[0] += 30
+    await cache.resolve("pkg.test")
+    assert queries == ["pkg.test"]
+    answers["pkg.test"] = "10.0.0.2"
+    clock[0] += 31
+    assert (await cache.resolve("pkg.test"))[0][1][0] == "10.0.0.2" and len(queries) == 2
+
+    # Negative caching: one query per negative_ttl
+    for _ in range(3):
+        try:
+            await cache.resolve("missing.test")
+            raise AssertionError("resolved a missing host")
+        except socket.gaierror:
+            pass
+    assert queries.count("missing.test") == 1
+    clock[0] += 6
+    try:
+        await cache.resolve("missing.test")
+    except socket.gaierror:
+        pass
+    assert queries.count("missing.test") == 2
+
+    # Refresh ahead: served from cache while refreshing; a failed refresh keeps the old entry
+    del answers["pkg.test"]
+    clock[0] += 50  # past 80% of the TTL
+    assert (await cache.resolve("pkg.test"))[0][1][0] == "10.0.0.2"
+    await asyncio.sleep(0.05)
+    assert queries.count("pkg.test") == 3 and cache.refreshes == 1
+    assert (await cache.resolve("pkg.test"))[0][1][0] == "10.0.0.2"
+    clock[0] += 11  # expires with its original TTL, even with a refresh in flight
+    try:
+        await cache.resolve("pkg.test")
+        raise AssertionError("served an expired entry")
+    except socket.gaierror:
+        pass
+
+    # Happy eyeballs: an address that never answers costs one delay, not a timeout
+    listener = socket.create_server(("127.0.0.1", 0))
+    attempt = proxy_dns._attempt
+    started = []
+
+    async def blackholed(loop, family, sockaddr):
+        started.append(sockaddr[0])
+        if sockaddr[0] == "192.0.2.1":
+            await asyncio.sleep(3600)
+        return await attempt(loop, family, sockaddr)
+
+    proxy_dns._attempt = blackholed
+    begin = asyncio.get_running_loop().time()
+    sock = await happy_eyeballs_connect(
+        [(socket.AF_INET, ("192.0.2.1", 0)), (socket.AF_INET, ("127.0.0.1", 0))],
+        listener.getsockname()[1], delay=0.2,
+    )
+    elapsed = asyncio.get_running_loop().time() - begin
+    assert started == ["192.0.2.1", "127.0.0.1"] and 0.2 <= elapsed < 0.5, elapsed
+    assert sock.getpeername() == listener.getsockname()
+    sock.close()
+    listener.close()
+
+asyncio.run(main())
+EOF
+
+run_python_test "Log rotation compresses segments and read_log spans them" <<'EOF' || true
+import logging, os, tempfile, time
+from logger import ArchivingFileHandler, read_log, _TEXT_TIME_FORMAT
+
+log_file = os.path.join(tempfile.mkdtemp(), "cowork.log")
+handler = ArchivingFileHandler(log_file, max_bytes=0, rotate_seconds=600, retention_days=0)
+handler.setFormatter(logging.Formatter("%(asctime)s %(message)s", datefmt=_TEXT_TIME_FORMAT))
+base = int(time.time()) - 3600
+for n in range(30):
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, "line %d", (n,), None)
+    record.created = base + n * 120  # one record every 2 minutes, a segment every 10
+    handler.emit(record)
+handler.close()  # waits for background compression
+
+segments = handler.index.segments
+names = sorted(os.listdir(os.path.dirname(log_file)))
+assert len(segments) == 5 and all(segment["compressed"] for segment in segments)
+assert sum(name.endswith(".gz") for name in names) == 5
+assert [line.split()[-1] for line in read_log(log_file)] == [str(n) for n in range(30)]
+window = [line.split()[-1] for line in read_log(log_file, base + 600, base + 1200)]
+assert window == [str(n) for n in range(5, 11)]
+EOF
+
+run_python_test "Log pipeline drops on overflow, reports it and flushes" <<'EOF' || true
+import logging, subprocess, sys, threading, time
+from logger import LogPipeline
+
+class SlowHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.gate.wait()
+        self.messages.append(record.getMessage())
+
+def record(message, level=logging.INFO):
+    return logging.LogRecord("test", level, __file__, 0, message, None, None)
+
+handler = SlowHandler()
+pipeline = LogPipeline([handler], queue_size=4, overflow="drop")
+pipeline.handle(record("first"))
+while pipeline.queue.qsize():
+    time.sleep(0.001)  # the writer thread has taken "first" and waits in the handler
+for n in range(10):
+    pipeline.handle(record(f"line {n}"))
+assert pipeline.stats()["dropped"] == 6 and pipeline.stats()["pending"] == 4
+
+# Errors wait for room instead of being dropped
+error = threading.Thread(target=pipeline.handle, args=(record("failure", logging.ERROR),))
+error.start()
+error.join(0.2)
+assert error.is_alive()
+handler.gate.set()
+error.join(5)
+assert pipeline.flush(5)
+assert handler.messages[:5] == ["first", "line 0", "line 1", "line 2", "line 3"]
+assert sorted(handler.messages[5:]) == ["Log queue full, dropped 6 records", "failure"]
+assert pipeline.stats()["written"] == 7 and pipeline.stats()["pending"] == 0
+pipeline.close()
+
+# Records still queued at exit are written by close() from atexit
+script = (
+    "import logging, sys\n"
+    "from logger import LogPipeline\n"
+    "pipeline = LogPipeline([logging.StreamHandler(sys.stdout)], overflow='block')\n"
+    "for n in range(1000):\n"
+    "    pipeline.handle(logging.LogRecord('t', logging.INFO, '', 0, 'line %d', (n,), None))\n"
+)
+output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=30)
+assert output.stdout.splitlines() == [f"line {n}" for n in range(1000)]
+EOF
+
+run_python_test "Latency histogram percentiles stay within 1/16" <<'EOF' || true
+import random
+from proxy_metrics import LatencyHistogram
+
+random.seed(1)
+values = [random.lognormvariate(3, 1.5) for _ in range(20000)]
+first, second = LatencyHistogram(), LatencyHistogram()
+for n, value in enumerate(values):
+    (first if n % 2 else second).record(value)
+first.merge(second)
+values.sort()
+assert first.count == len(values)
+for pct in (50, 90, 99, 99.9):
+    exact = values[min(len(values) - 1, int(pct / 100 * len(values)))]
+    assert abs(first.percentile(pct) - exact) <= exact / 16 + 0.001, pct
+assert first.percentile(100) <= values[-1] * (1 + 1 / 16)
+EOF
+
+run_python_test "HyperLogLog and Space-Saving stay within their error bounds" <<'EOF' || true
+from proxy_metrics import HyperLogLog, SpaceSaving
+
+first, second = HyperLogLog(), HyperLogLog()
+for n in range(30000):
+    (first if n < 20000 else second).add(f"host{n}.example")
+    second.add(f"host{n % 100}.example")
+first.merge(second)
+assert abs(first.count() - 30000) <= 3 * first.relative_error * 30000
+
+top = SpaceSaving(capacity=20)
+for n in range(5000):
+    top.add(f"rare{n}.example")
+    if n % 5 == 0:
+        top.add("pypi.org", 10)
+host, count, error = top.top(1)[0]
+assert host == "pypi.org" and count - error <= 10000 <= count
+assert top.max_error <= top.total // top.capacity
+EOF
+
+run_python_test "Trace context reaches proxy records through the proxy URL" <<'EOF' || true
+import base64, os, tempfile
+from urllib.parse import unquote, urlsplit
+from controller import CoworkController, SandboxConfig
+from proxy_accounting import parse_attribution
+from proxy_monitor import RequestLog
+from proxy_store import RequestLogStore
+from tracing import Tracer, load_trace
+
+trace_file = os.path.join(tempfile.mkdtemp(), "traces.jsonl")
+tracer = Tracer(trace_file)
+controller = CoworkController(SandboxConfig(proxy_host="192.168.5.2"))
+with tracer.span("ask_claude", job_id="job1") as parent:
+    shell = tracer.start("vm_shell")
+    env = controller._proxy_env("job1", shell.traceparent)
+    tracer.end(shell)
+
+# What an HTTP client sends for the proxy URL in the environment
+proxy_url = urlsplit(env.split()[0].split("=", 1)[1])
+credentials = f"{unquote(proxy_url.username)}:{unquote(proxy_url.password)}"
+headers = [("Proxy-Authorization", "Basic " + base64.b64encode(credentials.encode()).decode())]
+sandbox, job, trace_id, parent_span_id = parse_attribution(headers)
+assert (sandbox, job) == ("sandbox", "job1")
+assert (trace_id, parent_span_id) == (parent.trace_id, shell.span_id)
+
+request = RequestLog(timestamp="2026-01-25T10:00:00", method="GET", url="http://pypi.org/simple/",
+                     host="pypi.org", path="/simple/")
+request.attribute(("192.168.5.15", sandbox, job, trace_id, parent_span_id))
+store = RequestLogStore(capacity=10)
+store.append(request)
+row = store[-1]
+assert row["trace_id"] == parent.trace_id and row["parent_span_id"] == shell.span_id
+assert row["span_id"] == request.span_id and len(row["span_id"]) == 16
+
+spans = {span.name: span for span in load_trace("job1", trace_file, None)["cowork-controller"]}
+assert spans["vm_shell"].parent_id == spans["ask_claude"].span_id == parent.span_id
+EOF
+
 if [ "$VM_RUNNING" != true ]; then
     echo ""
     echo -e "${YELLOW}⚠ Skipping VM functionality tests (VM not running)${NC}"